@@ -141,7 +141,7 @@ def print_manual_to_detected_mapping_table(tp_manual, idx_to_op_map):
   # print(tabulate(table, headers=['idx', 'manual slice', 'detected op (name type idx)']))
 
 
-def test_accuracy(tp_manual, idx_to_op_map, flow_index, metadata):
+def test_accuracy(tp_manual, idx_to_op_map, flow_index, metadata, slice_table=None, topology=None):
   """We are going to match IDs found in the manual annotation to the detected ops."""
   # if not was_step_called:  # TODO: Fix me for user friendliness
   #   raise Exception('When testing accuracy you must call hotline.annotate.step() after each training iteration.')
@@ -168,12 +168,12 @@ def test_accuracy(tp_manual, idx_to_op_map, flow_index, metadata):
 
     # Get detected slices and slices in manual annotation
     detected_slices = h_slice.get_slices(op)
-    manual_slices = h_perfetto.get_descendant_and_connected_slices(tp_manual, flow_index, manual_annotation["id"])
+    manual_slices = h_perfetto.get_descendant_and_connected_slices(tp_manual, flow_index, manual_annotation["id"], slice_table)
     if op.get('is_model_pass') == 'Backward':
       # Get slices on other CPU threads
-      bw_slices = h_perfetto.get_slices_on_other_threads_on_same_process_between_time_range(tp_manual, manual_annotation)
+      bw_slices = h_perfetto.get_slices_on_other_threads_on_same_process_between_time_range(tp_manual, manual_annotation, slice_table, topology)
       # Get GPU kernels
-      bw_slices.extend(h_perfetto.get_connected_slices(tp_manual, flow_index, bw_slices))
+      bw_slices.extend(h_perfetto.get_connected_slices(tp_manual, flow_index, bw_slices, slice_table))
       manual_slices.extend(bw_slices)
     manual_slices = h_annotate._remove_manual_annotations(manual_slices)  # For example, forward pass has manual annotations of the layers and ops, we don't want to count those events in the accuracy caclulation
 
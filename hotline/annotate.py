@@ -2,6 +2,7 @@ import traceback
 import inspect
 import orjson
 import torch
+import concurrent.futures
 
 from IPython import embed
 from pprint import pprint
@@ -28,28 +29,34 @@ def _remove_manual_annotations(slices):
 
 def remove_manual_annotations(input_trace_file):
   # Read trace
-  with open(input_trace_file, "rb") as f:
+  with h_read.open_trace(input_trace_file) as f:
     trace = orjson.loads(f.read())
 
   # Remove slices that include "hotline id" because they are manual annotations
   trace['traceEvents'] = _remove_manual_annotations(trace['traceEvents'])
 
-  # Write trace
-  with open(input_trace_file, 'wb') as f:
+  # Write trace, compressed the same way as it was read
+  with h_read.open_trace(input_trace_file, 'wb') as f:
     f.write(orjson.dumps(trace))  # 4x faster
 
 
 def get_manual_annotation_by_idx(tp_manual, idx):
-  manual_annotation = tp_manual.query_dict(f'select * from slices where name like "hid={idx} %"')
+  manual_annotation = tp_manual.query_dict_cached(f'select * from slices where name like "hid={idx} %"')
   if manual_annotation:
     return manual_annotation[0]
   else:
     return {}
 
 
+def prefetch_manual_annotations(tp_manual, idxs, num_threads):
+  """Run the queries of get_manual_annotation_by_idx() for every idx on num_threads threads, so later calls are answered by the query cache. Only faster with a TraceProcessorReplicas of at least num_threads trace processors."""
+  with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+    list(executor.map(lambda idx: get_manual_annotation_by_idx(tp_manual, idx), idxs))
+
+
 def get_annotation_idx_by_name(tp_manual, name):
   name = name.lower()
-  manual_annotation = tp_manual.query_dict(f'select * from slices where LOWER(slices.name) like "hid=% {name}%"')
+  manual_annotation = tp_manual.query_dict_cached(f'select * from slices where LOWER(slices.name) like "hid=% {name}%"')
   if manual_annotation:
     name = manual_annotation[0]['name']
     idx = int(name.split(' ')[0].split('=')[1])
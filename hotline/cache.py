@@ -0,0 +1,105 @@
+import os
+import shutil
+import pickle
+import hashlib
+
+from hotline.hotline import *
+
+# Bump when the layout of anything stored in the cache changes so that stale entries are never loaded
+CACHE_VERSION = 3
+DEFAULT_MAX_SIZE = 10 * 1024**3  # 10 GB
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def trace_key(trace_filepath, **params):
+  """Content-addressed cache key for a trace file.
+
+  The key is a hash of the bytes of the trace file, not its path or modification time, so a copy of the same trace on another path reuses the cache while an overwritten trace does not. Any params that change the ingested result, such as remove_slice_args, are part of the key.
+  """
+  digest = hashlib.blake2b(digest_size=20)
+  with open(trace_filepath, 'rb') as f:
+    for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+      digest.update(block)
+  digest.update(repr((CACHE_VERSION, sorted(params.items()))).encode())
+  return digest.hexdigest()
+
+
+def entry_dir(cache_dir, key):
+  return os.path.join(cache_dir, key)
+
+
+def load(cache_dir, key, name):
+  """Return the object stored under name for this key, or None on a cache miss."""
+  filepath = os.path.join(entry_dir(cache_dir, key), f'{name}.pickle')
+  try:
+    with open(filepath, 'rb') as f:
+      obj = pickle.load(f)
+  except FileNotFoundError:
+    return None
+  except Exception as e:
+    # A truncated or incompatible entry is treated as a miss and will be overwritten
+    log.warning(f'Ignoring unreadable cache entry {filepath}: {e}')
+    return None
+  os.utime(entry_dir(cache_dir, key))  # mark as recently used for eviction
+  log.info(f'Loaded {name} from cache: {filepath}')
+  return obj
+
+
+def save(cache_dir, key, name, obj, max_size=DEFAULT_MAX_SIZE):
+  """Store obj under name for this key, then evict least recently used entries until the cache fits in max_size bytes."""
+  dirpath = entry_dir(cache_dir, key)
+  os.makedirs(dirpath, exist_ok=True)
+  filepath = os.path.join(dirpath, f'{name}.pickle')
+  tmp_filepath = f'{filepath}.{os.getpid()}.tmp'
+  with open(tmp_filepath, 'wb') as f:
+    pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+  os.replace(tmp_filepath, filepath)  # atomic so concurrent readers never see a partial entry
+  os.utime(dirpath)
+  evict(cache_dir, max_size, keep_key=key)
+
+
+def open_file(cache_dir, key, name):
+  """Return the file stored under name for this key opened for reading, or None on a cache miss. For large data that shouldn't be loaded into memory by pickle."""
+  filepath = os.path.join(entry_dir(cache_dir, key), name)
+  try:
+    f = open(filepath, 'rb')
+  except FileNotFoundError:
+    return None
+  os.utime(entry_dir(cache_dir, key))  # mark as recently used for eviction
+  log.info(f'Opened {name} from cache: {filepath}')
+  return f
+
+
+def save_file(cache_dir, key, name, src, max_size=DEFAULT_MAX_SIZE):
+  """Copy the file object src from its start to name for this key, then evict like save()."""
+  dirpath = entry_dir(cache_dir, key)
+  os.makedirs(dirpath, exist_ok=True)
+  filepath = os.path.join(dirpath, name)
+  tmp_filepath = f'{filepath}.{os.getpid()}.tmp'
+  src.seek(0)
+  with open(tmp_filepath, 'wb') as f:
+    shutil.copyfileobj(src, f)
+  src.seek(0)
+  os.replace(tmp_filepath, filepath)
+  os.utime(dirpath)
+  evict(cache_dir, max_size, keep_key=key)
+
+
+def entry_size(dirpath):
+  return sum(entry.stat().st_size for entry in os.scandir(dirpath) if entry.is_file())
+
+
+def evict(cache_dir, max_size=DEFAULT_MAX_SIZE, keep_key=None):
+  """Delete whole entries, least recently used first, until the total size of the cache is at most max_size bytes. The entry for keep_key is never deleted."""
+  if not os.path.isdir(cache_dir):
+    return
+  entries = [(entry.stat().st_mtime, entry.path, entry_size(entry.path)) for entry in os.scandir(cache_dir) if entry.is_dir()]
+  total_size = sum(size for _, _, size in entries)
+  for _, dirpath, size in sorted(entries):
+    if total_size <= max_size:
+      break
+    if os.path.basename(dirpath) == keep_key:
+      continue
+    log.info(f'Evicting cache entry: {dirpath}')
+    shutil.rmtree(dirpath, ignore_errors=True)
+    total_size -= size
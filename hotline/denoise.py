@@ -82,6 +82,7 @@ def detect_arbitrary_annotations(op, max_generated_depth, tiny_op_threshold, **k
     # Get slices on track with most slices, ignore the other tracks. We will make annotations using time spans found on track with most slices
     _, max_slices_track_id = h_slice.get_track_with_most_slices(all_slices)
     slices = [slice for slice in all_slices if slice['track_id'] == max_slices_track_id]
+    interval_index = h_table.IntervalIndex.from_slices(all_slices)  # for the time range of each slice group below
 
     # Get unique slice depths so that we can select only what we are interested in. We are interested in the first depth that has more than 1 slice on it.
     depths = [slice["depth"] for slice in slices]
@@ -126,7 +127,7 @@ def detect_arbitrary_annotations(op, max_generated_depth, tiny_op_threshold, **k
       # Found a new section. Get slices in this section, all of their sub slices, and create a new op.
       else:
         slice_group = slices_of_interest[idx - instances : idx]
-        sub_slices = h_slice.get_sub_slices_for_range(all_slices, slice_group)
+        sub_slices = h_slice.get_sub_slices_for_range(all_slices, slice_group, interval_index)
 
         # Fix weirdness involving ops with dur=0 by adding to sub_slices any item in the slice_group that is missing from sub_slices.
         sub_slice_ids = [slice['id'] for slice in sub_slices]
@@ -1,4 +1,6 @@
-import copy
+
+import multiprocessing
+import numpy as np
 
 from hotline.hotline import *
 
@@ -112,7 +114,7 @@ def mark_is_backward(op, **kwargs):
     del op['idx']  # remove the idx as it is the same as the matching forward pass op. TODO: add a new idx for the backward pass op but need to know what the next idx is
 
 
-def detect_model_dfs(ops, state, is_backward, tp):
+def detect_model_dfs(ops, state, is_backward, tp, span_fn=None):
   """
   Forward pass: Post-order tree traversal. A kind of depth-first search. Is a recursive function. Used to step through the model definition in forward order, leafs first, then parents. https://en.wikipedia.org/wiki/Tree_traversal
 
@@ -123,7 +125,7 @@ def detect_model_dfs(ops, state, is_backward, tp):
   for idx in range(len(ops)):
     op = ops[idx]
     if 'ops' in op:
-      detect_model_dfs(op['ops'], state, is_backward, tp)
+      detect_model_dfs(op['ops'], state, is_backward, tp, span_fn)
 
     # Need next op to handle "Edge case: Don't match if next detected op has the same name"
     # Limitation: current next_op will only work for direct sibiling ops of the same parent, not when two leafs are technically next but have different parents. Possible solution: on each op set the parent so that the child can traverse up and anywhere.
@@ -131,7 +133,7 @@ def detect_model_dfs(ops, state, is_backward, tp):
     if idx + 1 < len(ops):
       next_op = ops[idx + 1]
 
-    infer_span(op, state, is_backward, tp, next_op)
+    (span_fn or infer_span)(op, state, is_backward, tp, next_op)
   return ops, state
 
 
@@ -158,7 +160,7 @@ def next_slice_also_matches(op, state, is_backward, tp):
   except IndexError:
     return False
 
-  op_found, is_fused = h_name.fuzzy_op_match(next_slice, op, is_backward, tp)
+  op_found, is_fused = h_name.fuzzy_op_match(next_slice, op, is_backward, tp, state.get('launch_index'), state.get('op_matcher'))
   if op_found:
     return True
 
@@ -193,7 +195,7 @@ def infer_span(op, state, is_backward, tp, next_op):
   start_idx = state['slice_idx']
   while state['slice_idx'] < len(state['slices']):
     slice = state['slices'][state['slice_idx']]
-    op_found, is_fused = h_name.fuzzy_op_match(slice, op, is_backward, tp)
+    op_found, is_fused = h_name.fuzzy_op_match(slice, op, is_backward, tp, state.get('launch_index'), state.get('op_matcher'))
     # is_fused = False # Feature Toggle: Disable fused op matching
     if not op_found or not is_fused:
       state['slice_idx'] += 1 # increment by one in default case
@@ -215,7 +217,7 @@ def infer_span(op, state, is_backward, tp, next_op):
         state['last_found_was_fused'] = False
       log.debug(f'[infer_span] {start_idx} - {state["slice_idx"]} [{len(slices)}]')
       # h_slice.add_slices_to_op(op, slices, 'cpu')
-      h_perfetto.add_slices(op, slices, tp)
+      h_perfetto.add_slices(op, slices, tp, state.get('slice_table'))
       state['last_found_slice_idx'] = state['slice_idx']
       state['op_found_count'] += 1
       return op_found
@@ -226,11 +228,153 @@ def infer_span(op, state, is_backward, tp, next_op):
     state['slice_idx'] = state['last_found_slice_idx']
 
 
+ALIGNMENT_BAND = 512  # slices on either side of the diagonal that align_leaf_ops() considers for each leaf op
+ALIGN_LEFT, ALIGN_UP, ALIGN_MATCH, ALIGN_FUSED = 0, 1, 2, 3  # moves of the alignment
 
-def detect_model(op, model_ops, tp, parent_op=None, **kwargs):
-  if 'is_model_pass' not in op:
+
+def leaf_op_sequence(ops, is_backward):
+  """Leaf ops in the order detect_model_dfs() visits them."""
+  leaf_ops = []
+  for op in (list(reversed(ops)) if is_backward else ops):
+    if 'ops' in op:
+      leaf_ops.extend(leaf_op_sequence(op['ops'], is_backward))
+    else:
+      leaf_ops.append(op)
+  return leaf_ops
+
+
+class MatchMatrix:
+  """Which leaf ops match which slices, like fuzzy_op_match() on every pair, without storing a leaf x slice matrix.
+
+  Names are matched once per unique (op type, slice name) pair, then a row of the matrix is a lookup of the slice name codes in the row of the op type.
+  """
+  def __init__(self, leaf_ops, slices, is_backward, tp, launch_index=None, op_matcher=None):
+    name_codes, type_codes = {}, {}
+    self.slice_codes = np.fromiter((name_codes.setdefault(h_name.get_match_name(slice, tp, launch_index), len(name_codes)) for slice in slices), dtype=np.int64, count=len(slices))
+    self.leaf_codes = np.fromiter((type_codes.setdefault(h_name.standardize_name(op['type']), len(type_codes)) for op in leaf_ops), dtype=np.int64, count=len(leaf_ops))
+    self.type_matches = np.zeros((len(type_codes), len(name_codes)), dtype=bool)
+    name_is_fused = np.zeros(len(name_codes), dtype=bool)
+    for type_code, compare_to in enumerate(type_codes):
+      for name_code, slice_name in enumerate(name_codes):
+        is_match, is_fused = h_name.match_name_to_type(slice_name, compare_to, is_backward, op_matcher)
+        self.type_matches[type_code, name_code] = bool(is_match)
+        name_is_fused[name_code] = bool(is_fused)
+    self.fused = name_is_fused[self.slice_codes]
+
+  def row(self, leaf_idx, start, end):
+    """Whether the leaf op matches each of slices[start:end]."""
+    return self.type_matches[self.leaf_codes[leaf_idx], self.slice_codes[start:end]]
+
+
+def align_leaf_ops(matches, leaf_count, slice_count, band=ALIGNMENT_BAND):
+  """Banded monotonic alignment of leaf ops to slices. Returns the index of the slice each leaf op is anchored to, -1 when it is not found.
+
+  This is a longest common subsequence between the leaf ops and the slices where a pair can be aligned when they match, plus a fused slice that was aligned to the previous leaf op can also be aligned to the next one. Only slices within band of the diagonal are considered for each leaf op, so the cost is O(leaf_count * band) with one vectorized step per leaf op.
+  """
+  unreachable = -(leaf_count + 1)
+  prev_lo, prev = 0, np.zeros(slice_count + 1, dtype=np.int64)  # no leaf ops align to nothing
+  moves = []
+  for leaf_idx in range(leaf_count):
+    center = (leaf_idx + 1) * slice_count // max(leaf_count, 1)
+    lo, hi = max(0, center - band), min(slice_count, center + band) + 1
+    j = np.arange(lo, hi)
+
+    def prev_at(idx):
+      # Past the end of the previous window the score stays the same, slices are skipped
+      return np.where(idx < prev_lo, unreachable, prev[np.clip(idx - prev_lo, 0, len(prev) - 1)])
+
+    up = prev_at(j)  # this leaf op is not found
+    diagonal = prev_at(j - 1)
+    row = np.zeros(len(j), dtype=bool)
+    row[j > 0] = matches.row(leaf_idx, max(lo - 1, 0), hi - 1)
+    fused = np.zeros(len(j), dtype=bool)
+    fused[j > 0] = matches.fused[max(lo - 1, 0):hi - 1]
+    match = np.where(row & (j > 0), diagonal + 1, unreachable)
+    fused_match = np.where(row & fused & (up > diagonal), up + 1, unreachable)  # slice j - 1 is already aligned to an earlier leaf op
+
+    # On ties prefer aligning over skipping the leaf op, and an earlier slice over a later one, so leaf ops are aligned to the first slices that match like infer_span() does
+    score = match
+    move = np.full(len(j), ALIGN_MATCH, dtype=np.int8)
+    for candidate, candidate_move in [(fused_match, ALIGN_FUSED), (up, ALIGN_UP)]:
+      better = candidate > score
+      score = np.where(better, candidate, score)
+      move[better] = candidate_move
+    best = np.maximum.accumulate(score)
+    move[1:][best[:-1] >= score[1:]] = ALIGN_LEFT
+    moves.append((lo, move))
+    prev_lo, prev = lo, best
+
+  anchors = np.full(leaf_count, -1, dtype=np.int64)
+  leaf_idx, slice_idx = leaf_count, slice_count
+  while leaf_idx > 0:
+    lo, move = moves[leaf_idx - 1]
+    if slice_idx >= lo + len(move):
+      slice_idx = lo + len(move) - 1  # skipped slices past the window
+      continue
+    step = move[slice_idx - lo]
+    if step == ALIGN_LEFT:
+      slice_idx -= 1
+    elif step == ALIGN_UP:
+      leaf_idx -= 1
+    else:
+      anchors[leaf_idx - 1] = slice_idx - 1
+      leaf_idx -= 1
+      if step == ALIGN_MATCH:
+        slice_idx -= 1
+  return anchors
+
+
+def spans_from_anchors(leaf_ops, slices, matches, anchors):
+  """The slices of each aligned leaf op, like infer_span() would give it: from the end of the previous span to its anchor, and on over following slices that also match unless the next leaf op has the same name. A fused anchor is shared with the next leaf op."""
+  spans = {}
+  aligned = np.flatnonzero(anchors >= 0).tolist()
+  start = 0
+  for idx, leaf_idx in enumerate(aligned):
+    anchor = int(anchors[leaf_idx])
+    op = leaf_ops[leaf_idx]
+    if matches.fused[anchor]:
+      slices[anchor]['possibly_is_fused'] = True
+      spans[id(op)] = [slice.copy() for slice in slices[start:anchor + 1]]  # copies, the fused slice is also in the next span
+      start = anchor
+      continue
+    next_anchor = int(anchors[aligned[idx + 1]]) if idx + 1 < len(aligned) else len(slices)
+    next_op = leaf_ops[leaf_idx + 1] if leaf_idx + 1 < len(leaf_ops) else None
+    end = anchor + 1
+    if not next_op_same_name(op, next_op):
+      also_matches = matches.row(leaf_idx, end, next_anchor)
+      end += len(also_matches) if np.all(also_matches) else int(np.argmin(also_matches))
+    spans[id(op)] = slices[start:end]
+    start = end
+  return spans
+
+
+def add_aligned_span(op, state, is_backward, tp, next_op):
+  """Used in place of infer_span() by the banded alignment engine, with the spans found beforehand."""
+  if 'ops' in op:
+    return h_slice.add_sub_op_slices_to_op(op, res_name=state['res_name'])
+  slices = state['spans'].get(id(op))
+  if not slices:
+    state['op_not_found_count'] += 1
     return
+  h_perfetto.add_slices(op, slices, tp, state.get('slice_table'))
+  state['op_found_count'] += 1
+  return True
+
+
+def detect_model_banded(model_ops, state, is_backward, tp):
+  """Alternative to detect_model_dfs() that aligns all leaf ops at once with align_leaf_ops() instead of scanning slices op by op."""
+  leaf_ops = leaf_op_sequence(model_ops, is_backward)
+  slices = state['slices']
+  matches = MatchMatrix(leaf_ops, slices, is_backward, tp, state.get('launch_index'), state.get('op_matcher'))
+  anchors = align_leaf_ops(matches, len(leaf_ops), len(slices), state.get('alignment_band', ALIGNMENT_BAND))
+  log.info(f'Aligned {int(np.sum(anchors >= 0))} of {len(leaf_ops)} leaf ops to {len(slices)} slices')
+  state['spans'] = spans_from_anchors(leaf_ops, slices, matches, anchors)
+  return detect_model_dfs(model_ops, state, is_backward, tp, span_fn=add_aligned_span)
+
 
+def model_detection_units(op, tp, slice_table=None):
+  """The resources of a model pass op to detect the model on and their slices, in order."""
+  units = []
   for res_name, res in op['resources'].items():
     if 'cpu' not in res_name:
       continue
@@ -243,27 +387,142 @@ def detect_model(op, model_ops, tp, parent_op=None, **kwargs):
     fw_slice = [slice for slice in slices if slice['name'] in ['DataParallel.forward', 'nn.Module: DataParallel']]
     if fw_slice:
       fw_slice = fw_slice[0]
-      slices = tp.query_dict(f'SELECT * FROM descendant_slice({fw_slice["id"]})')
+      if slice_table is not None:
+        # Same as below on rows, so only the slices at the min depth are made into dicts rather than every descendant
+        rows = slice_table.descendant_rows(slice_table.rows_for_ids([fw_slice['id']])[0])
+        rows = h_slice.remove_upper_depth_rows_if_only_one_slice(slice_table, rows)
+        units.append((res_name, slice_table.to_dicts(h_slice.get_rows_at_depth(slice_table, rows, 'minimum'))))
+        continue
+      slices = h_perfetto.get_descendant_slices(tp, [fw_slice['id']])[fw_slice['id']]
     slices =  h_slice.remove_upper_depths_if_only_one_slice(slices)
     slices =  h_slice.get_slices_at_depth(slices, 'minimum')
+    units.append((res_name, slices))
+  return units
 
-    log.info(f'Begin {op["is_model_pass"]} model detection for "{op["name"]}" on resource "{res_name}" with {len(slices)} slices at min depth.')
-    state = {}
-    state['slices'] = slices
-    state['slice_idx'] = 0
-    state['res_name'] = res_name
-    state['last_found_slice_idx'] = 0
-    state['op_found_count'] = 0
-    state['op_not_found_count'] = 0
-    state['last_found_was_fused'] = False
-    is_backward = True if op['is_model_pass'] == 'Backward' else False
-
-    model_ops = copy.deepcopy(model_ops)
+
+def detect_model_on_slices(op, model_ops, slices, res_name, tp, slice_table=None, launch_index=None, op_matcher=None, alignment_engine='greedy'):
+  """Match the model to the slices of one resource of a model pass op. Returns a copy of model_ops annotated with the slices, on top of any resources model_ops already has.
+
+  alignment_engine is 'greedy' for infer_span() or 'banded' for detect_model_banded().
+  """
+  model_ops = h_op.clone_op_tree(model_ops)
+  annotate_model_on_slices(op, model_ops, slices, res_name, tp, slice_table, launch_index, op_matcher, alignment_engine)
+  return model_ops
+
+
+def annotate_model_on_slices(op, model_ops, slices, res_name, tp, slice_table=None, launch_index=None, op_matcher=None, alignment_engine='greedy'):
+  """detect_model_on_slices() on model_ops itself rather than a copy."""
+  log.info(f'Begin {op["is_model_pass"]} model detection for "{op["name"]}" on resource "{res_name}" with {len(slices)} slices at min depth.')
+  state = {}
+  state['slices'] = slices
+  state['slice_idx'] = 0
+  state['res_name'] = res_name
+  state['last_found_slice_idx'] = 0
+  state['op_found_count'] = 0
+  state['op_not_found_count'] = 0
+  state['last_found_was_fused'] = False
+  state['slice_table'] = slice_table  # in-memory descendant lookups
+  state['launch_index'] = launch_index  # kernel names of cudaLaunchKernel slices without queries
+  state['op_matcher'] = op_matcher  # compiled name patterns of the model's op types
+  is_backward = True if op['is_model_pass'] == 'Backward' else False
+
+  if alignment_engine == 'banded':
+    detect_model_banded(model_ops, state, is_backward, tp)
+  elif alignment_engine == 'greedy':
     detect_model_dfs(model_ops, state, is_backward, tp)
-    op['ops'] = model_ops
+  else:
+    raise ValueError(f'Unknown alignment engine: {alignment_engine}')
+
+
+def set_detected_model(op, model_ops):
+  op['ops'] = model_ops
+
+  if op['is_model_pass'] == 'Backward':
+    # Reverse ops
+    op['ops'].reverse() # reverse top level op
+    h_tree.pre_order_depth_first(op, h_op.reverse_op) # reverse all child ops recursively
+    h_tree.pre_order_depth_first(op, mark_is_backward)
 
-    if is_backward:
-      # Reverse ops
-      op['ops'].reverse() # reverse top level op
-      h_tree.pre_order_depth_first(op, h_op.reverse_op) # reverse all child ops recursively
-      h_tree.pre_order_depth_first(op, mark_is_backward)
+
+def detect_model(op, model_ops, tp, parent_op=None, slice_table=None, launch_index=None, op_matcher=None, alignment_engine='greedy', **kwargs):
+  if 'is_model_pass' not in op:
+    return
+
+  units = model_detection_units(op, tp, slice_table)
+  if not units:
+    return
+  model_ops = h_op.clone_op_tree(model_ops)  # each pass annotates its own copy
+  for res_name, slices in units:
+    # Every resource is detected on the same copy, so the ops end up with the slices of every resource (ex. one CPU thread per GPU with DataParallel)
+    annotate_model_on_slices(op, model_ops, slices, res_name, tp, slice_table, launch_index, op_matcher, alignment_engine)
+  set_detected_model(op, model_ops)
+
+
+def merge_detected_resources(ops, other_ops):
+  """Add the resources of other_ops to the same ops of ops, which are annotated copies of the same model. Same result as detecting other_ops' resource on top of ops, since detection only touches the resource it runs on."""
+  for op, other_op in zip(ops, other_ops):
+    for res_name, res in other_op.get('resources', {}).items():
+      for list_name, values in res.items():
+        h_op.append_list_to_resource(op, res_name, list_name, values)
+    if 'ops' in op:
+      merge_detected_resources(op['ops'], other_op['ops'])
+  return ops
+
+
+# Set in each worker process by init_detect_model_worker()
+worker_context = {}
+
+
+def init_detect_model_worker(model_ops, slice_table, launch_index, op_matcher, alignment_engine='greedy'):
+  worker_context.update(model_ops=model_ops, slice_table=slice_table, launch_index=launch_index, op_matcher=op_matcher, alignment_engine=alignment_engine)
+
+
+def start_detect_model_workers(num_workers):
+  """Start the process pool of parallel_detect_model() before there is a model to detect, so the workers are forked before any thread starts, see h_util.start_process_pool(). share_detect_model_context() gives them the model once it exists."""
+  barrier = multiprocessing.get_context('fork').Barrier(num_workers)
+  return h_util.start_process_pool(num_workers, initializer=worker_context.update, initargs=({'barrier': barrier},))
+
+
+def receive_detect_model_context(*context):
+  init_detect_model_worker(*context)
+  worker_context['barrier'].wait()  # holds this worker until every worker has taken one of these tasks
+
+
+def share_detect_model_context(executor, num_workers, model_ops, slice_table, launch_index, op_matcher, alignment_engine='greedy'):
+  """Run init_detect_model_worker() in each worker of a pool from start_detect_model_workers()."""
+  futures = [executor.submit(receive_detect_model_context, model_ops, slice_table, launch_index, op_matcher, alignment_engine) for _ in range(num_workers)]
+  for future in futures:
+    future.result()
+
+
+def detect_model_worker(op, slices, res_name):
+  """Runs in a worker process, without a trace processor. Returns the annotated model ops and the op matcher verdicts made along the way."""
+  op_matcher = worker_context['op_matcher']
+  known_names = set(op_matcher.matches) if op_matcher else set()
+  model_ops = detect_model_on_slices(op, worker_context['model_ops'], slices, res_name, None, worker_context['slice_table'], worker_context['launch_index'], op_matcher, worker_context['alignment_engine'])
+  verdicts = {name: matches for name, matches in op_matcher.matches.items() if name not in known_names} if op_matcher else {}
+  return model_ops, verdicts
+
+
+def parallel_detect_model(top_op, model_ops, executor, tp, slice_table, launch_index, op_matcher=None):
+  """detect_model() on every model pass op, with each (pass, resource) run as a task in executor, a process pool made with init_detect_model_worker() or share_detect_model_context().
+
+  Workers have no trace processor, so slice_table and launch_index are required. Only the name of the op and the slices of the resource are sent to a worker, not the tree. Each resource of an op is detected on its own copy of the model and the copies are merged in resource order, the same result as detect_model() detecting each resource on top of the previous ones.
+  """
+  units = []
+  for op in h_tree.DepthFirstTreeIterator(top_op):
+    if 'is_model_pass' not in op:
+      continue
+    task_op = {'name': op['name'], 'is_model_pass': op['is_model_pass']}  # all that detect_model_on_slices() reads from op
+    futures = [executor.submit(detect_model_worker, task_op, slices, res_name) for res_name, slices in model_detection_units(op, tp, slice_table)]
+    if futures:
+      units.append((op, futures))
+
+  for op, futures in units:
+    detected_model_ops = None
+    for future in futures:
+      res_model_ops, verdicts = future.result()
+      if op_matcher:
+        op_matcher.matches.update(verdicts)
+      detected_model_ops = res_model_ops if detected_model_ops is None else merge_detected_resources(detected_model_ops, res_model_ops)
+    set_detected_model(op, detected_model_ops)
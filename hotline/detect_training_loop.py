@@ -4,6 +4,8 @@ import random, string
 import json
 from IPython import embed
 
+import numpy as np
+
 from hotline.hotline import *
 
 
@@ -187,32 +189,35 @@ def _detect_training_loop(high_level_ops, slices):
 
   return ops_detected
 
-def detect_training_loop(tp, annotations):
+def detect_training_loop(tp, annotations, slice_table=None, topology=None):
   # Get ProfileStep
   profile_step_slice, between_time_range = h_perfetto.get_profile_step_slice(tp)
 
   # Get primary tracks/timelines
-  primary_track_ids, on_primary_tracks = h_perfetto.track_ids_for_process_of_slice(tp, profile_step_slice)
+  primary_track_ids, on_primary_tracks = h_perfetto.track_ids_for_process_of_slice(tp, profile_step_slice, topology)
 
-  # Get slices in ProfilerStep across all threads of the primary cpu process
-  slices = tp.query_dict(f'SELECT * from slices WHERE {on_primary_tracks} AND {between_time_range}')
+  # Get slices in ProfilerStep across all threads of the primary cpu process. As columns because only the top level slices are kept, so dicts are only made for those.
+  columns = tp.query_columns(f'SELECT * from slices WHERE {on_primary_tracks} AND {between_time_range}')
 
   # Exclude the profile step because it is at an uninteresting depth we want to ignore
-  step_slice = slices.pop(0)
-  assert 'ProfilerStep' in step_slice['name']
-  h_slice._normalize_slice_depth(slices)
+  assert 'ProfilerStep' in columns['name'][0]
+  rows = np.arange(1, len(columns['name']))
+  depth = columns['depth'].astype(np.int64)
+  depth = depth - depth[rows].min()  # same as h_slice._normalize_slice_depth()
+  columns['depth'] = depth
+  track_ids = columns['track_id'].astype(np.int64)
 
   # Select slices at minimum depth (on a per track basis because the track that had ProfilerStep has a different minimum depth)
-  top_level_slices = []
+  top_level_rows = []
   for track_id in primary_track_ids:
-    track_slices = [slice for slice in slices if slice['track_id'] == track_id]
-    min_depth_track_slices = h_slice.get_slices_at_depth(track_slices, 'minimum')
-    assert(len(min_depth_track_slices))  # make sure the track is not empty
-    top_level_slices.extend(min_depth_track_slices)
-  slices = top_level_slices
+    track_rows = rows[track_ids[rows] == track_id]
+    assert(len(track_rows))  # make sure the track is not empty
+    top_level_rows.append(track_rows[depth[track_rows] == depth[track_rows].min()])
+  rows = np.concatenate(top_level_rows)
 
   # Sort slices so we can iterate through time
-  slices = sorted(slices, key=lambda d: d['ts'])
+  rows = rows[np.argsort(columns['ts'][rows], kind='stable')]
+  slices = h_perfetto.columns_to_dicts(columns, rows)
 
   # Detect high level sections
   detected_ops = _detect_training_loop(high_level_ops, slices)
@@ -250,8 +255,12 @@ def detect_training_loop(tp, annotations):
     time =  op['resources']['default_res']['time']
     start_ts = time['ts']
     end_ts = time['ts'] + time['dur']
-    within_high_level_section = f'ts BETWEEN {start_ts} AND {end_ts}'
-    sub_slices = tp.query_dict(f'SELECT * FROM slices WHERE {on_primary_tracks} AND {within_high_level_section};')
+    if slice_table is not None:
+      # Same as the query below, with binary searches instead of a query per section
+      sub_slices = slice_table.to_dicts(slice_table.intervals().starting_between(start_ts, end_ts, primary_track_ids))
+    else:
+      within_high_level_section = f'ts BETWEEN {start_ts} AND {end_ts}'
+      sub_slices = tp.query_dict(f'SELECT * FROM slices WHERE {on_primary_tracks} AND {within_high_level_section};')
     op['resources']['default_res']['slices'] = sub_slices
 
   return ops
@@ -23,8 +23,10 @@ import hotline.slice as h_slice  # needs to be second
 import hotline.op as h_op
 import hotline.time as h_time
 import hotline.name as h_name
-import hotline.read as h_read
 import hotline.util as h_util
+import hotline.read as h_read
+import hotline.table as h_table
+import hotline.cache as h_cache
 import hotline.tree as h_tree
 import hotline.print as h_print
 import hotline.write as h_write
@@ -96,6 +98,7 @@ class Hotline:
   """Identify backward pass operations using the model architecture as guide."""
   def __init__(self, trace_filepath, output_dir, ui_dir, torch_model, run_name, model_name, dataloader, metadata=None, backend='torch', test=False, num_gpus=None, test_accuracy=False, source_file_name=False, source_file_num=False):
     self.trace_filepath = trace_filepath
+    self.is_protobuf_trace = h_read.is_protobuf_trace(trace_filepath)  # Perfetto protobuf traces skip the JSON path
     self.output_dir = output_dir
     self.ui_traces_path = f'{ui_dir}/dist/traces/results/{run_name}'
     self.ui_model_path = f'{ui_dir}/src/results/{run_name}.js'
@@ -131,24 +134,98 @@ class Hotline:
     self.max_generated_depth = 2
     self.remove_slice_args = True # For speedup and disk space saving at cost of less information when opened with perfetto
     self.write_model_ops_to_file = True  # For testing only
+    self.ingest_workers = 1  # Processes used to decode the trace, set to os.cpu_count() to use every core on large traces
+    self.profiler_step_only = False  # Drop events outside of the ProfilerStep#N windows and processes at ingest, to speed up loading and save memory
+    self.compress_traces = False  # Write per-op traces as .json.gz to save disk space
+    self.cache_dir = os.environ.get('HOTLINE_CACHE_DIR')  # Reuse ingest results of the same trace across runs. Disabled when not set.
+    self.cache_max_size = h_cache.DEFAULT_MAX_SIZE
+    self.cache_key = None
+    self.alignment_engine = 'greedy'  # How detect_model aligns model ops to slices: 'greedy' scans slices op by op, 'banded' aligns all leaf ops at once in O(ops * band), see detect_model.align_leaf_ops()
+    self.detect_model_workers = 1  # Processes for detect_model, each detecting the model on one (pass, resource) at a time. Set to the number of GPUs to detect every GPU thread at once.
+    self.ingest_executor = None  # process pools, see start_worker_processes()
+    self.detect_model_executor = None
+    self.tp_replicas = 1  # Trace processors to load the trace with manual annotations into for test_accuracy(), which runs a query per op. More than 1 runs that many of those queries at once, at the cost of memory per trace processor.
+    self.tp_pool = h_perfetto.get_trace_processor_pool() if os.environ.get('HOTLINE_TP_POOL') else None  # Share trace processors between the analyses of this process, ex. batch re-analysis, so trace_processor_shell startup is paid once. The pool keeps shells and loaded traces alive between analyses. Disabled when not set, each analysis then closes its own.
 
 
   @decorator
   def load_trace_processor(self):
-      self.tp = h_perfetto.load_trace_processor(trace_bytes=self.slices_bytes)
+      if self.is_protobuf_trace:
+        self.tp = h_perfetto.load_trace_processor(trace_filepath=self.trace_filepath, pool=self.tp_pool, key=self.trace_processor_key())
+      else:
+        self.tp = h_perfetto.load_trace_processor(trace_bytes=self.slices_bytes, pool=self.tp_pool, key=self.trace_processor_key())
+
+
+  def close_trace_processors(self):
+      """Close the trace processors of this analysis, unless the pool keeps them loaded for the next one."""
+      for tp in [getattr(self, 'tp', None), getattr(self, 'tp_with_manual_annotations', None)]:
+        if tp is not None and not (self.tp_pool and self.tp_pool.holds(tp)):
+          tp.close()
+
+
+  def trace_processor_key(self):
+      """Key of the trace in the trace processor pool. The content hash of the cache is reused when there is one, otherwise the trace file isn't hashed just for the pool."""
+      if self.cache_key:
+        return self.cache_key
+      return h_perfetto.TraceProcessorPool.file_key(self.trace_filepath, remove_slice_args=self.remove_slice_args, profiler_step_only=self.profiler_step_only)
 
 
   @decorator
-  def create_perfetto_indexes(self):
-      self.slice_index = h_perfetto.create_slice_index(self.tp)
-      self.flow_index = h_perfetto.create_flow_index(self.tp)
-      self.track_index, self.thread_index, self.process_index = h_perfetto.create_track_indexes(self.tp)
+  def create_perfetto_indexes(self, tp_loaded=None):
+      """tp_loaded is a future of load_trace_processor() to wait for. The indexes are rebuilt from the cache without the trace processor."""
+      cached = self.load_from_cache('perfetto_indexes')
+      if cached:
+        self.slice_table, self.flow_index, self.track_index, self.thread_index, self.process_index = cached
+      else:
+        if tp_loaded:
+          tp_loaded.result()
+        self.slice_table = h_perfetto.create_slice_table(self.tp)
+        self.flow_index = h_perfetto.create_flow_index(self.tp)
+        self.track_index, self.thread_index, self.process_index = h_perfetto.create_track_indexes(self.tp)
+        self.save_to_cache('perfetto_indexes', (self.slice_table, self.flow_index, self.track_index, self.thread_index, self.process_index))
+      self.slice_index = h_perfetto.create_slice_index(self.tp, self.slice_table)
+      self.slice_table.build_children_index()  # for descendant lookups without SQL
+      self.launch_index = h_perfetto.create_launch_index(self.slice_table, self.slice_index, self.flow_index)
+      self.topology = h_perfetto.create_track_topology(self.track_index, self.slice_table, self.flow_index)
+      if self.raw_slice_count is None:
+        self.raw_slice_count = len(self.slice_table)  # protobuf trace
 
 
   @decorator
   def load_raw_trace(self):
       """This must execute before load_trace_processor() so that convert_ids_int_string will run to fix a weird bug."""
-      self.raw_slices, self.raw_slice_index, self.slices_bytes = h_read.load_raw_trace(self.trace_filepath, remove_slice_args=self.remove_slice_args)
+      if self.is_protobuf_trace:
+        # The trace processor reads protobuf traces itself. There are no raw JSON events, per-op traces are rebuilt from slices by h_write.write_trace().
+        self.raw_slice_count, self.raw_slice_index, self.slices_bytes = None, None, None
+        return
+      cached = self.load_from_cache('raw_trace')
+      slices_bytes = cached and h_cache.open_file(self.cache_dir, self.cache_key, 'slices.json')  # kept on disk, not pickled
+      if slices_bytes:
+        self.raw_slice_count, self.raw_slice_index = cached
+        self.slices_bytes = slices_bytes
+      else:
+        self.raw_slice_count, self.raw_slice_index, self.slices_bytes = h_read.load_raw_trace(self.trace_filepath, remove_slice_args=self.remove_slice_args, profiler_step_only=self.profiler_step_only, num_workers=self.ingest_workers, executor=self.ingest_executor)
+        if self.cache_key:
+          h_cache.save_file(self.cache_dir, self.cache_key, 'slices.json', self.slices_bytes, max_size=self.cache_max_size)
+        self.save_to_cache('raw_trace', (self.raw_slice_count, self.raw_slice_index))
+
+
+  @decorator
+  def create_cache_key(self):
+    if self.cache_dir:
+      self.cache_key = h_cache.trace_key(self.trace_filepath, remove_slice_args=self.remove_slice_args, profiler_step_only=self.profiler_step_only)
+
+
+  def load_from_cache(self, name):
+    if not self.cache_key:
+      return None
+    return h_cache.load(self.cache_dir, self.cache_key, name)
+
+
+  def save_to_cache(self, name, obj):
+    if not self.cache_key:
+      return
+    h_cache.save(self.cache_dir, self.cache_key, name, obj, max_size=self.cache_max_size)
 
 
   @decorator
@@ -157,7 +234,12 @@ class Hotline:
       self.model_ops = self.torch_model
 
     else:
-      self.model_ops, self.stats_str = h_torch.convert_model_to_heirachical_dict(self.torch_model, self.device, self.dataloader)
+      cached = self.load_from_cache(f'model_ops_{self.model_name}')
+      if cached:
+        self.model_ops, self.stats_str = cached
+      else:
+        self.model_ops, self.stats_str = h_torch.convert_model_to_heirachical_dict(self.torch_model, self.device, self.dataloader)
+        self.save_to_cache(f'model_ops_{self.model_name}', (self.model_ops, self.stats_str))
       # h_tree.post_order_depth_first(self.model_ops[0], detect_model.remove_repeating_ops)
 
       if self.write_model_ops_to_file:
@@ -209,7 +291,7 @@ class Hotline:
   def detect_training_loop(self):
     # These annotations will be used later to set the filename and lineinfo on the training loop ops
     annotations = hotline.annotate.outer.top_op['ops']
-    self.training_loop_ops = detect_training_loop.detect_training_loop(self.tp, annotations)
+    self.training_loop_ops = detect_training_loop.detect_training_loop(self.tp, annotations, self.slice_table, self.topology)
 
 
   @decorator
@@ -229,7 +311,7 @@ class Hotline:
 
     # Add additional interesting values
     self.top_op['trace_disk_size'] = humanize.naturalsize(os.stat(self.trace_filepath).st_size)
-    self.top_op['trace_event_count'] = humanize.intcomma(len(self.raw_slices))
+    self.top_op['trace_event_count'] = humanize.intcomma(self.raw_slice_count)
     self.top_op['pytorch_version'] = torch.__version__
     self.top_op['gpu_model'] = torch.cuda.get_device_name(0)
     self.top_op['gpu_cuda_version'] = torch.version.cuda
@@ -301,8 +383,8 @@ class Hotline:
     if not os.path.exists(self.ui_traces_path):
       log.info(f'Creating directory: {self.ui_traces_path}')
       os.makedirs(self.ui_traces_path)
-    slices_bytes = getattr(self, 'slices_bytes_with_manual_annotations', self.slices_bytes)
-    h_tree.pre_order_depth_first(self.top_op, h_write.write_trace, self.ui_traces_path, self.run_name, self.raw_slice_index, slices_bytes, self.track_index)
+    top_slices_bytes = getattr(self, 'slices_bytes_with_manual_annotations', None)
+    h_tree.pre_order_depth_first(self.top_op, h_write.write_trace, self.ui_traces_path, self.run_name, self.raw_slice_index, self.slices_bytes, self.track_index, compress=self.compress_traces, trace_filepath=self.trace_filepath, top_slices_bytes=top_slices_bytes)
 
   @decorator
   def write_source_codes(self):
@@ -398,15 +480,21 @@ class Hotline:
 
   @decorator
   def detect_model(self):
-    multithread = False
-    if multithread:
-      with concurrent.futures.ThreadPoolExecutor(max_workers=self.num_gpus*2) as self.executor:
-        results = h_tree.parallel_pre_order_depth_first(self.top_op, detect_model.detect_model, self.executor, self.model_ops, self.tp)
-        for result in results:
-          if isinstance(result, concurrent.futures.Future):
-            result.result()
+    op_matcher = h_name.OpMatcher.from_model_ops(self.model_ops)  # shared by every resource and pass
+    op_matcher_key = f'op_matcher_{op_matcher.patterns_key()}'  # an entry of its own, shared by every trace of models with these op types
+    if self.cache_dir:
+      op_matcher.load_verdicts(h_cache.load(self.cache_dir, op_matcher_key, 'verdicts'))
+    if self.detect_model_workers > 1:
+      # The slice table, launch index and model are given to each worker once, only the slices of each (pass, resource) are sent per task
+      with self.detect_model_executor or detect_model.start_detect_model_workers(self.detect_model_workers) as executor:
+        detect_model.share_detect_model_context(executor, self.detect_model_workers, self.model_ops, self.slice_table, self.launch_index, op_matcher, self.alignment_engine)
+        detect_model.parallel_detect_model(self.top_op, self.model_ops, executor, self.tp, self.slice_table, self.launch_index, op_matcher)
+      self.detect_model_executor = None
     else:
-      results = h_tree.pre_order_depth_first(self.top_op, detect_model.detect_model, self.model_ops, self.tp)
+      results = h_tree.pre_order_depth_first(self.top_op, detect_model.detect_model, self.model_ops, self.tp, slice_table=self.slice_table, launch_index=self.launch_index, op_matcher=op_matcher, alignment_engine=self.alignment_engine)
+    log.info(f'Op matcher verdicts: {op_matcher.stats()}')
+    if self.cache_dir:
+      h_cache.save(self.cache_dir, op_matcher_key, 'verdicts', op_matcher.dump_verdicts(), max_size=self.cache_max_size)  # for the next run of these op types
 
 
   @decorator
@@ -518,15 +606,28 @@ class Hotline:
   def test_accuracy_setup(self):
     if not self.is_test_accuracy:
       return
+    if self.is_protobuf_trace:
+      log.warning('Accuracy testing needs manual annotations to be removed from a JSON trace, skipping it for protobuf trace.')
+      self.is_test_accuracy = False
+      return
 
     # Load the trace with manual annotations in perfetto
-    raw_slices, raw_slice_index, slices_bytes = h_read.load_raw_trace(self.trace_filepath, remove_slice_args=self.remove_slice_args)
-    self.tp_with_manual_annotations = h_perfetto.load_trace_processor(trace_bytes=slices_bytes)
+    _, _, slices_bytes = h_read.load_raw_trace(self.trace_filepath, remove_slice_args=self.remove_slice_args, profiler_step_only=self.profiler_step_only, num_workers=self.ingest_workers, executor=self.ingest_executor)
+    if self.tp_replicas > 1:
+      self.tp_with_manual_annotations = h_perfetto.load_trace_processor_replicas(self.tp_replicas, trace_bytes=slices_bytes)
+    else:
+      self.tp_with_manual_annotations = h_perfetto.load_trace_processor(trace_bytes=slices_bytes, pool=self.tp_pool, key=self.trace_processor_key())  # keyed before the manual annotations are removed from the file below
     self.flow_index_with_manual_annotations = h_perfetto.create_flow_index(self.tp_with_manual_annotations)
+    self.slice_table_with_manual_annotations = h_perfetto.create_slice_table(self.tp_with_manual_annotations)
+    track_index_with_manual_annotations, _, _ = h_perfetto.create_track_indexes(self.tp_with_manual_annotations)
+    self.topology_with_manual_annotations = h_perfetto.create_track_topology(track_index_with_manual_annotations, self.slice_table_with_manual_annotations, self.flow_index_with_manual_annotations)
     self.slices_bytes_with_manual_annotations = slices_bytes
 
     # Make a copy of trace with manual annotations
     manual_trace_path = self.trace_filepath + 'with_manual_annotations.json'
+    trace_filepath_root, compression_ext = os.path.splitext(self.trace_filepath)
+    if compression_ext in ['.gz', '.zst']:
+      manual_trace_path = trace_filepath_root + 'with_manual_annotations.json' + compression_ext  # keep the compression extension so the copy can still be read
     log.info('Saved trace with manual annotations to: ' + manual_trace_path)
     shutil.copyfile(self.trace_filepath, manual_trace_path)
 
@@ -544,9 +645,47 @@ class Hotline:
     if not self.is_test_accuracy:
       return
 
+    if self.tp_replicas > 1 and self.idx_to_op_map:
+      h_annotate.prefetch_manual_annotations(self.tp_with_manual_annotations, range(max(self.idx_to_op_map.keys()) + 1), self.tp_replicas)
+
     h_accuracy.print_manual_to_detected_mapping_table(self.tp_with_manual_annotations, self.idx_to_op_map)
 
-    self.top_op['total_accuracy_str'] = h_accuracy.test_accuracy(self.tp_with_manual_annotations, self.idx_to_op_map, self.flow_index_with_manual_annotations, self.metadata)
+    self.top_op['total_accuracy_str'] = h_accuracy.test_accuracy(self.tp_with_manual_annotations, self.idx_to_op_map, self.flow_index_with_manual_annotations, self.metadata, self.slice_table_with_manual_annotations, self.topology_with_manual_annotations)
+
+
+  def setup(self):
+    """Run the setup steps as a dependency graph so that independent steps overlap.
+
+    The trace processor ingests the trace in its own process and the model is converted by torch, so both run on threads while this thread reads the raw trace and builds the perfetto indexes. Each step only waits for the steps it uses.
+    """
+    h_name.reset_name_table()  # names are kept per analysis
+    self.start_worker_processes()  # before any thread below starts
+    if self.tp_pool:
+      self.tp_pool.fill()  # start trace processors in the background while the trace is read
+    self.test_accuracy_setup()  # edits the trace file, so must finish before anything reads it
+    self.create_cache_key()  # used to look up every cached step
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix='setup') as executor:
+      model_converted = executor.submit(self.convert_model_to_heirachical_dict)  # independent of the trace
+      if self.is_protobuf_trace:
+        tp_loaded = executor.submit(self.load_trace_processor)  # reads the trace file itself
+        self.load_raw_trace()
+      else:
+        self.load_raw_trace()
+        tp_loaded = executor.submit(self.load_trace_processor)  # needs the events from load_raw_trace()
+      self.create_perfetto_indexes(tp_loaded)
+      tp_loaded.result()
+      model_converted.result()
+    if self.ingest_executor:
+      self.ingest_executor.shutdown()
+      self.ingest_executor = None
+
+
+  def start_worker_processes(self):
+    """Fork the process pools of this analysis up front, see h_util.start_process_pool(). Setup overlaps its steps on threads, and the trace processor pool spawns shells on threads."""
+    if self.ingest_workers > 1 and not self.is_protobuf_trace:
+      self.ingest_executor = h_util.start_process_pool(self.ingest_workers)
+    if self.detect_model_workers > 1:
+      self.detect_model_executor = detect_model.start_detect_model_workers(self.detect_model_workers)
 
 
   def analyze(self):
@@ -554,11 +693,7 @@ class Hotline:
     log.info(f'Begin analyzing: {self.trace_filepath}')
 
     # Setup
-    self.test_accuracy_setup()
-    self.load_raw_trace()
-    self.load_trace_processor()
-    self.create_perfetto_indexes()
-    self.convert_model_to_heirachical_dict()
+    self.setup()
     # self.create_model_from_annotations()  # creates self.model_ops
 
     # Annotation
@@ -600,4 +735,8 @@ class Hotline:
     self.add_interesting_info_to_ops()
     self.write_hierarchical_model()
     self.results_summary()
+    log.info(f'Query cache: {self.tp.query_cache.stats()}')
+    if self.tp_pool:
+      log.info(f'Trace processor pool: {self.tp_pool.stats}')
+    self.close_trace_processors()
     log.info(f'Run {self.run_name}, model {self.model_name}, done.')
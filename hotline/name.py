@@ -1,4 +1,8 @@
 import re
+import json
+import hashlib
+import threading
+import collections
 
 from IPython import embed
 
@@ -14,7 +18,70 @@ def shorten_name(name, length=29):
   return name
 
 
+class NameTable:
+  """Dictionary of the unique slice names of one analysis.
+
+  Every unique name gets a small integer id and is stored once, so slices with the same name share one string. Anything derived from a name (renamed, standardized, matched) is computed once per unique name with derive() instead of once per slice. A new table is started for each analysis with reset_name_table(), so a long-lived process doesn't keep the names of every trace it has seen.
+  """
+  def __init__(self):
+    self.names = []
+    self.ids = {}
+    self.derived = {}  # derive function -> {name: derived value}
+    self.lock = threading.Lock()  # for names added from query threads
+
+  def intern(self, name):
+    """Return the id of name, adding it to the table if it's new."""
+    name_id = self.ids.get(name)
+    if name_id is None:
+      with self.lock:
+        name_id = self.ids.get(name)
+        if name_id is None:
+          name_id = len(self.names)
+          self.names.append(name)
+          self.ids[name] = name_id
+    return name_id
+
+  def name(self, name_id):
+    return self.names[name_id]
+
+  def derive(self, fn, name):
+    """Return fn(name), only calling fn the first time a name is seen."""
+    cache = self.derived.setdefault(fn, {})
+    try:
+      return cache[name]
+    except KeyError:
+      value = cache[name] = fn(name)
+      return value
+
+
+name_table = NameTable()
+
+
+def reset_name_table():
+  """Start an empty name table, see NameTable."""
+  global name_table
+  name_table = NameTable()
+
+
+def intern_names(names):
+  """The shared string in name_table of each name."""
+  return [name_table.names[name_table.intern(name)] for name in names]
+
+
+def intern_slice_names(slices):
+  """Point the name of each slice to the one shared string in name_table."""
+  for slice in slices:
+    name = slice.get('name')
+    if name is not None:
+      slice['name'] = name_table.names[name_table.intern(name)]
+  return slices
+
+
 def rename_slice(name):
+  return name_table.derive(_rename_slice, name)
+
+
+def _rename_slice(name):
   rules = [
     {
       'match_pattern': re.compile('\(\d+\): '), # Match examples: '(188): ', '(1): ,'
@@ -243,11 +310,12 @@ def calc_predominant_name(slices, minimum_depth=True):
 
 
 def match(word, compare_to_list):
+  word = name_table.derive(str.lower, word)
   for compare_to in compare_to_list:
     if isinstance(compare_to, re.Pattern):
-      is_match = re.search(compare_to, word.lower())
+      is_match = re.search(compare_to, word)
     elif isinstance(compare_to, str):
-      is_match = compare_to.lower() in word.lower()
+      is_match = compare_to.lower() in word
     if is_match:
       return compare_to  # return the matched string/pattern
   return False
@@ -285,6 +353,10 @@ def add_pretty_name(op, **kwargs):
 
 
 def standardize_name(name):
+  return name_table.derive(_standardize_name, name)
+
+
+def _standardize_name(name):
   name = name.lower()
   remove_list = ['1d', '2d', '3d', '_']
   for remove in remove_list:
@@ -292,18 +364,19 @@ def standardize_name(name):
   return name
 
 
-def fuzzy_op_match(slice, op, is_backward, tp):
-  """Decide whether the current slice matches the target op.
+fused_names = [  # also see fused.py
+  re.compile('cudnn.*x.*relu'),  # Example conv+relu fused kernel found in ResNet50 forward: volta_scudnn_winograd_128x128_ldg1_ldg4_relu_tile148t_nt_v1
+  re.compile('cat.*dog'),  # for tests
+  re.compile('fish.*turtle'),  # for tests
+]
+
+
+def match_fused_name(name):
+  return match(name, fused_names)
 
-  Args:
-    slice: perfetto slice format
-    op: pytorch module op format
-  """
-  # Clean up names to be more matching
-  slice_name = standardize_name(slice['name'])
-  compare_to = standardize_name(op['type'])
 
-  # Remap names to known matches
+def get_op_name_map(is_backward):
+  """Remap names to known matches."""
   op_name_map = {
     # formatting of this dict:
     #   'lowercase type in pytorch model def': 'name in trace',
@@ -336,27 +409,193 @@ def fuzzy_op_match(slice, op, is_backward, tp):
     op_name_map['lstm'] = ['void at::native::reduce_kernel<128, 4, at::native::ReduceOp<float, at::native::func_wrapper_t<float, at::native::sum_functor<float, float, float>::operator()(at::TensorIterator&)::{lambda(float, float)#1}>, unsigned int, float, 4> >(at::native::ReduceOp<float, at::native::func_wrapper_t<float, at::native::sum_functor<float, float, float>::operator()(at::TensorIterator&)::{lambda(float, float)#1}>, unsigned int, float, 4>)']  # check is this needed? probably not
   else:
     op_name_map['lstm'] = ['rnn']
+  return op_name_map
 
+
+def get_compare_to_list(compare_to, is_backward):
+  """Patterns that match slices of a standardized op type, in the order they are tried."""
+  op_name_map = get_op_name_map(is_backward)
   if compare_to.lower() in op_name_map:
-    compare_to_list = op_name_map[compare_to] + [compare_to.lower()]
+    return op_name_map[compare_to] + [compare_to.lower()]
+  return [compare_to]
+
+
+class AhoCorasick:
+  """Finds which of many substrings occur in a string in one pass over the string."""
+  def __init__(self, words):
+    self.goto = [{}]
+    self.fail = [0]
+    self.output = [set()]
+    for word in words:
+      state = 0
+      for char in word:
+        if char not in self.goto[state]:
+          self.goto.append({})
+          self.fail.append(0)
+          self.output.append(set())
+          self.goto[state][char] = len(self.goto) - 1
+        state = self.goto[state][char]
+      self.output[state].add(word)
+
+    # Breadth first so the fail link of a state's parent is set before its own
+    queue = collections.deque(self.goto[0].values())
+    while queue:
+      state = queue.popleft()
+      for char, next_state in self.goto[state].items():
+        queue.append(next_state)
+        fail = self.fail[state]
+        while fail and char not in self.goto[fail]:
+          fail = self.fail[fail]
+        self.fail[next_state] = self.goto[fail].get(char, 0)
+        self.output[next_state] |= self.output[self.fail[next_state]]
+
+  def find_all(self, text):
+    found = set(self.output[0])  # the empty string, if it is a word
+    state = 0
+    for char in text:
+      while state and char not in self.goto[state]:
+        state = self.fail[state]
+      state = self.goto[state].get(char, 0)
+      found |= self.output[state]
+    return found
+
+
+OP_MATCHER_VERSION = 1  # Bump when matching changes in a way the patterns don't show, so saved verdicts are not loaded
+
+
+class OpMatcher:
+  """The patterns of fuzzy_op_match() compiled once for the op types of a model.
+
+  Substrings of every op type are found with one AhoCorasick pass over a slice name and each regex runs once, so the first time a name is seen it is matched against every op type at once. The verdicts for that name are cached, so after that matching a slice to an op is a dict lookup. One matcher is shared by every resource and model pass of an analysis and its verdicts can be saved for the next run of the same model.
+  """
+  def __init__(self, op_types):
+    self.patterns = {}  # (standardized op type, is_backward) -> patterns in the order they are tried
+    for op_type in set(op_types):
+      compare_to = standardize_name(op_type)
+      for is_backward in [False, True]:
+        self.patterns[(compare_to, is_backward)] = get_compare_to_list(compare_to, is_backward)
+    all_patterns = [pattern for patterns in self.patterns.values() for pattern in patterns] + fused_names
+    self.automaton = AhoCorasick({pattern.lower() for pattern in all_patterns if isinstance(pattern, str)})
+    self.regexes = list(dict.fromkeys(pattern for pattern in all_patterns if isinstance(pattern, re.Pattern)))
+    self.matches = {}  # slice name -> ({(op type, is_backward): matched pattern}, matched fused pattern)
+    self.hits = 0
+    self.misses = 0
+
+  @classmethod
+  def from_model_ops(cls, model_ops):
+    op_types = []
+    def collect(ops):
+      for op in ops:
+        op_types.append(op['type'])
+        collect(op.get('ops', []))
+    collect(model_ops)
+    return cls(op_types)
+
+  def compile_name(self, slice_name):
+    word = slice_name.lower()
+    found = self.automaton.find_all(word)
+    found.update(regex for regex in self.regexes if re.search(regex, word))
+    def first_found(patterns):
+      return next((pattern for pattern in patterns if (pattern.lower() if isinstance(pattern, str) else pattern) in found), False)
+    matched_types = {key: first_found(patterns) for key, patterns in self.patterns.items()}
+    return {key: pattern for key, pattern in matched_types.items() if pattern is not False}, first_found(fused_names)
+
+  def match(self, slice_name, compare_to, is_backward):
+    """Same as (match(slice_name, compare_to_list), match_fused_name(slice_name)) in fuzzy_op_match()."""
+    matches = self.matches.get(slice_name)
+    if matches is None:
+      self.misses += 1
+      matches = self.matches[slice_name] = self.compile_name(slice_name)
+    else:
+      self.hits += 1
+    matched_types, is_fused = matches
+    key = (compare_to, is_backward)
+    if key not in self.patterns:
+      return match(slice_name, get_compare_to_list(compare_to, is_backward)), is_fused  # op type the matcher wasn't built with
+    return matched_types.get(key, False), is_fused
+
+
+  def stats(self):
+    return {'hits': self.hits, 'misses': self.misses, 'size': len(self.matches)}
+
+  def patterns_key(self):
+    """Changes whenever the patterns change, so that verdicts saved with other patterns are not loaded."""
+    patterns = sorted((repr(key), [self.pattern_ref(pattern) for pattern in patterns]) for key, patterns in self.patterns.items())
+    fused = [self.pattern_ref(pattern) for pattern in fused_names]
+    return hashlib.blake2b(json.dumps([OP_MATCHER_VERSION, patterns, fused]).encode(), digest_size=16).hexdigest()
+
+  @staticmethod
+  def pattern_ref(pattern):
+    if pattern is False:
+      return None
+    if isinstance(pattern, re.Pattern):
+      return ['re', pattern.pattern]
+    return ['str', pattern]
+
+  def dump_verdicts(self):
+    """The verdicts of every name seen so far, to store with h_cache for the next run of the same op types."""
+    matches = {
+      name: [[[op_type, is_backward, self.pattern_ref(pattern)] for (op_type, is_backward), pattern in matched_types.items()], self.pattern_ref(is_fused)]
+      for name, (matched_types, is_fused) in self.matches.items()
+    }
+    return {'version': OP_MATCHER_VERSION, 'patterns_key': self.patterns_key(), 'matches': matches}
+
+  def load_verdicts(self, saved):
+    """Add the verdicts of dump_verdicts(), unless they were made with different patterns. Returns whether they were loaded."""
+    if not saved:
+      return False
+    if saved.get('version') != OP_MATCHER_VERSION or saved.get('patterns_key') != self.patterns_key():
+      log.info('Ignoring op matcher verdicts made with other patterns.')
+      return False
+    # Point back to this matcher's pattern objects
+    patterns = {json.dumps(self.pattern_ref(pattern)): pattern for patterns in self.patterns.values() for pattern in patterns}
+    patterns.update({json.dumps(self.pattern_ref(pattern)): pattern for pattern in fused_names})
+    patterns['null'] = False
+    for name, (matched_types, is_fused) in saved['matches'].items():
+      self.matches[name] = (
+        {(op_type, is_backward): patterns[json.dumps(ref)] for op_type, is_backward, ref in matched_types},
+        patterns[json.dumps(is_fused)],
+      )
+    log.info(f'Loaded {len(saved["matches"])} op matcher verdicts.')
+    return True
+
+
+def get_match_name(slice, tp, launch_index=None):
+  """The name of a slice that op types are compared to: its standardized name, or the name of the launched kernel for a cudaLaunchKernel."""
+  if slice['name'] != 'cudaLaunchKernel':
+    return standardize_name(slice['name'])
+  launch_slice_id = slice["slice_id"]
+  if launch_index is not None:
+    kernel_slice = launch_index[launch_slice_id]
   else:
-    compare_to_list = [compare_to]
-
-  # If current is a cudaLaunchKernel, compare the target to the name of the launched kernel
-  if slice['name'] == 'cudaLaunchKernel':
-    launch_slice_id = slice["slice_id"]
-    flow_slice = tp.query_dict(f'SELECT * FROM DIRECTLY_CONNECTED_FLOW({launch_slice_id});')[0]
-    kernel_slice = tp.query_dict(f'SELECT * FROM slice WHERE id = {flow_slice["slice_in"]};')[0]
-    slice_name = kernel_slice['name'].lower()
-
-  fused_names = [  # also see fused.py
-    re.compile('cudnn.*x.*relu'),  # Example conv+relu fused kernel found in ResNet50 forward: volta_scudnn_winograd_128x128_ldg1_ldg4_relu_tile148t_nt_v1
-    re.compile('cat.*dog'),  # for tests
-    re.compile('fish.*turtle'),  # for tests
-  ]
-  is_fused = match(slice_name, fused_names)
+    flow_slice = tp.query_dict_cached(f'SELECT * FROM DIRECTLY_CONNECTED_FLOW({launch_slice_id});')[0]
+    kernel_slice = tp.query_dict_cached(f'SELECT * FROM slice WHERE id = {flow_slice["slice_in"]};')[0]
+  return name_table.derive(str.lower, kernel_slice['name'])
+
+
+def match_name_to_type(slice_name, compare_to, is_backward, op_matcher=None):
+  """(matched pattern or False, matched fused pattern or False) for a name from get_match_name() and a standardized op type."""
+  if op_matcher is not None:
+    return op_matcher.match(slice_name, compare_to, is_backward)
+  is_fused = name_table.derive(match_fused_name, slice_name)
+  is_match = match(slice_name, get_compare_to_list(compare_to, is_backward))
+  return is_match, is_fused
+
+
+def fuzzy_op_match(slice, op, is_backward, tp, launch_index=None, op_matcher=None):
+  """Decide whether the current slice matches the target op.
+
+  Args:
+    slice: perfetto slice format
+    op: pytorch module op format
+    launch_index: launch slice id to kernel slice, see h_perfetto.create_launch_index(). Queried from tp when not given.
+    op_matcher: OpMatcher with the patterns of the model's op types precompiled.
+  """
+  # Clean up names to be more matching. If current is a cudaLaunchKernel, compare the target to the name of the launched kernel
+  slice_name = get_match_name(slice, tp, launch_index)
+  compare_to = standardize_name(op['type'])
 
-  is_match = match(slice_name, compare_to_list)
+  is_match, is_fused = match_name_to_type(slice_name, compare_to, is_backward, op_matcher)
   if is_match and is_fused:
     slice['possibly_is_fused'] = True  # A fused kernel may or may not be utilized for all it's affordances. There may be a conv_relu where the relu isn't present in the pytorch model and the relu is not applied.
     log.debug(f'FUSED FOUND: {slice_name} <-> {is_fused}')
@@ -9,6 +9,33 @@ import hotline.name as h_name
 import hotline.util as h_util
 import hotline.slice as h_slice
 
+def clone_op_tree(ops, memo=None):
+  """Same result as copy.deepcopy(ops) for a list of ops and their child ops, at a fraction of the cost.
+
+  Each op dict is copied so it can be annotated on its own (resources, times, flags), while the immutable values that make up the model structure (names, types) are shared with the original. Any other value, such as existing resources, is still deep copied. One deepcopy memo is used for the whole tree, so objects shared by several ops, like the slices a parent op gets from its child ops, are still shared in the clone.
+  """
+  memo = {} if memo is None else memo
+  if id(ops) in memo:
+    return memo[id(ops)]
+  clone = memo[id(ops)] = []
+  clone.extend(clone_op(op, memo) for op in ops)
+  return clone
+
+
+def clone_op(op, memo):
+  if id(op) in memo:
+    return memo[id(op)]
+  clone = memo[id(op)] = {}
+  for key, value in op.items():
+    if key == 'ops' and isinstance(value, list):
+      clone[key] = clone_op_tree(value, memo)
+    elif value is None or isinstance(value, (str, int, float)):
+      clone[key] = value
+    else:
+      clone[key] = copy.deepcopy(value, memo)
+  return clone
+
+
 def get_unique_resource_names(ops):
   uniq_res_names = set()
   for op in ops:
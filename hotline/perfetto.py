@@ -1,4 +1,15 @@
+import os
+import queue
+import atexit
+import contextlib
+import hashlib
+import threading
 import traceback
+import collections
+import concurrent.futures
+
+import numpy as np
+import pandas as pd
 
 from perfetto.trace_processor import TraceProcessor
 
@@ -26,38 +37,382 @@ from hotline.hotline import *
 #   'slice_id': 459
 # }
 
-interesting_fields = 'SELECT ts, dur, track_id, category, name, depth, cat, slice_id, id FROM slice'
+slice_fields = ['ts', 'dur', 'track_id', 'category', 'name', 'depth', 'cat', 'slice_id', 'id', 'parent_id']
+interesting_fields = f'SELECT {", ".join(slice_fields)} FROM slice'
+DESCENDANT_BATCH_SIZE = 5000  # root slice ids per query
+
+
+QUERY_CACHE_SIZE = 4096  # query results kept per trace processor
+
 
+class QueryCache:
+  """LRU cache in front of query_dict for queries that repeat within one analysis.
 
-def load_trace_processor(trace_filepath=None, trace_bytes=None):
-  input_trace = trace_bytes or trace_filepath
+  Queries are keyed by their normalized SQL (case and whitespace don't matter). Results are copied on the way out because callers edit the returned slice dicts.
+  """
+  def __init__(self, query_dict, max_size=QUERY_CACHE_SIZE):
+    self.query_dict = query_dict
+    self.max_size = max_size
+    self.results = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    self.lock = threading.Lock()  # shared by query threads with TraceProcessorReplicas
+
+  @staticmethod
+  def normalize(query):
+    return ' '.join(query.lower().split()).rstrip(';').strip()
+
+  def __call__(self, query):
+    key = self.normalize(query)
+    with self.lock:
+      rows = self.results.get(key)
+      if rows is not None:
+        self.hits += 1
+        self.results.move_to_end(key)
+    if rows is None:
+      rows = self.query_dict(query)  # not under the lock so that other queries can run meanwhile
+      with self.lock:
+        self.misses += 1
+        self.results[key] = rows
+        if len(self.results) > self.max_size:
+          self.results.popitem(last=False)  # least recently used
+    return [dict(row) for row in rows]
+
+  def clear(self):
+    self.results.clear()
+
+  def stats(self):
+    return {'hits': self.hits, 'misses': self.misses, 'size': len(self.results)}
+
+
+def spawn_trace_processor():
+  """Start a trace_processor_shell with no trace loaded yet."""
   try:
-    tp = TraceProcessor(input_trace)
+    return TraceProcessor()
   except ConnectionResetError as e:
     # This happens sometimes so retry once
-    tp = TraceProcessor(input_trace)
+    return TraceProcessor()
 
-  def query_dict(query):
+
+@contextlib.contextmanager
+def open_input_trace(trace_filepath=None, trace_bytes=None):
+  if trace_bytes:
+    trace_bytes.seek(0)
+    yield trace_bytes  # owned by the caller, left open
+    return
+  # Give the trace processor a decompressing stream for .gz and .zst traces rather than a path
+  with h_read.open_trace(trace_filepath) as f:
+    yield f
+
+
+def parse_trace(tp, trace_filepath=None, trace_bytes=None):
+  with open_input_trace(trace_filepath, trace_bytes) as f:
+    tp._parse_trace(f)
+
+
+def load_trace_processor(trace_filepath=None, trace_bytes=None, pool=None, key=None):
+  """Return a trace processor with the trace loaded and the query helpers below attached. With a TraceProcessorPool the shell is reused instead of spawned, key is the trace's key in the pool (see TraceProcessorPool.load())."""
+  if pool:
+    return pool.load(trace_filepath=trace_filepath, trace_bytes=trace_bytes, key=key)
+  tp = spawn_trace_processor()
+  try:
+    parse_trace(tp, trace_filepath, trace_bytes)
+  except ConnectionResetError as e:
+    # This happens sometimes so retry once on a new shell
+    tp.close()
+    tp = spawn_trace_processor()
+    parse_trace(tp, trace_filepath, trace_bytes)
+  return attach_query_functions(tp)
+
+
+def attach_query_functions(tp):
+  def run_query(query):
     query = query.lower().replace('select * from slice', interesting_fields) # gives a 15% speedup
     try:
-      query_iterator = tp.query(query)
+      return tp.query(query)
     except Exception as e:
       print('[ERROR] Unable to run query: %s' % query)
       # print('[ERROR] Unable to run query.')
       print(traceback.format_exc())
       print('\n\n')
       raise e
-    return [item.__dict__ for item in query_iterator]
+
+  def query_dict(query):
+    return h_name.intern_slice_names([item.__dict__ for item in run_query(query)])  # slices share one string per unique name
+
+  def query_iter(query):
+    """Like query_dict but yields one row dict at a time."""
+    for item in run_query(query):
+      yield h_name.intern_slice_names([item.__dict__])[0]
+
+  def query_columns(query):
+    """Like query_dict but returns {column name: numpy array}, without creating a dict per row. See result_columns()."""
+    return result_columns(run_query(query))
+
+  def query_dataframe(query):
+    return pd.DataFrame(query_columns(query))
 
   tp.query_dict = query_dict
+  tp.query_cache = QueryCache(query_dict)
+  tp.query_dict_cached = tp.query_cache  # for queries that are repeated, see QueryCache
+  tp.query_iter = query_iter
+  tp.query_columns = query_columns
+  tp.query_dataframe = query_dataframe
 
   return tp
 
 
+def load_trace_processor_replicas(count, trace_filepath=None, trace_bytes=None):
+  """Load the trace into count trace processors at once and return a TraceProcessorReplicas that dispatches queries across them."""
+  def load(_):
+    reader = h_read.SharedFileReader(trace_bytes) if trace_bytes else None  # each replica reads the file at its own position
+    return load_trace_processor(trace_filepath=trace_filepath, trace_bytes=reader)
+  with concurrent.futures.ThreadPoolExecutor(max_workers=count) as executor:
+    tps = list(executor.map(load, range(count)))
+  return TraceProcessorReplicas(tps)
+
+
+class TraceProcessorReplicas:
+  """Stands in for one trace processor, running each query on whichever of several trace processors with the same trace loaded is free.
+
+  A trace_processor_shell answers one query at a time, so this is what lets query heavy passes such as h_annotate.prefetch_manual_annotations() run on threads. Every replica holds the whole trace rather than a time or track shard, since queries like descendant_slice() and flows cross any shard boundary.
+  """
+  def __init__(self, tps):
+    self.tps = tps
+    self.free = queue.Queue()
+    for tp in tps:
+      self.free.put(tp)
+    attach_query_functions(self)
+
+  def query(self, query):
+    tp = self.free.get()  # waits for a replica to be free
+    try:
+      return tp.query(query)  # the result is fully read here, so the replica can be released
+    finally:
+      self.free.put(tp)
+
+  def __len__(self):
+    return len(self.tps)
+
+  def close(self):
+    for tp in self.tps:
+      tp.close()
+
+
+TRACE_PROCESSOR_POOL_SIZE = int(os.environ.get('HOTLINE_TP_POOL_SIZE', 1))  # idle shells kept ready
+TRACE_PROCESSOR_POOL_MAX_LOADED = 4  # traces kept loaded for reuse
+
+
+class TraceProcessorPool:
+  """Reusable trace_processor_shell workers shared by the analyses run in one process.
+
+  Idle shells are spawned ahead of time on background threads, so startup overlaps with reading the trace. Loaded traces are keyed by content and kept up to max_loaded, least recently used first out, so loading the same trace again returns the same trace processor and its query cache. A shell can't unload a trace, so unloading closes it and a fresh idle shell is spawned in its place.
+  """
+  def __init__(self, size=TRACE_PROCESSOR_POOL_SIZE, max_loaded=TRACE_PROCESSOR_POOL_MAX_LOADED, spawn=spawn_trace_processor):
+    self.size = size
+    self.max_loaded = max_loaded
+    self.spawn = spawn
+    self.idle = collections.deque()  # futures of spawned shells
+    self.loaded = collections.OrderedDict()  # trace key -> tp
+    self.lock = threading.Lock()
+    self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(size, 1), thread_name_prefix='trace_processor_pool')
+    self.stats = {'spawned': 0, 'loads': 0, 'reuses': 0, 'unhealthy': 0}
+
+  def _spawn(self):
+    self.stats['spawned'] += 1
+    return self.spawn()
+
+  def fill(self):
+    """Start spawning shells in the background until size are idle."""
+    with self.lock:
+      while len(self.idle) < self.size:
+        self.idle.append(self.executor.submit(self._spawn))
+
+  def take_idle(self):
+    """Return a healthy idle shell, spawning one if there are none."""
+    while True:
+      with self.lock:
+        future = self.idle.popleft() if self.idle else None
+      if future is None:
+        return self._spawn()
+      try:
+        tp = future.result()
+      except Exception as e:
+        log.warning(f'Discarding trace processor that failed to start: {e}')
+        self.stats['unhealthy'] += 1
+        continue
+      if self.is_healthy(tp):
+        return tp
+      self.discard(tp)
+
+  @staticmethod
+  def is_healthy(tp):
+    if getattr(tp, 'subprocess', None) is not None and tp.subprocess.poll() is not None:
+      return False  # the shell exited
+    try:
+      tp.http.status()
+    except Exception:
+      return False
+    return True
+
+  def discard(self, tp):
+    self.stats['unhealthy'] += 1
+    try:
+      tp.close()
+    except Exception:
+      pass
+
+  @staticmethod
+  def file_key(trace_filepath, **params):
+    """Key of a trace file by its path, size and modification time, so the trace doesn't have to be read to find out if it's loaded. Params that change what is loaded from the file, such as remove_slice_args, are part of the key."""
+    stat = os.stat(trace_filepath)
+    return repr((os.path.realpath(trace_filepath), stat.st_size, stat.st_mtime_ns, sorted(params.items())))
+
+  @classmethod
+  def trace_key(cls, trace_filepath=None, trace_bytes=None):
+    if trace_bytes:
+      # Nothing else is known about the bytes
+      digest = hashlib.blake2b(digest_size=20)
+      trace_bytes.seek(0)
+      for block in iter(lambda: trace_bytes.read(h_cache.HASH_BLOCK_SIZE), b''):
+        digest.update(block)
+      return digest.hexdigest()
+    return cls.file_key(trace_filepath)
+
+  def load(self, trace_filepath=None, trace_bytes=None, key=None):
+    """Return a trace processor with this trace loaded, reusing a loaded one when it is still healthy.
+
+    key identifies the trace, such as the h_cache key or file_key() of the file trace_bytes were read from. Without one, trace_bytes are hashed.
+    """
+    key = key or self.trace_key(trace_filepath, trace_bytes)
+    with self.lock:
+      tp = self.loaded.get(key)
+      if tp is not None:
+        self.loaded.move_to_end(key)
+    if tp is not None:
+      if self.is_healthy(tp):
+        self.stats['reuses'] += 1
+        return tp
+      self.unload(key)
+
+    tp = self.take_idle()
+    try:
+      parse_trace(tp, trace_filepath, trace_bytes)
+    except ConnectionResetError as e:
+      # This happens sometimes so retry once on another shell
+      self.discard(tp)
+      tp = self.take_idle()
+      parse_trace(tp, trace_filepath, trace_bytes)
+    attach_query_functions(tp)
+    self.stats['loads'] += 1
+
+    with self.lock:
+      self.loaded[key] = tp
+      evicted = []
+      while len(self.loaded) > self.max_loaded:
+        evicted.append(self.loaded.popitem(last=False)[1])
+    for old_tp in evicted:
+      old_tp.close()
+    self.fill()  # replace the shell that was used
+    return tp
+
+  def holds(self, tp):
+    with self.lock:
+      return any(loaded_tp is tp for loaded_tp in self.loaded.values())
+
+  def unload(self, key):
+    with self.lock:
+      tp = self.loaded.pop(key, None)
+    if tp is not None:
+      try:
+        tp.close()
+      except Exception:
+        pass
+
+  def close(self):
+    with self.lock:
+      loaded, self.loaded = list(self.loaded.values()), collections.OrderedDict()
+      idle, self.idle = list(self.idle), collections.deque()
+    for future in idle:
+      try:
+        loaded.append(future.result())
+      except Exception:
+        pass
+    for tp in loaded:
+      try:
+        tp.close()
+      except Exception:
+        pass
+
+
+trace_processor_pool = None
+
+
+def get_trace_processor_pool():
+  """The process-wide pool, created on first use."""
+  global trace_processor_pool
+  if trace_processor_pool is None:
+    trace_processor_pool = TraceProcessorPool()
+    atexit.register(trace_processor_pool.close)
+  return trace_processor_pool
+
+
+def result_columns(query_iterator):
+  """Convert a query result to {column name: numpy array}.
+
+  The result holds one list of values per cell type (int, float, string, ...) in row-major order, and a type per cell. Each column is gathered from those lists with numpy instead of building a row object per row like iterating the result does.
+  Columns of only ints are int64, of only floats (or ints and floats) are float64, anything else (strings, columns with NULLs) is an object array with None for NULL.
+  """
+  column_names = query_iterator._QueryResultIterator__column_names  # perfetto 0.5.0 keeps the decoded batches private
+  cells = np.asarray(query_iterator._QueryResultIterator__cells, dtype=np.int8)
+  data_lists = query_iterator._QueryResultIterator__data_lists
+  column_count = len(column_names)
+  row_count = len(cells) // column_count if column_count else 0
+  cells = cells.reshape(row_count, column_count)
+  if np.any(cells == TraceProcessor.QUERY_CELL_INVALID_FIELD_ID):
+    raise ValueError('Invalid cell type in query result')
+
+  columns = {}
+  for column_idx, column_name in enumerate(column_names):
+    types = set(np.unique(cells[:, column_idx]).tolist())
+    if types <= {TraceProcessor.QUERY_CELL_VARINT_FIELD_ID}:
+      dtype = np.int64
+    elif types <= {TraceProcessor.QUERY_CELL_VARINT_FIELD_ID, TraceProcessor.QUERY_CELL_FLOAT64_FIELD_ID}:
+      dtype = np.float64
+    else:
+      dtype = object
+    columns[column_name] = np.empty(row_count, dtype=dtype)
+    if dtype is object:
+      columns[column_name][:] = None
+
+  flat_cells = cells.ravel()
+  for cell_type, values in enumerate(data_lists):
+    if not len(values) or cell_type == TraceProcessor.QUERY_CELL_NULL_FIELD_ID:
+      continue
+    positions = np.flatnonzero(flat_cells == cell_type)  # the nth cell of this type holds the nth value of this type
+    values = np.asarray(values, dtype=object if cell_type in [TraceProcessor.QUERY_CELL_STRING_FIELD_ID, TraceProcessor.QUERY_CELL_BLOB_FIELD_ID] else None)
+    value_rows, value_columns = np.divmod(positions, column_count)
+    for column_idx, column_name in enumerate(column_names):
+      in_column = value_columns == column_idx
+      if np.any(in_column):
+        columns[column_name][value_rows[in_column]] = values[in_column]
+  return columns
+
+
+def columns_to_dicts(columns, rows=None):
+  """Materialize the given rows (default all) of query_columns() output as row dicts, like query_dict() returns."""
+  names = list(columns)
+  if rows is None:
+    values = [columns[name].tolist() for name in names]
+  else:
+    values = [columns[name][rows].tolist() for name in names]
+  return h_name.intern_slice_names([dict(zip(names, row)) for row in zip(*values)])
+
+
 def get_profile_step_slice(tp):
   """Scope to a certain ProfilerStep"""
   query = f'SELECT * FROM slices WHERE name LIKE "ProfilerStep%";'  # PyTorch specific
-  slice = tp.query_dict(query)[0]
+  slice = tp.query_dict_cached(query)[0]
   start = slice['ts']
   end = slice['ts'] + slice['dur']
   between_time_range = f' ts BETWEEN {start} AND {end}'
@@ -71,9 +426,12 @@ def sql_in_string(ids, col_name):
   return in_ids_str
 
 
-def track_ids_for_process_of_slice(tp, slice):
-  """Get track ids for the process that a slice (ex. ProfilerStep) is found on. Said another way, get all the track ids contained within a process given a track id. For example, what timelines exist in the ProfilerStep process.
+def track_ids_for_process_of_slice(tp, slice, topology=None):
+  """Get track ids for the process that a slice (ex. ProfilerStep) is found on. Said another way, get all the track ids contained within a process given a track id. For example, what timelines exist in the ProfilerStep process. Answered by an h_table.TrackTopology without a query when given.
   """
+  if topology is not None:
+    primary_track_ids = topology.process_track_ids(slice['track_id'])
+    return primary_track_ids, sql_in_string(primary_track_ids, 'track_id')
   neighbouring_track_ids  = f'''
   select id from THREAD_TRACK where utid in (
     select utid from THREAD where upid=(
@@ -83,13 +441,13 @@ def track_ids_for_process_of_slice(tp, slice):
     )
   );
   '''
-  tracks = tp.query_dict(neighbouring_track_ids)
+  tracks = tp.query_dict_cached(neighbouring_track_ids)
   primary_track_ids = [track['id'] for track in tracks]
   on_primary_tracks = sql_in_string(primary_track_ids, 'track_id')
   return primary_track_ids, on_primary_tracks
 
 
-def get_process_and_thread_name_for_each_track(tp):
+def get_process_and_thread_name_for_each_track(tp, lazy=False):
   """Get process and thread name for each track.
   Note docs: https://perfetto.dev/docs/analysis/trace-processor#thread-and-process-identifiers
   """
@@ -107,6 +465,8 @@ def get_process_and_thread_name_for_each_track(tp):
   JOIN thread on thread_track.utid = thread.utid
   JOIN process on thread.upid = process.upid;
   '''
+  if lazy:
+    return tp.query_iter(query)
   track_info = tp.query_dict(query)
   return track_info
 
@@ -141,55 +501,98 @@ def add_gpu(op, tp, slice_index, flow_index, **kwargs):
 
 
 
-def add_slices(op, slices, tp):
+def add_slices(op, slices, tp, slice_table=None):
   """ Queries each slice given for nested slices then adds all them to an op.
 
   TODO: improve function name and/or break this into two functions?
   """
   # Get descendant slices
   d_slices = []
-  for slice in slices:
-    try:
-      d_slice = tp.query_dict(f'SELECT * FROM descendant_slice({slice["id"]});')
-      d_slices.extend(d_slice)
-    except:
-      print(traceback.format_exc())
+  for descendants in get_descendant_slices(tp, [slice['id'] for slice in slices], slice_table).values():
+    d_slices.extend(descendants)
 
   sub_slices = sorted(slices + d_slices, key=lambda d: d['ts'])
   for slice in sub_slices:
     h_op.append_list_to_resource(op, 'cpu' + str(slice['track_id']), 'slices', slice)
 
 
-def create_slice_index(tp):
-  slices = tp.query_dict('SELECT * FROM slice')
-  slice_index = {}
-  for slice in slices:
-    slice_index[slice['id']] = slice
-  return slice_index
+def get_descendant_slices(tp, slice_ids, slice_table=None):
+  """Get the descendants of many slices at once, grouped per root: {slice_id: [descendant slices]}.
+
+  Same result as a SELECT * FROM descendant_slice(id) ORDER BY id per slice id. With a slice_table, the children index of the table is used and the trace processor isn't queried at all. Otherwise there is one recursive query per batch of ids rather than one round trip to the trace processor per id. If a batch query fails, its ids are queried one at a time so a failure only loses the descendants of one id.
+  """
+  slice_ids = list(dict.fromkeys(slice_ids))  # unique, in order
+  descendants = {slice_id: [] for slice_id in slice_ids}
+  if slice_table is not None:
+    for slice_id, row in zip(slice_ids, slice_table.rows_for_ids(slice_ids)):
+      descendants[slice_id] = slice_table.to_dicts(slice_table.descendant_rows(row))  # copies, callers may edit them
+    return descendants
+  fields = ', '.join(f'slice.{field}' for field in slice_fields)
+  for idx in range(0, len(slice_ids), DESCENDANT_BATCH_SIZE):
+    batch = slice_ids[idx:idx + DESCENDANT_BATCH_SIZE]
+    query = f'''
+    WITH RECURSIVE descendant(root_id, id) AS (
+      SELECT id, id FROM slice WHERE {sql_in_string(batch, 'id')}
+      UNION ALL
+      SELECT descendant.root_id, slice.id FROM slice JOIN descendant ON slice.parent_id = descendant.id
+    )
+    SELECT descendant.root_id, {fields} FROM descendant JOIN slice ON slice.id = descendant.id
+    WHERE descendant.id != descendant.root_id
+    ORDER BY descendant.root_id, slice.id
+    '''
+    try:
+      rows = tp.query_dict(query)
+    except Exception:
+      log.error(f'Unable to get the descendants of {len(batch)} slices in one query, querying them one at a time.\n{traceback.format_exc()}')
+      rows = []
+      for slice_id in batch:
+        try:
+          rows.extend(dict(row, root_id=slice_id) for row in tp.query_dict(f'SELECT * FROM descendant_slice({slice_id}) ORDER BY id'))
+        except Exception:
+          log.error(f'Unable to get the descendants of slice {slice_id}.\n{traceback.format_exc()}')
+    for row in rows:
+      descendants[row.pop('root_id')].append(row)
+  return descendants
+
+
+def create_slice_table(tp):
+  return h_table.SliceTable.from_columns(tp.query_columns('SELECT * FROM slice'))
+
+
+def create_slice_index(tp, slice_table=None):
+  """Slice id -> slice dict. Backed by the columnar slice table so dicts are only created for slices that are looked up."""
+  if slice_table is None:
+    slice_table = create_slice_table(tp)
+  return h_table.SliceIndex(slice_table)
 
 def create_flow_index(tp):
   # From CPU (key) to GPU (value)
-  flows = tp.query_dict('SELECT slice_in, slice_out FROM flow')
-  flow_index = {}
-  for flow in flows:
-    if flow['slice_out'] not in flow_index:
-      flow_index[flow['slice_out']] = [ flow['slice_in'] ]
-    else:
-      flow_index[flow['slice_out']].append(flow['slice_in'])
-  return flow_index
+  flows = tp.query_columns('SELECT slice_in, slice_out FROM flow')
+  slice_out = flows['slice_out'].astype(np.int64)
+  slice_in = flows['slice_in'].astype(np.int64)
+  # Group slice_in by slice_out, keeping flow order within each group
+  order = np.argsort(slice_out, kind='stable')
+  keys, starts = np.unique(slice_out[order], return_index=True)
+  groups = np.split(slice_in[order], starts[1:]) if len(keys) else []
+  return {key: group.tolist() for key, group in zip(keys.tolist(), groups)}
+
+def create_launch_index(slice_table, slice_index, flow_index, launch_name='cudaLaunchKernel'):
+  """From kernel launch slice id (key) to the launched kernel slice (value), the first slice its flow connects to like DIRECTLY_CONNECTED_FLOW()."""
+  launch_rows = np.flatnonzero(slice_table.name_codes == slice_table.name_code(launch_name))
+  launch_index = {}
+  for launch_slice_id in slice_table.id[launch_rows].tolist():
+    kernel_slice_ids = flow_index.get(launch_slice_id)
+    if kernel_slice_ids and kernel_slice_ids[0] in slice_index:
+      launch_index[launch_slice_id] = slice_index[kernel_slice_ids[0]]
+  return launch_index
 
 def create_track_indexes(tp):
-  track_info = get_process_and_thread_name_for_each_track(tp)
   track_index = {}
-  for track in track_info:
-    track_index[track['track_id']] = track
-
   thread_index = {}
-  for track in track_info:
-    thread_index[track['tid']] = track
-
   process_index = {}
-  for track in track_info:
+  for track in get_process_and_thread_name_for_each_track(tp, lazy=True):
+    track_index[track['track_id']] = track
+    thread_index[track['tid']] = track
     if track['pid'] not in process_index:
       process_index[track['pid']] = [track]
     else:
@@ -198,37 +601,49 @@ def create_track_indexes(tp):
   return track_index, thread_index, process_index
 
 
-def get_connected_slices(tp, flow_index, slices):
+def create_track_topology(track_index, slice_table=None, flow_index=None):
+  return h_table.TrackTopology(track_index.values(), slice_table, flow_index)
+
+
+def get_connected_slices(tp, flow_index, slices, slice_table=None):
     # Get connected slice ids
   connected_slice_ids = []
   sub_slice_ids = [op["id"] for op in slices]
   for sub_slice_id in sub_slice_ids:
     connected_slice_ids.extend(flow_index.get(sub_slice_id, []))
 
+  if slice_table is not None:
+    # Same as the query below: each slice once, in id order
+    return slice_table.to_dicts(slice_table.rows_for_ids(np.unique(np.array(connected_slice_ids, dtype=np.int64)), skip_missing=True))
+
   # Get connected slices from flow index
   ids_str = ','.join([str(id) for id in connected_slice_ids])  # Example string: 23448, 27178, 27205
   connected_slices = tp.query_dict(f'SELECT * FROM slices WHERE id IN ({ids_str})')
   return connected_slices
 
-def get_descendant_and_connected_slices(tp, flow_index, slice_id):
-  sub_slices = tp.query_dict(f'SELECT * FROM descendant_slice({slice_id})')
-  connected_slices = get_connected_slices(tp, flow_index, sub_slices)
+def get_descendant_and_connected_slices(tp, flow_index, slice_id, slice_table=None):
+  sub_slices = get_descendant_slices(tp, [slice_id], slice_table)[slice_id]
+  connected_slices = get_connected_slices(tp, flow_index, sub_slices, slice_table)
 
   slices = []
   slices.extend(sub_slices)
   slices.extend(connected_slices)
   return slices
 
-def get_slices_on_other_threads_on_same_process_between_time_range(tp, slice):
+def get_slices_on_other_threads_on_same_process_between_time_range(tp, slice, slice_table=None, topology=None):
   """Get slices on other threads on same process between time range."""
   # Get other thread ids on same process
-  track_ids, on_tracks = track_ids_for_process_of_slice(tp, slice)
+  track_ids, on_tracks = track_ids_for_process_of_slice(tp, slice, topology)
   track_ids.remove(slice['track_id'])
   on_tracks = sql_in_string(track_ids, 'track_id')
 
   # Get time range
   start = slice['ts']
   end = slice['ts'] + slice['dur']
+
+  if slice_table is not None:
+    return slice_table.to_dicts(slice_table.intervals().starting_between(start, end, track_ids))
+
   between_time_range = f' ts BETWEEN {start} AND {end}'
 
   # Get slices
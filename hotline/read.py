@@ -1,31 +1,48 @@
 import io
+import os
+import mmap
 import orjson
 import time
 import json
 import copy
+import codecs
+import re
+import gzip
+import tempfile
+import concurrent.futures
 
 from perfetto.trace_processor import TraceProcessor
 
+try:
+  import zstandard  # optional, only needed for .zst traces
+except ImportError:
+  zstandard = None
+
 from hotline.hotline import *
 
 
-def get_key(slice, processed=False, track_index=None):
-  """A key that can corrolated between legacy raw JSON and new trace processor JSON types"""
+def get_keys(slices, processed=False, track_index=None):
+  """Keys that can be corrolated between legacy raw JSON and new trace processor slices.
+
+  A key is a (ts, dur, cat, tid, name) tuple so a lookup costs one tuple hash instead of building a string. Processed slices are in nanoseconds and are converted back to the microseconds of the raw JSON in one vectorized step.
+  """
   if processed:
-    ts = h_time.safe_time_convert(slice["ts"])
-    dur = h_time.safe_time_convert(slice.get('dur',''))
-    cat = slice.get('category','')
-    tid = track_index[slice["track_id"]]["tid"]
+    ts = h_time.safe_time_convert_array([slice['ts'] for slice in slices]).tolist()
+    dur = h_time.safe_time_convert_array([slice.get('dur') or 0 for slice in slices]).tolist()
+    cat = [slice.get('category') or '' for slice in slices]
+    tid = [track_index[slice['track_id']]['tid'] or '' for slice in slices]
   else:
-    ts = slice["ts"]
-    dur = slice.get('dur','')
-    cat = slice.get('cat','')
-    tid = slice.get('tid','')
-  if dur == 0: # legacy json can have duration missing, while new json has dur=0
-    dur = '' # revert to legacy
-  key = f'{ts}{dur}{cat}{tid}{slice["name"]}'
-  key = key.replace("None", "")
-  return key
+    ts = [slice.get('ts') for slice in slices]
+    dur = [slice.get('dur') or 0 for slice in slices]  # legacy json can have duration missing, while new json has dur=0
+    cat = [slice.get('cat') or '' for slice in slices]
+    tid = [slice.get('tid') or '' for slice in slices]
+  name = [slice.get('name') or '' for slice in slices]
+  return list(zip(ts, dur, cat, tid, name))
+
+
+def get_key(slice, processed=False, track_index=None):
+  """A key that can corrolated between legacy raw JSON and new trace processor JSON types"""
+  return get_keys([slice], processed=processed, track_index=track_index)[0]
 
 
 def convert_ids_int_string(slices):
@@ -44,40 +61,526 @@ def remove_args(slices):
   [slice.pop('args', None) for slice in slices]
 
 
-def load_raw_trace(input_trace_file, remove_slice_args=False):
-  with open(input_trace_file, "rb") as f:
-    raw_slices = orjson.loads(f.read())
+def normalize_event(event, remove_slice_args=False):
+  """Apply convert_ids_int_string, convert_negative_tids_to_positive and remove_args to a single event."""
+  if 'id' in event:
+    event['id'] = str(event['id'])
+  tid = event.get('tid')
+  if isinstance(tid, int):
+    event['tid'] = abs(tid)
+  if remove_slice_args:
+    event.pop('args', None)
+  return event
 
-  if isinstance(raw_slices, dict) and 'traceEvents' in raw_slices:
-    raw_slices = raw_slices.pop('traceEvents', None) # Perfetto doesn't want this format produced by PyTorch
-  convert_ids_int_string(raw_slices) # Convert IDs from int to string. Without this perfetto fails to JSON load trace with IDs stored as integers.
-  convert_negative_tids_to_positive(raw_slices) # Convert negative 'tid' values to positive. Without this perfetto combines together the slices with different tids into one track
 
-  if remove_slice_args:
-    remove_args(raw_slices) # For speedup
+READ_BLOCK_SIZE = 1 << 20  # bytes read from disk at a time while streaming a trace
+EVENT_CHUNK_SIZE = 50000  # number of events handed to the caller at a time
+_json_decoder = json.JSONDecoder()
+_json_whitespace = re.compile(r'[ \t\n\r]*')
+
+
+class JsonStreamReader:
+  """Incrementally decode a JSON document from a binary file object.
+
+  Only a small window of the document is held in memory. Values are decoded one at a time with the C scanner of the json module, so a trace of several GB can be walked while only ever holding one event at a time.
+  """
+  def __init__(self, f, read_block_size=READ_BLOCK_SIZE):
+    self.f = f
+    self.read_block_size = read_block_size
+    self.decoder = codecs.getincrementaldecoder('utf-8')()
+    self.buf = ''
+    self.pos = 0
+    self.eof = False
+
+  def fill(self):
+    """Read the next block from disk. Returns False at the end of the file."""
+    if self.eof:
+      return False
+    block = self.f.read(self.read_block_size)
+    if not block:
+      self.eof = True
+      self.buf = self.buf[self.pos:] + self.decoder.decode(b'', final=True)
+      self.pos = 0
+      return False
+    # Drop everything already consumed so the window does not grow with the trace size
+    self.buf = self.buf[self.pos:] + self.decoder.decode(block)
+    self.pos = 0
+    return True
+
+  def peek(self):
+    """Return the next non-whitespace character without consuming it."""
+    while True:
+      self.pos = _json_whitespace.match(self.buf, self.pos).end()
+      if self.pos < len(self.buf):
+        return self.buf[self.pos]
+      if not self.fill():
+        raise ValueError('Unexpected end of JSON trace file.')
+
+  def expect(self, chars):
+    char = self.peek()
+    if char not in chars:
+      raise ValueError(f'Malformed JSON trace file, expected one of "{chars}" but found "{char}" at position {self.pos}.')
+    self.pos += 1
+    return char
+
+  def decode_value(self):
+    self.peek()
+    while True:
+      try:
+        value, end = _json_decoder.raw_decode(self.buf, self.pos)
+      except json.JSONDecodeError:
+        # The value is cut off by the end of the window, read more and try again
+        if self.eof:
+          raise
+        self.fill()
+        continue
+      if end >= len(self.buf) and not self.eof:
+        # A number or literal touching the end of the window may continue in the next block
+        self.fill()
+        continue
+      self.pos = end
+      return value
+
+  def iter_array(self):
+    """Yield each value of the JSON array starting at the current position."""
+    self.expect('[')
+    if self.peek() == ']':
+      self.pos += 1
+      return
+    while True:
+      yield self.decode_value()
+      if self.expect(',]') == ']':
+        return
+
+  def iter_object(self):
+    """Yield each key of the JSON object starting at the current position. The caller must consume the value of each key before asking for the next key."""
+    self.expect('{')
+    if self.peek() == '}':
+      self.pos += 1
+      return
+    while True:
+      key = self.decode_value()
+      self.expect(':')
+      yield key
+      if self.expect(',}') == '}':
+        return
+
+
+def open_trace(filepath, mode='rb'):
+  """Open a trace file in binary mode. Files ending in .gz or .zst are (de)compressed as a stream so they never have to be unpacked to disk first."""
+  filepath = str(filepath)
+  if filepath.endswith('.gz'):
+    return gzip.open(filepath, mode)
+  if filepath.endswith('.zst'):
+    if zstandard is None:
+      raise ImportError(f'The zstandard package is required for .zst traces: pip install zstandard ({filepath})')
+    if 'r' in mode:
+      return zstandard.ZstdDecompressor().stream_reader(open(filepath, 'rb'), read_across_frames=True, closefd=True)
+    return zstandard.ZstdCompressor().stream_writer(open(filepath, 'wb'), closefd=True)
+  return open(filepath, mode)
+
+
+PROTOBUF_TRACE_EXTENSIONS = ('.pftrace', '.perfetto-trace', '.pb')
+
+
+def is_protobuf_trace(filepath):
+  """True for Perfetto protobuf traces, which are loaded by the trace processor directly instead of going through the JSON path."""
+  filepath = str(filepath)
+  for compression_ext in ['.gz', '.zst']:
+    if filepath.endswith(compression_ext):
+      filepath = filepath[:-len(compression_ext)]
+  return filepath.endswith(PROTOBUF_TRACE_EXTENSIONS)
+
+
+def iter_trace_events(input_trace_file, read_block_size=READ_BLOCK_SIZE):
+  """Yield the events of a Chrome JSON trace one at a time.
+
+  Both the PyTorch format ({"traceEvents": [...], ...}) and a bare list of events are supported, either as plain JSON or compressed as .json.gz or .json.zst.
+  """
+  with open_trace(input_trace_file) as f:
+    reader = JsonStreamReader(f, read_block_size)
+    if reader.peek() == '[':
+      yield from reader.iter_array()
+      return
+    for key in reader.iter_object():
+      if key == 'traceEvents':
+        yield from reader.iter_array()
+      else:
+        reader.decode_value()  # skip other top level values such as "deviceProperties"
+
+
+def iter_raw_trace_chunks(input_trace_file, remove_slice_args=False, chunk_size=EVENT_CHUNK_SIZE, read_block_size=READ_BLOCK_SIZE):
+  """Yield lists of at most chunk_size normalized events so that only one chunk of decoded event dicts is alive at a time."""
+  chunk = []
+  for event in iter_trace_events(input_trace_file, read_block_size=read_block_size):
+    chunk.append(normalize_event(event, remove_slice_args))
+    if len(chunk) >= chunk_size:
+      yield chunk
+      chunk = []
+  if chunk:
+    yield chunk
+
+
+PROFILER_STEP_NAME = re.compile(rb'"name"\s*:\s*"ProfilerStep#')
+GPU_CATEGORIES = ('kernel', 'gpu_memcpy', 'gpu_memset', 'gpu_user_annotation')
+FLOW_PHASES = ('s', 't', 'f')
+
+
+def _is_profiler_step(event):
+  return isinstance(event, dict) and str(event.get('name', '')).startswith('ProfilerStep#') and event.get('ts') is not None and event.get('dur') is not None
+
+
+def find_profiler_step_windows(input_trace_file, read_block_size=READ_BLOCK_SIZE):
+  """Find the (start, end) time windows in us of the ProfilerStep#N slices and the pids they are on.
+
+  This is the cheap first pass of profiler_step_only ingest. The raw bytes are searched for ProfilerStep names and only the enclosing events are decoded, instead of decoding every event of the trace. Falls back to decoding every event if an enclosing event can't be found this way.
+  """
+  steps = []
+  with open_trace(input_trace_file) as f:
+    buf = b''
+    eof = False
+    while not eof:
+      block = f.read(read_block_size)
+      eof = not block
+      buf += block
+      pos = 0
+      pending = None
+      while True:
+        match = PROFILER_STEP_NAME.search(buf, pos)
+        if not match:
+          break
+        start = buf.rfind(b'{', 0, match.start())  # PyTorch writes "name" before any nested "args" object
+        try:
+          event, end = _json_decoder.raw_decode(buf[start:].decode('utf-8', 'replace'))
+        except json.JSONDecodeError:
+          if not eof:
+            pending = start  # the event is cut off by the end of the buffer, read more
+          break
+        if not _is_profiler_step(event):
+          log.warning('Unable to locate ProfilerStep events by name, decoding every event to find them.')
+          steps = [event for event in iter_trace_events(input_trace_file, read_block_size) if _is_profiler_step(event)]
+          eof = True
+          break
+        steps.append(event)
+        pos = match.end()
+      # Keep only what could still hold the start of an event that continues into the next block
+      if pending is not None:
+        buf = buf[pending:]
+      else:
+        last_brace = buf.rfind(b'{', pos)
+        buf = buf[last_brace:] if last_brace != -1 else buf[max(pos, len(buf) - 64):]
 
-  #   # Write back changes to disk so that Perfetto can read it in the correct format.
-  #   with open(input_trace_file, 'wb') as f:
-  #     # json.dump(raw_slices, f, indent=2)
-  #     # json.dump(raw_slices, f)  # speedup without indents
-  #     slices_bytes = orjson.dumps(raw_slices)
-  #     f.write(slices_bytes) # speedup with orjson 4x speedup
-  # time.sleep(0.1) # Wait for the file to be written to disk before we try to read it.
-  # slices_bytes = None
+  windows = sorted((event['ts'], event['ts'] + event['dur']) for event in steps)
+  step_pids = {event.get('pid') for event in steps}
+  return windows, step_pids
 
-  slices_bytes = orjson.dumps(raw_slices)
-  slices_bytes = io.BytesIO(slices_bytes)  # 4x speedup using orjson
 
-  # Remove tracks that have only 1 slice because these are deemed noise
-  raw_slices = h_slice.remove_tracks_with_n_slices(raw_slices, 1)
+class ProfilerStepFilter:
+  """Decides which events are kept by profiler_step_only ingest.
 
+  Kept are:
+    - events on the ProfilerStep process that overlap a ProfilerStep window
+    - GPU events and flows from the start of the first window on, since kernels launched in a window run after the launch
+    - metadata (process/thread names) of the processes that have kept events, see kept_metadata()
+  """
+  def __init__(self, windows, step_pids):
+    self.windows = windows
+    self.step_pids = step_pids
+    self.first_start = windows[0][0]
+    self.gpu_pids = set()
+    self.deferred_metadata = []
+
+  def keep(self, event):
+    pid = event.get('pid')
+    phase = event.get('ph')
+    if phase == 'M':
+      if pid in self.step_pids:
+        return True
+      self.deferred_metadata.append(event)  # keep if the pid turns out to have GPU events
+      return False
+    ts = event.get('ts')
+    if ts is None:
+      return pid in self.step_pids
+    if event.get('cat') in GPU_CATEGORIES or phase in FLOW_PHASES:
+      if ts >= self.first_start:
+        self.gpu_pids.add(pid)
+        return True
+      return False
+    if pid not in self.step_pids:
+      return False
+    end = ts + (event.get('dur') or 0)
+    return any(start <= end and ts <= stop for start, stop in self.windows)
+
+  def kept_metadata(self):
+    """Metadata events held back by keep() for the processes that ended up with kept events. Call once every event has been seen."""
+    return [event for event in self.deferred_metadata if event.get('pid') in self.gpu_pids]
+
+
+def filter_profiler_step_chunks(chunks, windows, step_pids):
+  """Drop events that can't be part of the analysis, the rest of the trace is never loaded into the trace processor. See ProfilerStepFilter for what is kept."""
+  step_filter = ProfilerStepFilter(windows, step_pids)
+  kept_count = 0
+  total_count = 0
+  for chunk in chunks:
+    total_count += len(chunk)
+    chunk = [event for event in chunk if step_filter.keep(event)]
+    kept_count += len(chunk)
+    if chunk:
+      yield chunk
+  metadata = step_filter.kept_metadata()
+  kept_count += len(metadata)
+  if metadata:
+    yield metadata
+  log.info(f'Kept {kept_count} of {total_count} trace events in {len(windows)} ProfilerStep windows.')
+
+
+def serialize_events(events):
+  """Serialize normalized events for the trace processor and locate them for raw_slice_index.
+
+  Every event is serialized once and only the joined bytes are kept, raw_slice_index points into them so no event dicts are kept alive after their chunk.
+
+  Returns:
+    events_bytes: the events joined by commas, without the enclosing brackets
+    index_items: (key, (offset, length)) pairs for raw_slice_index, the offset is relative to the start of events_bytes
+    count_per_track: tid -> number of events
+    first_key_per_track: tid -> key of the first event
+  """
+  events_bytes = [orjson.dumps(event) for event in events]  # 4x speedup using orjson
+  index_items = []
+  count_per_track = {}
+  first_key_per_track = {}
+  offset = 0
+  for event, event_bytes, key in zip(events, events_bytes, get_keys(events)):
+    tid = event.get('tid')
+    count_per_track[tid] = count_per_track.get(tid, 0) + 1
+    first_key_per_track.setdefault(tid, key)
+    index_items.append((key, (offset, len(event_bytes))))
+    offset += len(event_bytes) + 1  # and the comma
+  return b','.join(events_bytes), index_items, count_per_track, first_key_per_track
+
+
+def read_raw_slice(slices_bytes, location):
+  """Return the event at location, an (offset, length) of raw_slice_index, in the normalized trace. Null values are sanitized for the trace viewer."""
+  offset, length = location
+  event_bytes = os.pread(slices_bytes.fileno(), length, offset)  # leaves the file position alone
+  if b'null' in event_bytes:
+    event = orjson.loads(event_bytes)
+    if None in event.values():
+      event_bytes = orjson.dumps(sanitize_trace([event])[0])
+  return event_bytes
+
+
+class SharedFileReader:
+  """A read position of its own on an open file, so several readers can read the file at once. Reads use pread and never move the file's own position."""
+  def __init__(self, f):
+    f.flush()  # pread doesn't see buffered writes
+    self.fileno = f.fileno()
+    self.position = 0
+
+  def seek(self, position):
+    self.position = position
+
+  def read(self, size=-1):
+    if size is None or size < 0:
+      size = os.fstat(self.fileno).st_size - self.position
+    data = os.pread(self.fileno, size, self.position)
+    self.position += len(data)
+    return data
+
+
+TRACE_EVENTS_START = re.compile(rb'"traceEvents"\s*:\s*\[')
+EVENT_BOUNDARY = re.compile(rb'\}\s*,\s*\{')
+ARRAY_END_ATTEMPTS = 16
+
+
+def find_trace_event_ranges(input_trace_file, num_ranges):
+  """Split the traceEvents array of a plain JSON trace into about num_ranges byte ranges that start on an event.
+
+  Split points are found by searching for "},{" near evenly spaced offsets, without parsing the trace. A split point that happens to be inside a string or a nested object makes the ranges around it fail to decode, which _decode_trace_events_range() reports as an error. The last range has end None because where the array ends is only known once it is decoded.
+  """
+  with open(input_trace_file, 'rb') as f:
+    if os.fstat(f.fileno()).st_size == 0:
+      return []
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+      first = _json_whitespace.match(data[:64].decode('utf-8', 'replace')).end()
+      if data[first:first + 1] == b'[':
+        array_start = first + 1  # bare list of events
+      else:
+        match = TRACE_EVENTS_START.search(data)
+        if not match:
+          raise ValueError(f'No traceEvents array found in {input_trace_file}')
+        array_start = match.end()
+      first_event = data.find(b'{', array_start)
+      if first_event == -1:
+        return []
+      starts = [first_event]
+      step = max((len(data) - first_event) // num_ranges, 1)
+      for offset in range(first_event + step, len(data), step):
+        match = EVENT_BOUNDARY.search(data, max(offset, starts[-1] + 1))
+        if not match:
+          break
+        if match.end() - 1 > starts[-1]:
+          starts.append(match.end() - 1)
+  return list(zip(starts, starts[1:] + [None]))
+
+
+def _decode_events_to_array_end(data):
+  """Decode the events of the last range. It runs up to the end of the array, which is found by trying each "}]" from the end of the file backwards."""
+  end = len(data)
+  for _ in range(ARRAY_END_ATTEMPTS):
+    end = data.rfind(b']', 0, end)
+    if end == -1:
+      break
+    last_event_end = len(data[:end].rstrip())
+    if data[last_event_end - 1:last_event_end] != b'}':
+      continue
+    try:
+      return orjson.loads(b'[' + data[:last_event_end] + b']')
+    except orjson.JSONDecodeError:
+      continue  # this "}]" is in a value after the traceEvents array
+  raise ValueError('Unable to find the end of the traceEvents array.')
+
+
+def _decode_trace_events_range(input_trace_file, start, end, remove_slice_args, windows=None, step_pids=None):
+  """Process pool worker of parallel ingest. Decode, normalize, filter and serialize the events in one byte range of the traceEvents array."""
+  with open(input_trace_file, 'rb') as f:
+    f.seek(start)
+    data = f.read(-1 if end is None else end - start)
+  if end is None:
+    events = _decode_events_to_array_end(data)
+  else:
+    events = orjson.loads(b'[' + data.rstrip().rstrip(b',') + b']')  # raises if the range does not hold whole events
+  total_count = len(events)
+  events = [normalize_event(event, remove_slice_args) for event in events]
+  deferred_metadata, gpu_pids = [], set()
+  if windows:
+    step_filter = ProfilerStepFilter(windows, step_pids)
+    events = [event for event in events if step_filter.keep(event)]
+    deferred_metadata, gpu_pids = step_filter.deferred_metadata, step_filter.gpu_pids
+  return serialize_events(events), total_count, deferred_metadata, gpu_pids
+
+
+def iter_parallel_serialized_events(input_trace_file, remove_slice_args, num_workers, windows=None, step_pids=None, executor=None):
+  """Decode and serialize ranges of the traceEvents array in a process pool, in file order. Returns None if the trace can't be split, then the caller should stream it instead.
+
+  executor is a process pool of num_workers to use, see h_util.start_process_pool(). Without one, a pool is made for this call.
+  """
+  try:
+    ranges = find_trace_event_ranges(input_trace_file, num_workers * 4)  # more ranges than workers to balance the load
+  except (ValueError, OSError) as e:
+    log.warning(f'Unable to split the trace for parallel ingest: {e}')
+    return None
+  if not ranges:
+    return None
+  own_executor = executor is None
+  if own_executor:
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=num_workers)
+  try:
+    futures = [executor.submit(_decode_trace_events_range, input_trace_file, start, end, remove_slice_args, windows, step_pids) for start, end in ranges]
+    concurrent.futures.wait(futures)
+  finally:
+    if own_executor:
+      executor.shutdown()
+
+  # A split point inside a string or nested value makes the ranges on both sides of it fail. Those are joined with the following ranges until they decode.
+  results = []
+  idx = 0
+  while idx < len(ranges):
+    if futures[idx].exception() is None:
+      results.append(futures[idx].result())
+      idx += 1
+      continue
+    start = ranges[idx][0]
+    while True:
+      idx += 1
+      if idx >= len(ranges):
+        log.warning(f'Unable to split the trace on event boundaries for parallel ingest: {futures[idx - 1].exception()}')
+        return None
+      try:
+        results.append(_decode_trace_events_range(input_trace_file, start, ranges[idx][1], remove_slice_args, windows, step_pids))
+        idx += 1
+        break
+      except ValueError:
+        continue
+
+  serialized = [result[0] for result in results]
+  if windows:
+    # Metadata is kept for the processes with GPU events in any range
+    gpu_pids = set().union(*[result[3] for result in results])
+    metadata = [event for result in results for event in result[2] if event.get('pid') in gpu_pids]
+    total_count = sum(result[1] for result in results)
+    kept_count = sum(len(result[0][1]) for result in results) + len(metadata)
+    log.info(f'Kept {kept_count} of {total_count} trace events in {len(windows)} ProfilerStep windows.')
+    if metadata:
+      serialized.append(serialize_events(metadata))
+  log.info(f'Decoded {len(ranges)} parts of the trace with {num_workers} workers.')
+  return serialized
+
+
+def load_raw_trace(input_trace_file, remove_slice_args=False, profiler_step_only=False, num_workers=1, executor=None):
+  """Normalize the trace and write it for the trace processor in a single streaming pass.
+
+  Returns:
+    raw_slice_count: number of events kept in raw_slice_index
+    raw_slice_index: key -> (offset, length) of the event in slices_bytes, used to export per-op traces in the legacy raw format, see read_raw_slice()
+    slices_bytes: normalized trace for the trace processor, in an anonymous temporary file
+
+  The normalized trace is written to disk as it is serialized instead of being held in memory. raw_slice_index is still in memory and grows with the number of events, as do the decoded ranges of parallel ingest until they are written.
+
+  With profiler_step_only, events outside of the ProfilerStep#N windows and processes are dropped before anything else is done with them, see ProfilerStepFilter.
+  With num_workers > 1, ranges of a plain JSON trace are decoded in parallel by a process pool, executor if given. Compressed traces, or traces that can't be split on event boundaries, are streamed.
+  """
+  # Stream events from disk instead of reading the whole file and decoding it in one go. Only the traceEvents are kept because Perfetto doesn't want the rest of the format produced by PyTorch.
+  # Each event is normalized as it is read:
+  #   - Convert IDs from int to string. Without this perfetto fails to JSON load trace with IDs stored as integers.
+  #   - Convert negative 'tid' values to positive. Without this perfetto combines together the slices with different tids into one track
+  #   - Optionally remove args for speedup
+  windows, step_pids = None, None
+  if profiler_step_only:
+    windows, step_pids = find_profiler_step_windows(input_trace_file)
+    if not windows:
+      log.warning('No ProfilerStep events found, loading the whole trace.')
+
+  serialized = None
+  if num_workers > 1 and str(input_trace_file).endswith(('.gz', '.zst')):
+    log.info('Compressed traces are read as a stream, parallel ingest is not used.')
+  elif num_workers > 1:
+    serialized = iter_parallel_serialized_events(input_trace_file, remove_slice_args, num_workers, windows, step_pids, executor)
+  if serialized is None:
+    chunks = iter_raw_trace_chunks(input_trace_file, remove_slice_args=remove_slice_args)
+    if windows:
+      chunks = filter_profiler_step_chunks(chunks, windows, step_pids)
+    serialized = (serialize_events(chunk) for chunk in chunks)
+
+  slices_bytes = tempfile.TemporaryFile()  # deleted once closed or garbage collected
+  slices_bytes.write(b'[')
   raw_slice_index = {}
-  for s in raw_slices:
-    # makes very little performance difference
-    key = get_key(s)
-    raw_slice_index[key] = s
+  count_per_track = {}
+  first_key_per_track = {}
+  for events_bytes, index_items, chunk_count_per_track, chunk_first_key_per_track in serialized:
+    if not events_bytes:
+      continue
+    if slices_bytes.tell() > 1:
+      slices_bytes.write(b',')
+    base = slices_bytes.tell()
+    slices_bytes.write(events_bytes)
+    raw_slice_index.update((key, (base + offset, length)) for key, (offset, length) in index_items)
+    for tid, count in chunk_count_per_track.items():
+      count_per_track[tid] = count_per_track.get(tid, 0) + count
+    for tid, key in chunk_first_key_per_track.items():
+      first_key_per_track.setdefault(tid, key)
+  slices_bytes.write(b']')
+  slices_bytes.seek(0)
+
+  # Remove tracks that have only 1 slice because these are deemed noise. Same as h_slice.remove_tracks_with_n_slices(), nothing is removed if every track has only 1 slice.
+  raw_slice_count = sum(count_per_track.values())
+  single_slice_tracks = [tid for tid, count in count_per_track.items() if count == 1]
+  if len(single_slice_tracks) < len(count_per_track):
+    for tid in single_slice_tracks:
+      raw_slice_index.pop(first_key_per_track[tid], None)
+    raw_slice_count -= len(single_slice_tracks)
 
-  return raw_slices, raw_slice_index, slices_bytes
+  return raw_slice_count, raw_slice_index, slices_bytes
 
 
 def sanitize_trace(trace):
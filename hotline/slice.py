@@ -19,6 +19,17 @@ def get_slices_at_depth(slices, depth):
   return [slice for slice in slices if slice['depth'] == depth]
 
 
+def get_rows_at_depth(table, rows, depth):
+  """Same as get_slices_at_depth() for row indexes into a h_table.SliceTable."""
+  if not len(rows):
+    return rows
+  depths = table.depth[rows]
+  if isinstance(depth, str):
+    if depth == 'minimum':
+      depth = depths.min()
+  return rows[depths == depth]
+
+
 def get_unique_depths(slices):
   """Example: Convert  [2, 2, 1, 2, 3] to [1, 2, 3] so we can loop over unique depths in order, lowest first"""
   depths = [slice["depth"] for slice in slices]
@@ -65,7 +76,8 @@ def normalize_slice_depth(op):
       _normalize_slice_depth(slices)
 
 
-def get_sub_slices_for_range(slices, slice_group):
+def get_sub_slices_for_range(slices, slice_group, interval_index=None):
+  """Slices that start within the time span of slice_group and are not longer than it. interval_index is an h_table.IntervalIndex over slices, to find them without scanning every slice."""
   if not slice_group:
     return []
   start_slice = slice_group[0]
@@ -74,6 +86,10 @@ def get_sub_slices_for_range(slices, slice_group):
   start_ts = start_slice['ts']
   total_dur = end_slice['ts'] + end_slice['dur'] - start_slice['ts']
 
+  if interval_index is not None:
+    rows = interval_index.starting_between(start_ts, end_ts, include_end=False)
+    return [slices[row] for row in rows.tolist() if slices[row]['dur'] <= total_dur]
+
   slices_between_range = [
     slice for slice in slices
       if slice['ts'] >= start_ts
@@ -200,3 +216,12 @@ def remove_upper_depths_if_only_one_slice(slices):
       remove_slices_at_depth(slices, depth)
     else:
       return slices
+
+
+def remove_upper_depth_rows_if_only_one_slice(table, rows):
+  """Same as remove_upper_depths_if_only_one_slice() for row indexes into a h_table.SliceTable."""
+  depths, counts = np.unique(table.depth[rows], return_counts=True)
+  multiple = np.flatnonzero(counts > 1)
+  if not len(multiple):
+    return rows[:0]  # every depth has one slice
+  return rows[table.depth[rows] >= depths[multiple[0]]]
@@ -0,0 +1,357 @@
+import collections.abc
+
+import numpy as np
+import pandas as pd
+
+from hotline.hotline import *
+
+
+class SliceTable:
+  """Columnar copy of the trace processor's slice table.
+
+  Numeric fields are int64 columns sorted by slice id. Names and categories are stored once each and referenced by integer codes local to the table, so a pickled table (ex. in h_cache) only carries the names of its own trace. h_slice.get_rows_at_depth() and h_slice.remove_upper_depth_rows_if_only_one_slice() take row index arrays into this table instead of lists of slice dicts.
+  """
+  def __init__(self, id, ts, dur, track_id, depth, parent_id, name_codes, names, category_codes, categories):
+    self.id = id
+    self.ts = ts
+    self.dur = dur
+    self.track_id = track_id
+    self.depth = depth
+    self.parent_id = parent_id  # -1 when the slice has no parent
+    self.name_codes = name_codes
+    self.names = names
+    self.category_codes = category_codes
+    self.categories = categories
+
+  @classmethod
+  def from_rows(cls, rows):
+    """Build from slice dicts as returned by tp.query_dict('SELECT * FROM slice')."""
+    rows = sorted(rows, key=lambda d: d['id'])
+    count = len(rows)
+
+    def int_column(field, default=-1):
+      return np.fromiter((default if row.get(field) is None else row[field] for row in rows), dtype=np.int64, count=count)
+
+    def code_column(field):
+      codes = {}
+      column = np.fromiter((codes.setdefault(row.get(field), len(codes)) for row in rows), dtype=np.int32, count=count)
+      return column, list(codes)
+
+    name_codes, names = code_column('name')
+    category_codes, categories = code_column('category')
+    return cls(
+      id=int_column('id'),
+      ts=int_column('ts'),
+      dur=int_column('dur'),
+      track_id=int_column('track_id'),
+      depth=int_column('depth'),
+      parent_id=int_column('parent_id'),
+      name_codes=name_codes,
+      names=h_name.intern_names(names),  # same strings as the slices from tp.query_dict
+      category_codes=category_codes,
+      categories=categories,
+    )
+
+  @classmethod
+  def from_columns(cls, columns):
+    """Build from column arrays as returned by tp.query_columns('SELECT * FROM slice'), without creating a dict per slice."""
+    order = np.argsort(columns['id'].astype(np.int64), kind='stable')
+
+    def int_column(field, default=-1):
+      column = columns[field][order]
+      if column.dtype == object:
+        column = np.where(np.equal(column, None), default, column)
+      return column.astype(np.int64)
+
+    def code_column(field, intern):
+      # Intern once per unique value instead of once per slice
+      codes, uniques = pd.factorize(columns[field][order])  # None gets code -1
+      codes_for_uniques = [intern(value) for value in uniques]
+      if np.any(codes == -1):
+        codes_for_uniques.append(intern(None))  # indexed by -1
+      return np.asarray(codes_for_uniques, dtype=np.int32)[codes] if len(codes) else np.array([], dtype=np.int32)
+
+    names, categories = {}, {}
+    name_codes = code_column('name', lambda name: names.setdefault(name, len(names)))
+    category_codes = code_column('category', lambda category: categories.setdefault(category, len(categories)))
+    return cls(
+      id=int_column('id'),
+      ts=int_column('ts'),
+      dur=int_column('dur'),
+      track_id=int_column('track_id'),
+      depth=int_column('depth'),
+      parent_id=int_column('parent_id'),
+      name_codes=name_codes,
+      names=h_name.intern_names(list(names)),
+      category_codes=category_codes,
+      categories=list(categories),
+    )
+
+  def __setstate__(self, state):
+    # Share the name strings of an unpickled table (ex. from h_cache) with the rest of this process
+    self.__dict__.update(state)
+    self.names = h_name.intern_names(self.names)
+
+  def __len__(self):
+    return len(self.id)
+
+  def name_code(self, name):
+    """Code of name in name_codes, -1 when no slice has this name."""
+    try:
+      return self.names.index(name)
+    except ValueError:
+      return -1
+
+  def find_rows(self, ids):
+    """Row indexes of slice ids and whether each id was found. Rows of ids that were not found are meaningless."""
+    ids = np.asarray(ids, dtype=np.int64)
+    if not len(self.id):
+      return np.zeros(len(ids), dtype=np.int64), np.zeros(len(ids), dtype=bool)
+    rows = np.minimum(np.searchsorted(self.id, ids), len(self.id) - 1)
+    return rows, self.id[rows] == ids
+
+  def rows_for_ids(self, ids, skip_missing=False):
+    """Convert slice ids to row indexes. Raises KeyError if an id is not in the table, unless skip_missing is set."""
+    ids = np.asarray(ids, dtype=np.int64)
+    if not len(ids):
+      return ids
+    rows, found = self.find_rows(ids)
+    if not np.all(found):
+      if skip_missing:
+        return rows[found]
+      raise KeyError(f'Slice ids not found in slice table: {ids[~found].tolist()}')
+    return rows
+
+  def build_children_index(self):
+    """Build the CSR children index: the child rows of row r are children[child_offsets[r]:child_offsets[r + 1]], in ts order.
+
+    Built once, on first use, so descendant and ancestor lookups are range scans instead of descendant_slice() queries.
+    """
+    has_parent = self.parent_id != -1
+    self.parent_row = np.full(len(self), -1, dtype=np.int64)
+    if np.any(has_parent):
+      rows = np.minimum(np.searchsorted(self.id, self.parent_id[has_parent]), len(self) - 1)
+      parent_rows = np.where(self.id[rows] == self.parent_id[has_parent], rows, -1)  # a parent missing from the table makes a root
+      self.parent_row[has_parent] = parent_rows
+    child_rows = np.flatnonzero(self.parent_row != -1)
+    order = np.lexsort((self.ts[child_rows], self.parent_row[child_rows]))
+    self.children = child_rows[order]
+    child_counts = np.bincount(self.parent_row[child_rows], minlength=len(self))
+    self.child_offsets = np.concatenate([[0], np.cumsum(child_counts)]).astype(np.int64)
+
+  def children_rows(self, rows):
+    """Child rows of all the given rows, grouped by parent."""
+    if not hasattr(self, 'child_offsets'):
+      self.build_children_index()
+    rows = np.asarray(rows, dtype=np.int64)
+    starts = self.child_offsets[rows]
+    lengths = self.child_offsets[rows + 1] - starts
+    total = int(lengths.sum())
+    if not total:
+      return np.array([], dtype=np.int64)
+    # Concatenate the ranges [start, start + length) of every row without a Python loop
+    range_offsets = np.repeat(starts - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths)
+    return self.children[np.arange(total) + range_offsets]
+
+  def descendant_rows(self, row):
+    """Rows of every descendant of a row, in slice id order like descendant_slice(). Walks the children index one depth level at a time."""
+    levels = []
+    frontier = self.children_rows([row])
+    while len(frontier):
+      levels.append(frontier)
+      frontier = self.children_rows(frontier)
+    if not levels:
+      return np.array([], dtype=np.int64)
+    return np.sort(np.concatenate(levels))
+
+  def ancestor_rows(self, row):
+    """Rows of every ancestor of a row, parent first."""
+    if not hasattr(self, 'parent_row'):
+      self.build_children_index()
+    rows = []
+    row = self.parent_row[row]
+    while row != -1:
+      rows.append(row)
+      row = self.parent_row[row]
+    return np.array(rows, dtype=np.int64)
+
+  def intervals(self):
+    """The IntervalIndex of this table, built on first use. Its rows are rows of this table."""
+    if not hasattr(self, 'interval_index'):
+      self.interval_index = IntervalIndex(self.ts, self.dur, self.track_id)
+    return self.interval_index
+
+  def to_dicts(self, rows):
+    """Materialize rows as slice dicts with the same fields as h_perfetto.interesting_fields."""
+    rows = np.asarray(rows, dtype=np.int64)
+    columns = zip(
+      self.ts[rows].tolist(),
+      self.dur[rows].tolist(),
+      self.track_id[rows].tolist(),
+      self.category_codes[rows].tolist(),
+      self.name_codes[rows].tolist(),
+      self.depth[rows].tolist(),
+      self.id[rows].tolist(),
+      self.parent_id[rows].tolist(),
+    )
+    return [
+      {
+        'ts': ts,
+        'dur': dur,
+        'track_id': track_id,
+        'category': self.categories[category_code],
+        'name': self.names[name_code],
+        'depth': depth,
+        'cat': self.categories[category_code],
+        'slice_id': id,
+        'id': id,
+        'parent_id': None if parent_id == -1 else parent_id,
+      }
+      for ts, dur, track_id, category_code, name_code, depth, id, parent_id in columns
+    ]
+
+  def to_dict(self, row):
+    return self.to_dicts([row])[0]
+
+
+class IntervalIndex:
+  """Per-track time range lookups over slices in O(log n + k).
+
+  Each track keeps its rows sorted by ts along with the running maximum of their end times (ts + dur). The slices that start in a range are a contiguous run found with two binary searches. The slices that overlap a range can't start after it ends and can't come before the first row whose running maximum end reaches its start, which is another binary search since the running maximum never decreases. Results are sorted rows, so for a SliceTable they are in slice id order like a SQL query would return.
+  """
+  def __init__(self, ts, dur, track_id):
+    ts = np.asarray(ts, dtype=np.int64)
+    ends = ts + np.maximum(np.asarray(dur, dtype=np.int64), 0)  # dur is -1 for slices that didn't end
+    track_id = np.asarray(track_id, dtype=np.int64)
+    order = np.lexsort((ts, track_id))
+    track_ids, starts = np.unique(track_id[order], return_index=True)
+    self.tracks = {}
+    for track, rows in zip(track_ids.tolist(), np.split(order, starts[1:]) if len(order) else []):
+      self.tracks[track] = (rows, ts[rows], ends[rows], np.maximum.accumulate(ends[rows]))
+
+  @classmethod
+  def from_slices(cls, slices):
+    """Build over a list of slice dicts. Rows are positions in the list."""
+    count = len(slices)
+    return cls(
+      np.fromiter((slice['ts'] for slice in slices), dtype=np.int64, count=count),
+      np.fromiter((slice['dur'] for slice in slices), dtype=np.int64, count=count),
+      np.fromiter((slice.get('track_id', -1) for slice in slices), dtype=np.int64, count=count),
+    )
+
+  def _tracks(self, track_ids):
+    if track_ids is None:
+      return self.tracks.values()
+    return [self.tracks[track] for track in track_ids if track in self.tracks]
+
+  @staticmethod
+  def _sorted(results):
+    if not results:
+      return np.array([], dtype=np.int64)
+    return np.sort(np.concatenate(results))
+
+  def starting_between(self, start, end, track_ids=None, include_end=True):
+    """Rows that start in [start, end] like ts BETWEEN start AND end, or in [start, end) without include_end."""
+    results = []
+    for rows, starts, _, _ in self._tracks(track_ids):
+      lo = np.searchsorted(starts, start, 'left')
+      hi = np.searchsorted(starts, end, 'right' if include_end else 'left')
+      results.append(rows[lo:hi])
+    return self._sorted(results)
+
+  def overlapping(self, start, end, track_ids=None):
+    """Rows with ts <= end and ts + dur >= start."""
+    results = []
+    for rows, starts, ends, max_ends in self._tracks(track_ids):
+      lo = np.searchsorted(max_ends, start, 'left')
+      hi = np.searchsorted(starts, end, 'right')
+      candidates = np.arange(lo, max(lo, hi))
+      results.append(rows[candidates[ends[candidates] >= start]])
+    return self._sorted(results)
+
+  def within(self, start, end, track_ids=None):
+    """Rows that are contained in the range, with ts >= start and ts + dur <= end."""
+    results = []
+    for rows, starts, ends, _ in self._tracks(track_ids):
+      lo = np.searchsorted(starts, start, 'left')
+      hi = np.searchsorted(starts, end, 'right')
+      results.append(rows[lo:hi][ends[lo:hi] <= end])
+    return self._sorted(results)
+
+
+class TrackTopology:
+  """Track, thread and process relationships of a trace, computed once from the rows of h_perfetto.create_track_indexes().
+
+  GPU streams are thread tracks too, of the process for the GPU device. A track is a GPU track when it has kernel, memcpy, memset or GPU annotation slices. The GPU tracks fed by a CPU track are the tracks that the flows out of its slices (ex. cudaLaunchKernel) end on.
+  """
+  def __init__(self, tracks, slice_table=None, flow_index=None):
+    self.thread_of_track = {}  # track id -> utid
+    self.process_of_thread = {}  # utid -> upid
+    self.tracks_of_process = collections.defaultdict(list)  # upid -> track ids
+    for track in tracks:
+      self.thread_of_track[track['track_id']] = track['utid']
+      self.process_of_thread[track['utid']] = track['upid']
+      self.tracks_of_process[track['upid']].append(track['track_id'])
+    for track_ids in self.tracks_of_process.values():
+      track_ids.sort()
+
+    self.gpu_track_ids = set()
+    self.gpu_tracks_of_track = {}  # track id -> GPU track ids
+    if slice_table is not None:
+      gpu_category_codes = [code for code, category in enumerate(slice_table.categories) if category in h_read.GPU_CATEGORIES]
+      self.gpu_track_ids = set(np.unique(slice_table.track_id[np.isin(slice_table.category_codes, gpu_category_codes)]).tolist())
+      if flow_index:
+        slice_out = np.fromiter((slice_id for slice_id, slice_ins in flow_index.items() for _ in slice_ins), dtype=np.int64)
+        slice_in = np.fromiter((slice_id for slice_ins in flow_index.values() for slice_id in slice_ins), dtype=np.int64)
+        out_rows, out_found = slice_table.find_rows(slice_out)
+        in_rows, in_found = slice_table.find_rows(slice_in)
+        found = out_found & in_found  # flows with an end missing from the table are skipped
+        pairs = np.unique(np.stack([slice_table.track_id[out_rows[found]], slice_table.track_id[in_rows[found]]], axis=1), axis=0)
+        for track_out, track_in in pairs.tolist():
+          if track_in in self.gpu_track_ids and track_in != track_out:
+            self.gpu_tracks_of_track.setdefault(track_out, []).append(track_in)
+
+  def process_track_ids(self, track_id):
+    """Track ids of every thread in the process of this track, including itself, in id order."""
+    utid = self.thread_of_track.get(track_id)
+    if utid is None:
+      return []
+    return list(self.tracks_of_process[self.process_of_thread[utid]])
+
+  def gpu_tracks_fed_by(self, track_id):
+    """GPU track ids that slices on this track launch work on, in id order."""
+    return sorted(set(self.gpu_tracks_of_track.get(track_id, [])))
+
+  def is_gpu_track(self, track_id):
+    return track_id in self.gpu_track_ids
+
+
+class SliceIndex(collections.abc.Mapping):
+  """Read-only slice id -> slice dict view over a SliceTable.
+
+  Dicts are only created for the slices that are looked up and are then reused, so callers get the same shared dict on every lookup as they did with a plain dict index.
+  """
+  def __init__(self, table):
+    self.table = table
+    self._dicts = {}
+
+  def __getitem__(self, slice_id):
+    slice = self._dicts.get(slice_id)
+    if slice is None:
+      row = self.table.rows_for_ids([slice_id])[0]
+      slice = self.table.to_dict(row)
+      self._dicts[slice_id] = slice
+    return slice
+
+  def __contains__(self, slice_id):
+    try:
+      self.table.rows_for_ids([slice_id])
+    except (KeyError, TypeError, ValueError):
+      return False
+    return True
+
+  def __iter__(self):
+    return iter(self.table.id.tolist())
+
+  def __len__(self):
+    return len(self.table)
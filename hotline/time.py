@@ -9,12 +9,18 @@ from hotline.hotline import *
 
 
 def safe_time_convert(time):
-  time = str(time)
-  if time[-3:] == '000':
-    # raise ValueError(f'When converting between the new nanosecond format and the old microsecond format, we found a number that doesn\'t include the expected "000". Given value: {time}')
-    return int(time[:-3])
+  """Convert from the new nanosecond format to the old microsecond format. Values that are not a whole number of microseconds are returned unchanged."""
+  time = int(time)
+  if time % 1000 == 0:
+    return time // 1000
   else:
-    return int(time)
+    return time
+
+
+def safe_time_convert_array(times):
+  """Vectorized safe_time_convert()."""
+  times = np.asarray(times, dtype=np.int64)
+  return np.where(times % 1000 == 0, times // 1000, times)
 
 
 def slices_time_stats(slices):
@@ -1,7 +1,5 @@
 from hotline.hotline import *
 
-import hotline.detect_model as detect_model
-
 
 
 def post_order_depth_first(this_op, apply_fn, *args, parent_op=None, **kwargs):
@@ -33,20 +31,6 @@ def pre_order_depth_first(this_op, apply_fn, *args, parent_op=None, level=-1, **
   return results
 
 
-def parallel_pre_order_depth_first(this_op, apply_fn, executor, model_ops, tp):
-  """Pre-order tree traversal. A kind of depth-first search. Is a recursive function.
-
-  https://en.wikipedia.org/wiki/Tree_traversal
-  Used to step through the model definition in a forward order, depth first."""
-  results = []
-  if this_op['type'] == 'root':
-    results.append(executor.submit(detect_model.detect_model, this_op, model_ops, tp))
-  for op in this_op['ops']:
-    results.append(executor.submit(detect_model.detect_model, op, model_ops, tp))
-    if 'ops' in op:
-      results.extend(parallel_pre_order_depth_first(op, apply_fn, executor, model_ops, tp))
-  return results
-
 class DepthFirstTreeIterator:
     def __init__(self, tree):
         self.tree = tree
@@ -1,6 +1,8 @@
 import string
 import logging
 import random
+import multiprocessing
+import concurrent.futures
 
 import numpy as np
 from IPython import embed
@@ -53,5 +55,14 @@ def normalize_0_to_1(data):
   data = np.array(data)
   return (data - np.min(data)) / (np.max(data) - np.min(data))
 
+def start_process_pool(num_workers, initializer=None, initargs=()):
+  """A process pool with every worker forked right away.
+
+  Call it before starting any thread, a child forked while another thread holds a lock can wait on that lock forever. Workers are forked rather than spawned because spawned workers import __main__, which for hotline.analyze() is the training script.
+  """
+  executor = concurrent.futures.ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context('fork'), initializer=initializer, initargs=initargs)
+  executor.submit(int).result()  # with fork, every worker is started by the first task
+  return executor
+
 def random_id(length=16):
   return ''.join(random.choices(string.ascii_letters + string.digits, k=length))
@@ -19,35 +19,73 @@ def write_hierarchical_model(top_op, filepath):
     json.dump([top_op], outfile)
   log.info(f'Wrote: {filepath}')
 
+def slices_to_chrome_events(slices, track_index):
+  """Convert trace processor slices to Chrome JSON trace events. Used for protobuf traces where there is no raw JSON event to copy."""
+  events = []
+  named_tracks = set()
+  for slice in slices:
+    track = track_index.get(slice['track_id'], {})
+    pid = track.get('pid') or 0
+    tid = track['tid'] if track.get('tid') is not None else slice['track_id']  # non-thread tracks (ex. GPU) get their own row
+    if (pid, tid) not in named_tracks:
+      named_tracks.add((pid, tid))
+      if track.get('process_name'):
+        events.append({'ph': 'M', 'name': 'process_name', 'pid': pid, 'tid': tid, 'args': {'name': track['process_name']}})
+      if track.get('thread_name'):
+        events.append({'ph': 'M', 'name': 'thread_name', 'pid': pid, 'tid': tid, 'args': {'name': track['thread_name']}})
+    events.append({
+      'ph': 'X',
+      'name': slice['name'] or 'NULL',
+      'cat': slice.get('category') or 'NULL',
+      'ts': slice['ts'] / 1000,  # ns to us
+      'dur': max(slice.get('dur') or 0, 0) / 1000,  # unfinished slices have dur -1
+      'pid': pid,
+      'tid': tid,
+    })
+  return events
+
+
 export_idx = 0
-def write_trace(op, ui_traces_path, run_name, raw_slice_index, slices_bytes, track_index, **kwargs):
+def write_trace(op, ui_traces_path, run_name, raw_slice_index, slices_bytes, track_index, compress=False, trace_filepath=None, top_slices_bytes=None, **kwargs):
+  """Export the trace of op. raw_slice_index points into slices_bytes, top_slices_bytes is a different trace to export for the top op."""
   # if 'ops' in op:  # only apply to non-leaf nodes
   #   return
   global export_idx
   export_idx += 1
 
   save_file = f'{ui_traces_path}/{run_name}.{export_idx}.pt.trace.json'
+  if compress:
+    save_file += '.gz'  # perfetto opens gzipped traces directly
 
-  if export_idx == 1:
+  if export_idx == 1 and slices_bytes is None:
+    # This is the top op of a protobuf trace, copy the original trace as is since perfetto opens it directly
+    save_file = f'{ui_traces_path}/{run_name}.{export_idx}.' + os.path.basename(trace_filepath).split('.', 1)[-1]
+    shutil.copyfile(trace_filepath, save_file)
+  elif export_idx == 1:
     # This is the top op, save the original trace
-    with open(save_file, "wb") as f:
-      f.write(slices_bytes.getbuffer())
+    top_slices_bytes = top_slices_bytes or slices_bytes
+    top_slices_bytes.seek(0)
+    with h_read.open_trace(save_file, 'wb') as f:
+      shutil.copyfileobj(top_slices_bytes, f)
+  elif raw_slice_index is None:
+    # Protobuf trace, there are no raw events so rebuild them from the slices
+    slices = h_slice.get_slices(op)
+    if slices:
+      with h_read.open_trace(save_file, 'wb') as f:
+        f.write(orjson.dumps(slices_to_chrome_events(slices, track_index)))
   else:
     slices = h_slice.get_slices(op)
     if slices:
       # Convert perfetto processed traces to raw traces from pytorch profiler
       raw_slices = []
-      for sub_slice in slices:
-        key = h_read.get_key(sub_slice, processed=True, track_index=track_index)
+      for key in h_read.get_keys(slices, processed=True, track_index=track_index):
         try:
-          raw_slice = raw_slice_index[key]
+          raw_slices.append(h_read.read_raw_slice(slices_bytes, raw_slice_index[key]))
         except KeyError as e:
           log.error(f'❌❌❌ failed to lookup key: {key}')
-        raw_slices.append(raw_slice)
-      raw_slices = h_read.sanitize_trace(raw_slices)
 
-      with open(save_file, 'wb') as f:
-        f.write(orjson.dumps(raw_slices))  # 4x faster
+      with h_read.open_trace(save_file, 'wb') as f:
+        f.write(b'[' + b','.join(raw_slices) + b']')
 
   op['trace_file'] = save_file.split('/ui/dist/traces')[-1]
   op['trace_disk_size'] = humanize.naturalsize(os.stat(save_file).st_size)
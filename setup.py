@@ -26,6 +26,9 @@ setup(
     ],
     extras_require={
         'dev': [
-        ]
+        ],
+        'zstd': [
+            'zstandard>=0.18.0',  # read .json.zst traces
+        ],
     }
 )
@@ -0,0 +1,16 @@
+"""
+Fixtures shared by the test files.
+"""
+import pytest
+
+
+@pytest.fixture
+def model_pass_slices():
+  """Two model passes on tracks 1 and 2, each: linear(addmm) relu(relu) linear(addmm) x 10"""
+  slices, slice_id = [], 0
+  for track_id in [1, 2]:
+    for idx in range(30):
+      name = ['aten::addmm', 'aten::relu', 'aten::addmm'][idx % 3]
+      slices.append({'id': slice_id, 'ts': 1000 * track_id + idx * 10, 'dur': 5, 'track_id': track_id, 'depth': 0, 'parent_id': None, 'name': name, 'category': 'cpu_op'})
+      slice_id += 1
+  return slices
@@ -0,0 +1,63 @@
+"""
+# Run Tests
+pytest tests/test_cache.py -s
+"""
+import pytest
+import os
+import sys
+import time
+sys.path.append(os.path.abspath('.'))
+from hotline.hotline import h_cache, h_table
+
+
+def write_file(path, content):
+  with open(path, 'wb') as f:
+    f.write(content)
+  return str(path)
+
+
+def test_key_is_content_addressed(tmp_path):
+  a = write_file(tmp_path / 'a.json', b'{"traceEvents": []}')
+  b = write_file(tmp_path / 'b.json', b'{"traceEvents": []}')
+  c = write_file(tmp_path / 'c.json', b'{"traceEvents": [{}]}')
+  assert h_cache.trace_key(a) == h_cache.trace_key(b)
+  assert h_cache.trace_key(a) != h_cache.trace_key(c)
+  assert h_cache.trace_key(a, remove_slice_args=True) != h_cache.trace_key(a, remove_slice_args=False)
+
+
+def test_round_trip_and_miss(tmp_path):
+  cache_dir = str(tmp_path / 'cache')
+  table = h_table.SliceTable.from_rows([{'id': 0, 'ts': 1, 'dur': 2, 'track_id': 3, 'depth': 0, 'parent_id': None, 'name': 'a', 'category': None}])
+  assert h_cache.load(cache_dir, 'key', 'indexes') is None
+  h_cache.save(cache_dir, 'key', 'indexes', (table, {1: [2]}))
+  loaded_table, flow_index = h_cache.load(cache_dir, 'key', 'indexes')
+  assert loaded_table.to_dicts([0]) == table.to_dicts([0])
+  assert flow_index == {1: [2]}
+
+
+def test_file_round_trip_and_miss(tmp_path):
+  import io
+  cache_dir = str(tmp_path / 'cache')
+  assert h_cache.open_file(cache_dir, 'key', 'slices.json') is None
+  src = io.BytesIO(b'[1]')
+  src.read()
+  h_cache.save_file(cache_dir, 'key', 'slices.json', src)
+  with h_cache.open_file(cache_dir, 'key', 'slices.json') as f:
+    assert f.read() == b'[1]'
+  assert h_cache.entry_size(os.path.join(cache_dir, 'key')) == 3  # counted for eviction
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+  cache_dir = str(tmp_path / 'cache')
+  payload = b'x' * 1000
+  for key in ['old', 'used', 'new']:
+    h_cache.save(cache_dir, key, 'raw_trace', payload)
+    time.sleep(0.01)
+  h_cache.load(cache_dir, 'used', 'raw_trace')  # refresh
+
+  h_cache.evict(cache_dir, max_size=2500)
+  assert sorted(os.listdir(cache_dir)) == ['new', 'used']
+
+  # The entry being written is kept even when it alone is over the limit
+  h_cache.save(cache_dir, 'big', 'raw_trace', payload * 5, max_size=2500)
+  assert os.listdir(cache_dir) == ['big']
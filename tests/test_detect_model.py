@@ -0,0 +1,99 @@
+"""
+# Run Tests
+pytest tests/test_detect_model.py -s
+"""
+import pytest
+import os
+import sys
+import concurrent.futures
+import numpy as np
+sys.path.append(os.path.abspath('.'))
+from hotline.hotline import detect_model, h_table, h_name
+
+
+def make_slice_table(slices):
+  slice_table = h_table.SliceTable.from_rows(slices)
+  slice_table.build_children_index()
+  return slice_table
+
+
+def detect_in_parallel(top_op, model_ops, slice_table):
+  op_matcher = h_name.OpMatcher.from_model_ops(model_ops)
+  with detect_model.start_detect_model_workers(2) as executor:
+    detect_model.share_detect_model_context(executor, 2, model_ops, slice_table, {}, op_matcher)
+    detect_model.parallel_detect_model(top_op, model_ops, executor, None, slice_table, {}, op_matcher)
+  return op_matcher
+
+
+def test_parallel_detect_model_same_as_sequential(model_pass_slices):
+  slice_table = make_slice_table(model_pass_slices)
+  model_ops = [{'name': 'fc1', 'type': 'Linear'}, {'name': 'relu', 'type': 'ReLU'}, {'name': 'fc2', 'type': 'Linear'}]
+
+  def make_top_op():
+    ops = []
+    for is_model_pass, track_id in [('Forward', 1), ('Backward', 2)]:
+      ops.append({'name': f'{is_model_pass} {track_id}', 'type': 'training loop', 'is_model_pass': is_model_pass, 'resources': {
+        f'cpu{track_id}': {'slices': slice_table.to_dicts(np.flatnonzero(slice_table.track_id == track_id))}}})
+    return {'name': 'root', 'type': 'root', 'ops': ops}
+
+  sequential = make_top_op()
+  for op in sequential['ops']:
+    detect_model.detect_model(op, model_ops, None, slice_table=slice_table, launch_index={})
+
+  parallel = make_top_op()
+  op_matcher = detect_in_parallel(parallel, model_ops, slice_table)
+
+  assert parallel == sequential
+  assert [op['name'] for op in parallel['ops'][1]['ops']] == ['fc2', 'relu', 'fc1']
+  assert all('resources' in op for pass_op in parallel['ops'] for op in pass_op['ops'])
+  assert 'aten::addmm' in op_matcher.matches  # verdicts made by the workers
+
+
+def resource_slice_ids(ops):
+  return [(op['name'], {res_name: [slice['id'] for slice in res['slices']] for res_name, res in op.get('resources', {}).items()}, resource_slice_ids(op.get('ops', []))) for op in ops]
+
+
+def test_detect_model_keeps_every_resource(model_pass_slices):
+  # One model pass with a CPU thread per GPU like DataParallel
+  slice_table = make_slice_table(model_pass_slices)
+  model_ops = [{'name': 'block', 'type': 'Sequential', 'ops': [{'name': 'fc1', 'type': 'Linear'}, {'name': 'relu', 'type': 'ReLU'}]}, {'name': 'fc2', 'type': 'Linear'}]
+
+  def make_top_op():
+    return {'name': 'root', 'type': 'root', 'ops': [{'name': 'Forward', 'type': 'training loop', 'is_model_pass': 'Forward', 'resources': {
+      f'cpu{track_id}': {'slices': slice_table.to_dicts(np.flatnonzero(slice_table.track_id == track_id))} for track_id in [1, 2]}}]}
+
+  sequential = make_top_op()
+  detect_model.detect_model(sequential['ops'][0], model_ops, None, slice_table=slice_table, launch_index={})
+  # Same as before detection was split per resource
+  assert resource_slice_ids(sequential['ops'][0]['ops']) == [
+    ('block', {'cpu1': [0, 1], 'cpu2': [30, 31]}, [('fc1', {'cpu1': [0], 'cpu2': [30]}, []), ('relu', {'cpu1': [1], 'cpu2': [31]}, [])]),
+    ('fc2', {'cpu1': [2, 3], 'cpu2': [32, 33]}, []),
+  ]
+
+  parallel = make_top_op()
+  detect_in_parallel(parallel, model_ops, slice_table)
+  assert parallel == sequential
+
+  # A parent op has the same slice dicts as its child ops on every resource, in both paths
+  for top_op in [sequential, parallel]:
+    block, fc1 = top_op['ops'][0]['ops'][0], top_op['ops'][0]['ops'][0]['ops'][0]
+    for res_name in ['cpu1', 'cpu2']:
+      assert block['resources'][res_name]['slices'][0] is fc1['resources'][res_name]['slices'][0]
+
+
+@pytest.mark.parametrize('is_model_pass', ['Forward', 'Backward'])
+def test_banded_alignment_same_as_greedy(is_model_pass, model_pass_slices):
+  slice_table = make_slice_table(model_pass_slices)
+  model_ops = [{'name': 'block', 'type': 'Sequential', 'ops': [{'name': 'fc1', 'type': 'Linear'}, {'name': 'relu', 'type': 'ReLU'}]}, {'name': 'fc2', 'type': 'Linear'}, {'name': 'dropout', 'type': 'Dropout'}]  # no slices match dropout
+  op = {'name': is_model_pass, 'is_model_pass': is_model_pass}
+  rows = np.flatnonzero(slice_table.track_id == 1)
+  greedy = detect_model.detect_model_on_slices(op, model_ops, slice_table.to_dicts(rows), 'cpu1', None, slice_table, {})
+  banded = detect_model.detect_model_on_slices(op, model_ops, slice_table.to_dicts(rows), 'cpu1', None, slice_table, {}, alignment_engine='banded')
+  assert banded == greedy
+  assert 'resources' not in banded[-1]
+
+
+def test_banded_alignment_skips_missing_ops():
+  matches = detect_model.MatchMatrix([{'type': 'Conv2d'}, {'type': 'ReLU'}, {'type': 'Linear'}, {'type': 'ReLU'}], [{'name': name} for name in ['aten::conv2d', 'aten::mul', 'aten::addmm', 'aten::relu']], False, None, {})
+  assert detect_model.align_leaf_ops(matches, 4, 4).tolist() == [0, -1, 2, 3]
+  assert detect_model.align_leaf_ops(matches, 4, 4, band=1).tolist() == [0, -1, 2, 3]
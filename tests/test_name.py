@@ -0,0 +1,93 @@
+"""
+# Run Tests
+pytest tests/test_name.py -s
+"""
+import pytest
+import os
+import sys
+sys.path.append(os.path.abspath('.'))
+from hotline.hotline import h_name, h_cache
+
+
+def test_name_table_interns_names():
+  name_table = h_name.NameTable()
+  a = name_table.intern('aten::conv2d')
+  assert name_table.intern('aten::' + 'conv2d') == a
+  assert name_table.intern('aten::relu') == a + 1
+  assert name_table.name(a) == 'aten::conv2d'
+
+
+def test_derived_values_are_computed_once_per_name():
+  name_table = h_name.NameTable()
+  calls = []
+  def derive(name):
+    calls.append(name)
+    return name.upper()
+  assert [name_table.derive(derive, name) for name in ['a', 'b', 'a', 'a']] == ['A', 'B', 'A', 'A']
+  assert calls == ['a', 'b']
+
+
+def test_interned_slices_share_names():
+  slices = [{'name': ''.join(['aten::', 'add_'])}, {'name': ''.join(['aten::', 'add_'])}, {'id': 1}]
+  h_name.intern_slice_names(slices)
+  assert slices[0]['name'] is slices[1]['name']
+  assert 'name' not in slices[2]
+
+
+def test_reset_name_table():
+  h_name.intern_slice_names([{'name': 'aten::add_'}])
+  h_name.rename_slice('aten::add_')
+  h_name.reset_name_table()
+  assert h_name.name_table.names == [] and h_name.name_table.derived == {}
+
+
+def test_cached_renames_match():
+  assert h_name.rename_slice('autograd::engine::evaluate_function: MeanBackward1') == 'Mean1'
+  assert h_name.rename_slice('autograd::engine::evaluate_function: MeanBackward1') == 'Mean1'
+  assert h_name.standardize_name('BatchNorm2d') == 'batchnorm'
+  assert h_name.match('Volta_Scudnn_Winograd_128x128_relu', h_name.fused_names)
+
+
+def test_aho_corasick_finds_every_word():
+  automaton = h_name.AhoCorasick(['he', 'she', 'his', 'hers', 'cudnn::bn'])
+  assert automaton.find_all('ushers') == {'he', 'she', 'hers'}
+  assert automaton.find_all('cudnn::bn_fw') == {'cudnn::bn'}
+  assert automaton.find_all('xyz') == set()
+
+
+def test_op_matcher_same_as_fuzzy_op_match():
+  model_ops = [{'name': 'layer1', 'type': 'Sequential', 'ops': [
+    {'name': 'conv1', 'type': 'Conv2d'}, {'name': 'bn1', 'type': 'BatchNorm2d'}, {'name': 'relu', 'type': 'ReLU'},
+    {'name': 'fc', 'type': 'Linear'}, {'name': 'attn', 'type': 'MultiheadAttention'}, {'name': 'lstm', 'type': 'LSTM'},
+  ]}]
+  op_matcher = h_name.OpMatcher.from_model_ops(model_ops)
+  slice_names = ['aten::conv2d', 'volta_scudnn_winograd_128x128_relu', 'aten::clamp_', 'cudnn::bn_fw_tr', 'aten::addmm', 'TBackward0', 'aten::rnn_tanh', 'aten::relu_', 'aten::add_', 'cat_and_dog']
+  ops = model_ops[0]['ops'] + [{'name': 'unknown', 'type': 'Identity'}]
+  for slice_name in slice_names:
+    for op in ops:
+      for is_backward in [False, True]:
+        expected = h_name.fuzzy_op_match({'name': slice_name}, op, is_backward, None)
+        assert h_name.fuzzy_op_match({'name': slice_name}, op, is_backward, None, op_matcher=op_matcher) == expected
+
+
+def test_op_matcher_verdicts_are_cached_and_saved(tmp_path):
+  model_ops = [{'name': 'conv1', 'type': 'Conv2d'}, {'name': 'fc', 'type': 'Linear'}]
+  op_matcher = h_name.OpMatcher.from_model_ops(model_ops)
+  for _ in range(3):
+    for slice_name in ['volta_scudnn_winograd_128x128_relu', 'aten::addmm']:
+      for op in model_ops:
+        op_matcher.match(h_name.standardize_name(slice_name), h_name.standardize_name(op['type']), False)
+  assert op_matcher.stats() == {'hits': 10, 'misses': 2, 'size': 2}
+
+  cache_dir = str(tmp_path / 'cache')
+  h_cache.save(cache_dir, 'op_matcher', 'verdicts', op_matcher.dump_verdicts())
+  saved = h_cache.load(cache_dir, 'op_matcher', 'verdicts')
+  loaded = h_name.OpMatcher.from_model_ops(model_ops)
+  assert loaded.load_verdicts(saved)
+  assert loaded.matches == op_matcher.matches
+  assert loaded.match(h_name.standardize_name('volta_scudnn_winograd_128x128_relu'), 'conv', False) == op_matcher.match(h_name.standardize_name('volta_scudnn_winograd_128x128_relu'), 'conv', False)
+  assert loaded.stats()['misses'] == 0
+
+  # Verdicts made for other op types are not loaded
+  assert not h_name.OpMatcher.from_model_ops([{'name': 'relu', 'type': 'ReLU'}]).load_verdicts(saved)
+  assert not loaded.load_verdicts(None)  # cache miss
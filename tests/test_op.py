@@ -0,0 +1,43 @@
+"""
+# Run Tests
+pytest tests/test_op.py -s
+"""
+import pytest
+import os
+import sys
+import copy
+sys.path.append(os.path.abspath('.'))
+from hotline.hotline import h_op
+
+
+def make_model_ops():
+  return [{'name': 'layer1', 'type': 'Sequential', 'is_model_op': True, 'ops': [
+    {'name': 'conv1', 'type': 'Conv2d', 'is_model_op': True},
+    {'name': 'relu', 'type': 'ReLU', 'is_model_op': True, 'resources': {'cpu1': {'slices': [{'id': 1}]}}},
+  ]}]
+
+
+def test_clone_op_tree_keeps_shared_objects_shared():
+  slice = {'id': 1}
+  model_ops = [{'name': 'block', 'type': 'Sequential', 'resources': {'cpu1': {'slices': [slice]}}, 'ops': [
+    {'name': 'fc1', 'type': 'Linear', 'resources': {'cpu1': {'slices': [slice]}}},
+  ]}]
+  clone = h_op.clone_op_tree(model_ops)
+  clone_slice = clone[0]['resources']['cpu1']['slices'][0]
+  assert clone_slice is clone[0]['ops'][0]['resources']['cpu1']['slices'][0]  # shared like in the original
+  assert clone_slice is not slice and clone_slice == slice
+  deepcopy = copy.deepcopy(model_ops)
+  assert deepcopy[0]['resources']['cpu1']['slices'][0] is deepcopy[0]['ops'][0]['resources']['cpu1']['slices'][0]
+
+
+def test_clone_op_tree_same_as_deepcopy():
+  model_ops = make_model_ops()
+  clone = h_op.clone_op_tree(model_ops)
+  assert clone == copy.deepcopy(model_ops)
+  assert clone[0]['name'] is model_ops[0]['name']  # shared
+
+  # Annotating the clone leaves the original as it was
+  h_op.append_list_to_resource(clone[0]['ops'][0], 'cpu1', 'slices', [{'id': 2}])
+  h_op.append_list_to_resource(clone[0]['ops'][1], 'cpu1', 'slices', [{'id': 3}])
+  clone[0]['ops'].reverse()
+  assert model_ops == make_model_ops()
@@ -0,0 +1,341 @@
+"""
+# Run Tests
+pytest tests/test_perfetto.py -s
+"""
+import pytest
+import os
+import sys
+import sqlite3
+import numpy as np
+sys.path.append(os.path.abspath('.'))
+from hotline.hotline import h_perfetto, h_table, h_name, h_annotate
+from perfetto.trace_processor import TraceProcessor
+
+
+class Batch:
+  def __init__(self, rows):
+    self.cells, self.varint_cells, self.float64_cells, self.blob_cells, strings = [], [], [], [], []
+    for row in rows:
+      for value in row:
+        if value is None:
+          self.cells.append(TraceProcessor.QUERY_CELL_NULL_FIELD_ID)
+        elif isinstance(value, int):
+          self.cells.append(TraceProcessor.QUERY_CELL_VARINT_FIELD_ID)
+          self.varint_cells.append(value)
+        elif isinstance(value, float):
+          self.cells.append(TraceProcessor.QUERY_CELL_FLOAT64_FIELD_ID)
+          self.float64_cells.append(value)
+        else:
+          self.cells.append(TraceProcessor.QUERY_CELL_STRING_FIELD_ID)
+          strings.append(value)
+    self.string_cells = ''.join(string + '\0' for string in strings)
+    self.is_last_batch = False
+
+
+def make_query_result(column_names, rows, batch_size=2):
+  """Build a query result the same way the trace processor returns them, in batches of cells."""
+  batches = [Batch(rows[idx:idx + batch_size]) for idx in range(0, len(rows), batch_size)] or [Batch([])]
+  batches[-1].is_last_batch = True
+  return TraceProcessor.QueryResultIterator(column_names, batches)
+
+
+class SqliteTraceProcessor:
+  """Stands in for the trace processor by running queries on an in-memory SQLite slice table."""
+  def __init__(self, slices):
+    self.db = sqlite3.connect(':memory:')
+    self.db.row_factory = sqlite3.Row
+    self.db.execute(f'CREATE TABLE slice ({", ".join(h_perfetto.slice_fields)})')
+    self.db.execute('CREATE VIEW slices AS SELECT * FROM slice')
+    for slice in slices:
+      slice = {**slice, 'slice_id': slice['id'], 'cat': slice['category']}
+      self.db.execute(f'INSERT INTO slice VALUES ({", ".join("?" * len(h_perfetto.slice_fields))})', [slice[field] for field in h_perfetto.slice_fields])
+
+  def query(self, query):
+    cursor = self.db.execute(query.lower())
+    return make_query_result([column[0] for column in cursor.description], [tuple(row) for row in cursor])
+
+  def query_dict(self, query):
+    return [dict(row) for row in self.db.execute(query.lower())]
+
+  def query_columns(self, query):
+    return h_perfetto.result_columns(self.query(query))
+
+
+def make_slices():
+  # Track 1: a(0) > b(1) > c(2) and a(0) > d(4). Track 2: kernel(3)
+  return [
+    {'id': 0, 'ts': 100, 'dur': 50, 'track_id': 1, 'depth': 0, 'parent_id': None, 'name': 'a', 'category': 'cpu_op'},
+    {'id': 1, 'ts': 105, 'dur': 20, 'track_id': 1, 'depth': 1, 'parent_id': 0, 'name': 'b', 'category': 'cpu_op'},
+    {'id': 2, 'ts': 110, 'dur': 5, 'track_id': 1, 'depth': 2, 'parent_id': 1, 'name': 'c', 'category': None},
+    {'id': 3, 'ts': 120, 'dur': 10, 'track_id': 2, 'depth': 0, 'parent_id': None, 'name': 'kernel', 'category': 'kernel'},
+    {'id': 4, 'ts': 130, 'dur': 10, 'track_id': 1, 'depth': 1, 'parent_id': 0, 'name': 'd', 'category': 'cpu_op'},
+  ]
+
+
+def test_get_descendant_slices_grouped_per_root():
+  tp = SqliteTraceProcessor(make_slices())
+  descendants = h_perfetto.get_descendant_slices(tp, [0, 1, 3, 1])
+  assert list(descendants) == [0, 1, 3]
+  assert [slice['id'] for slice in descendants[0]] == [1, 2, 4]
+  assert [slice['id'] for slice in descendants[1]] == [2]
+  assert descendants[3] == []
+  assert 'root_id' not in descendants[0][0]
+  assert set(descendants[0][0]) == set(h_perfetto.slice_fields)
+
+
+def test_descendants_in_id_order_and_per_id_after_a_failed_batch():
+  import re
+  slices = make_slices() + [{'id': 5, 'ts': 101, 'dur': 2, 'track_id': 1, 'depth': 1, 'parent_id': 0, 'name': 'e', 'category': 'cpu_op'}]  # starts before b(1)
+
+  class FlakyTraceProcessor(SqliteTraceProcessor):
+    """Fails every batch query and the descendant_slice() of slice 1."""
+    def query_dict(self, query):
+      match = re.search(r'descendant_slice\((\d+)\)', query)
+      if not match or match.group(1) == '1':
+        raise RuntimeError('query failed')
+      descendants = f'WITH RECURSIVE d(id) AS (SELECT id FROM slice WHERE parent_id = {match.group(1)} UNION ALL SELECT slice.id FROM slice JOIN d ON slice.parent_id = d.id)'
+      return super().query_dict(f'{descendants} SELECT slice.* FROM slice JOIN d USING (id) ORDER BY id')
+
+  from_sql = h_perfetto.get_descendant_slices(SqliteTraceProcessor(slices), [0, 1])
+  in_memory = h_perfetto.get_descendant_slices(None, [0, 1], h_table.SliceTable.from_rows(slices))
+  assert [slice['id'] for slice in from_sql[0]] == [slice['id'] for slice in in_memory[0]] == [1, 2, 4, 5]
+
+  per_id = h_perfetto.get_descendant_slices(FlakyTraceProcessor(slices), [0, 1, 3])
+  assert [slice['id'] for slice in per_id[0]] == [1, 2, 4, 5]
+  assert per_id[1] == [] and per_id[3] == []  # only slice 1 is lost
+
+
+def test_add_slices_adds_roots_and_descendants():
+  tp = SqliteTraceProcessor(make_slices())
+  op = {'name': 'op', 'type': 'generated'}
+  roots = [slice for slice in tp.query_dict('SELECT * FROM slice') if slice['id'] in [1, 3]]
+  h_perfetto.add_slices(op, roots, tp)
+  assert [slice['id'] for slice in op['resources']['cpu1']['slices']] == [1, 2]
+  assert [slice['id'] for slice in op['resources']['cpu2']['slices']] == [3]
+
+
+def test_in_memory_descendants_match_sql():
+  slices = make_slices()
+  tp = SqliteTraceProcessor(slices)
+  slice_table = h_table.SliceTable.from_rows(slices)
+  from_sql = h_perfetto.get_descendant_slices(tp, [0, 1, 3])
+  in_memory = h_perfetto.get_descendant_slices(None, [0, 1, 3], slice_table)
+  for slice_id in [0, 1, 3]:
+    assert [slice['id'] for slice in in_memory[slice_id]] == [slice['id'] for slice in from_sql[slice_id]]
+  assert in_memory[0][0] is not h_perfetto.get_descendant_slices(None, [0], slice_table)[0][0]  # fresh copies
+
+
+def test_in_memory_connected_slices():
+  slices = make_slices()
+  tp = SqliteTraceProcessor(slices)
+  slice_table = h_table.SliceTable.from_rows(slices)
+  flow_index = {2: [3], 4: [3, 99]}
+  from_sql = h_perfetto.get_descendant_and_connected_slices(tp, flow_index, 0)
+  in_memory = h_perfetto.get_descendant_and_connected_slices(None, flow_index, 0, slice_table)
+  assert [slice['id'] for slice in in_memory] == [slice['id'] for slice in from_sql] == [1, 2, 4, 3]
+
+
+def test_result_columns_match_rows():
+  column_names = ['id', 'name', 'dur', 'parent_id', 'value']
+  rows = [(1, 'a', 10, None, 1.5), (2, 'b', 20, 1, 2), (3, None, 30, 1, None)]
+  columns = h_perfetto.result_columns(make_query_result(column_names, rows))
+  assert columns['id'].dtype == np.int64 and columns['id'].tolist() == [1, 2, 3]
+  assert columns['dur'].tolist() == [10, 20, 30]
+  assert columns['name'].tolist() == ['a', 'b', None]
+  assert columns['parent_id'].tolist() == [None, 1, 1]
+  assert columns['value'].tolist() == [1.5, 2, None]
+  assert h_perfetto.columns_to_dicts(columns) == h_name.intern_slice_names([item.__dict__ for item in make_query_result(column_names, rows)])
+  assert h_perfetto.columns_to_dicts(columns, [2])[0]['dur'] == 30
+
+  empty = h_perfetto.result_columns(make_query_result(column_names, []))
+  assert all(len(column) == 0 for column in empty.values())
+
+
+def test_columnar_slice_table_and_flow_index():
+  slices = make_slices()
+  tp = SqliteTraceProcessor(slices)
+  tp.db.execute('CREATE TABLE flow (slice_out, slice_in)')
+  tp.db.executemany('INSERT INTO flow VALUES (?, ?)', [(2, 3), (4, 3), (2, 4)])
+  assert h_perfetto.create_flow_index(tp) == {2: [3, 4], 4: [3]}
+  slice_table = h_perfetto.create_slice_table(tp)
+  expected = h_table.SliceTable.from_rows(slices)
+  assert slice_table.to_dicts(np.arange(5)) == expected.to_dicts(np.arange(5))
+
+
+def test_query_cache():
+  tp = SqliteTraceProcessor(make_slices())
+  query_cache = h_perfetto.QueryCache(tp.query_dict, max_size=2)
+  first = query_cache('SELECT * FROM slice WHERE id = 1;')
+  first[0]['name'] = 'edited'
+  again = query_cache('select *  from slice\n  where id = 1')
+  assert again[0]['name'] == 'b'  # callers get copies
+  assert query_cache.stats() == {'hits': 1, 'misses': 1, 'size': 1}
+
+  query_cache('SELECT * FROM slice WHERE id = 2')
+  query_cache('SELECT * FROM slice WHERE id = 1')  # most recently used
+  query_cache('SELECT * FROM slice WHERE id = 3')  # evicts id = 2
+  assert query_cache.stats() == {'hits': 2, 'misses': 3, 'size': 2}
+  query_cache('SELECT * FROM slice WHERE id = 1')
+  assert query_cache.hits == 3
+
+
+class FakeShell:
+  """Stands in for a trace_processor_shell process in TraceProcessorPool tests."""
+  class Http:
+    def __init__(self):
+      self.alive = True
+
+    def status(self):
+      if not self.alive:
+        raise ConnectionRefusedError()
+
+  def __init__(self):
+    self.http = self.Http()
+    self.traces = []
+    self.trace_files = []
+    self.closed = False
+
+  def _parse_trace(self, trace):
+    self.traces.append(trace.read())
+    self.trace_files.append(trace)
+
+  def close(self):
+    self.closed = True
+    self.http.alive = False
+
+
+def test_trace_processor_pool_reuses_shells():
+  import io
+  shells = []
+  def spawn():
+    shells.append(FakeShell())
+    return shells[-1]
+  pool = h_perfetto.TraceProcessorPool(size=1, max_loaded=1, spawn=spawn)
+  pool.fill()
+  tp = pool.load(trace_bytes=io.BytesIO(b'[1]'))
+  assert tp is shells[0] and tp.traces == [b'[1]'] and hasattr(tp, 'query_dict')
+  assert pool.load(trace_bytes=io.BytesIO(b'[1]')) is tp  # same content, already loaded
+  assert pool.stats['reuses'] == 1
+  assert pool.holds(tp) and not pool.holds(FakeShell())
+
+  # A dead shell is not reused and loading another trace evicts the least recently used one
+  pool.idle[0].result().http.alive = False
+  tp2 = pool.load(trace_bytes=io.BytesIO(b'[2]'))
+  assert tp2 is shells[2] and tp2.traces == [b'[2]'] and shells[1].closed and tp.closed
+  assert pool.stats['unhealthy'] == 1
+
+  pool.close()
+  assert all(shell.closed for shell in shells)
+
+
+def test_trace_files_are_closed_after_loading(tmp_path, monkeypatch):
+  filepath = tmp_path / 'trace.json'
+  filepath.write_bytes(b'[1]')
+  pool = h_perfetto.TraceProcessorPool(size=0, spawn=FakeShell)
+  tp = pool.load(trace_filepath=str(filepath))
+  assert tp.traces == [b'[1]'] and tp.trace_files[0].closed
+  pool.close()
+
+  monkeypatch.setattr(h_perfetto, 'spawn_trace_processor', FakeShell)
+  tp = h_perfetto.load_trace_processor(trace_filepath=str(filepath))
+  assert tp.traces == [b'[1]'] and tp.trace_files[0].closed
+
+
+def test_trace_processor_pool_keys_files_without_reading_them(tmp_path, monkeypatch):
+  import io
+  import os
+  filepath = tmp_path / 'trace.json'
+  filepath.write_bytes(b'[1]')
+  key = h_perfetto.TraceProcessorPool.file_key(str(filepath), remove_slice_args=True)
+  monkeypatch.setattr(h_perfetto.hashlib, 'blake2b', None)  # nothing is hashed when the key is known
+  assert key == h_perfetto.TraceProcessorPool.file_key(str(filepath), remove_slice_args=True)
+  assert key != h_perfetto.TraceProcessorPool.file_key(str(filepath), remove_slice_args=False)
+  pool = h_perfetto.TraceProcessorPool(size=0, spawn=FakeShell)
+  tp = h_perfetto.load_trace_processor(trace_bytes=io.BytesIO(b'[1]'), pool=pool, key=key)
+  assert h_perfetto.load_trace_processor(trace_bytes=io.BytesIO(b'[1]'), pool=pool, key=key) is tp
+  assert h_perfetto.TraceProcessorPool.trace_key(trace_filepath=str(filepath)) == h_perfetto.TraceProcessorPool.file_key(str(filepath))
+
+  # An edited file gets a new key
+  filepath.write_bytes(b'[1, 2]')
+  os.utime(filepath, ns=(0, 0))
+  assert h_perfetto.TraceProcessorPool.file_key(str(filepath), remove_slice_args=True) != key
+  pool.close()
+
+
+def test_replicas_run_one_query_per_trace_processor():
+  import time
+  import concurrent.futures
+
+  class SlowTraceProcessor:
+    def __init__(self):
+      self.running = 0
+      self.max_running = 0
+      self.queries = 0
+
+    def query(self, query):
+      self.running += 1
+      self.max_running = max(self.max_running, self.running)
+      time.sleep(0.01)
+      self.queries += 1
+      self.running -= 1
+      return make_query_result(['id', 'name'], [(self.queries, f'hid={query.split("=")[1].split()[0]} op')])
+
+  tps = [SlowTraceProcessor() for _ in range(3)]
+  replicas = h_perfetto.TraceProcessorReplicas(tps)
+  with concurrent.futures.ThreadPoolExecutor(max_workers=6) as executor:
+    results = list(executor.map(lambda idx: replicas.query_dict(f'SELECT * FROM slices WHERE name LIKE "hid={idx} %"'), range(30)))
+  assert [rows[0]['name'] for rows in results] == [f'hid={idx} op' for idx in range(30)]
+  assert sum(tp.queries for tp in tps) == 30
+  assert all(tp.max_running == 1 and tp.queries for tp in tps)
+
+  # Prefetched manual annotations are answered by the query cache afterwards
+  h_annotate.prefetch_manual_annotations(replicas, range(10), 3)
+  assert sum(tp.queries for tp in tps) == 40
+  assert h_annotate.get_manual_annotation_by_idx(replicas, 4)['name'] == 'hid=4 op'
+  assert sum(tp.queries for tp in tps) == 40
+
+
+def test_replicas_each_read_the_whole_trace(tmp_path, monkeypatch):
+  import tempfile
+  monkeypatch.setattr(h_perfetto, 'spawn_trace_processor', FakeShell)
+  with tempfile.TemporaryFile() as trace_bytes:
+    trace_bytes.write(b'[1, 2, 3]')
+    replicas = h_perfetto.load_trace_processor_replicas(3, trace_bytes=trace_bytes)
+    assert len(replicas) == 3 and all(tp.traces == [b'[1, 2, 3]'] for tp in replicas.tps)
+    assert trace_bytes.tell() == 9  # replicas don't move the file's position
+  replicas.close()
+  assert all(tp.closed for tp in replicas.tps)
+
+
+def test_launch_index_matches_without_queries():
+  slices = make_slices() + [{'id': 5, 'ts': 118, 'dur': 1, 'track_id': 1, 'depth': 2, 'parent_id': 1, 'name': 'cudaLaunchKernel', 'category': 'cuda_runtime'}]
+  slice_table = h_table.SliceTable.from_rows(slices)
+  slice_index = h_table.SliceIndex(slice_table)
+  launch_index = h_perfetto.create_launch_index(slice_table, slice_index, {5: [3], 2: [4]})
+  assert launch_index == {5: slice_index[3]}
+
+  launch_slice = slice_index[5]
+  is_match, _ = h_name.fuzzy_op_match(launch_slice, {'name': 'kernel', 'type': 'Kernel'}, False, None, launch_index)
+  assert is_match
+
+
+def test_track_topology_matches_sql():
+  # Process 10 has threads 1 and 2 on tracks 1 and 5. Process 20 is a GPU with a stream on track 2.
+  slices = make_slices() + [{'id': 5, 'ts': 101, 'dur': 1, 'track_id': 5, 'depth': 0, 'parent_id': None, 'name': 'backward', 'category': 'cpu_op'}]
+  tp = SqliteTraceProcessor(slices)
+  tp.query_dict_cached = tp.query_dict
+  tp.db.execute('CREATE TABLE thread_track (id, utid)')
+  tp.db.execute('CREATE TABLE thread (utid, upid)')
+  tp.db.executemany('INSERT INTO thread_track VALUES (?, ?)', [(1, 1), (2, 3), (5, 2)])
+  tp.db.executemany('INSERT INTO thread VALUES (?, ?)', [(1, 10), (2, 10), (3, 20)])
+  tracks = [{'track_id': track_id, 'utid': utid, 'upid': upid} for track_id, utid, upid in [(1, 1, 10), (2, 3, 20), (5, 2, 10)]]
+  track_index = {track['track_id']: track for track in tracks}
+  topology = h_perfetto.create_track_topology(track_index, h_table.SliceTable.from_rows(slices), {2: [3], 4: [99]})
+
+  for slice in slices:
+    assert h_perfetto.track_ids_for_process_of_slice(tp, slice, topology) == h_perfetto.track_ids_for_process_of_slice(tp, slice)
+  assert topology.process_track_ids(1) == [1, 5]
+  assert topology.process_track_ids(7) == []
+  assert topology.gpu_tracks_fed_by(1) == [2]
+  assert topology.gpu_tracks_fed_by(5) == []
+  assert topology.is_gpu_track(2) and not topology.is_gpu_track(1)
@@ -0,0 +1,214 @@
+"""
+# Run Tests
+pytest tests/test_read.py -s
+"""
+import pytest
+import os
+import sys
+import json
+sys.path.append(os.path.abspath('.'))
+import hotline.read as h_read
+
+
+def write_trace(tmp_path, trace, name='trace.json', indent=None):
+  filepath = tmp_path / name
+  with open(filepath, 'w') as f:
+    json.dump(trace, f, indent=indent)
+  return str(filepath)
+
+
+def read_all(f):
+  f.seek(0)
+  return f.read()
+
+
+def test_pytorch_format_with_other_keys(tmp_path):
+  trace = {
+    'schemaVersion': 1,
+    'deviceProperties': [{'id': 0, 'name': 'GPU'}],
+    'traceEvents': [
+      {'ph': 'X', 'name': 'a', 'ts': 1, 'dur': 10, 'tid': 1},
+      {'ph': 'X', 'name': 'b', 'ts': 2, 'dur': 3, 'tid': 1},
+    ],
+    'traceName': 'test',
+  }
+  filepath = write_trace(tmp_path, trace, indent=2)
+  events = list(h_read.iter_trace_events(filepath))
+  assert events == trace['traceEvents']
+
+
+def test_bare_list_format(tmp_path):
+  trace = [{'ph': 'X', 'name': 'a', 'ts': 1, 'dur': 10, 'tid': 1}]
+  filepath = write_trace(tmp_path, trace)
+  assert list(h_read.iter_trace_events(filepath)) == trace
+
+
+def test_empty_trace(tmp_path):
+  filepath = write_trace(tmp_path, {'traceEvents': []})
+  assert list(h_read.iter_trace_events(filepath)) == []
+
+
+def test_tiny_read_blocks(tmp_path):
+  # Values are split across many reads, including strings with escapes and multi-byte characters
+  trace = {'traceEvents': [
+    {'ph': 'X', 'name': f'aten::conv "{idx}" \\ é ✅', 'ts': 1665165714853849 + idx, 'dur': 123456789, 'tid': -idx, 'args': {'nested': [1, 2, {'x': None}]}}
+    for idx in range(50)
+  ]}
+  filepath = write_trace(tmp_path, trace, indent=1)
+  events = list(h_read.iter_trace_events(filepath, read_block_size=7))
+  assert events == trace['traceEvents']
+
+
+def test_chunks_are_bounded_and_normalized(tmp_path):
+  trace = {'traceEvents': [
+    {'ph': 'X', 'name': 'a', 'ts': idx, 'dur': 1, 'tid': -5, 'id': idx, 'args': {'a': 1}}
+    for idx in range(10)
+  ]}
+  filepath = write_trace(tmp_path, trace)
+  chunks = list(h_read.iter_raw_trace_chunks(filepath, remove_slice_args=True, chunk_size=4))
+  assert [len(chunk) for chunk in chunks] == [4, 4, 2]
+  event = chunks[0][1]
+  assert event == {'ph': 'X', 'name': 'a', 'ts': 1, 'dur': 1, 'tid': 5, 'id': '1'}
+
+
+def test_load_raw_trace_single_pass(tmp_path):
+  events = [
+    {'ph': 'X', 'name': 'a', 'ts': 1, 'dur': 10, 'tid': 1, 'cat': None},
+    {'ph': 'X', 'name': 'b', 'ts': 2, 'dur': 3, 'tid': 1, 'cat': 'cpu_op'},
+    {'ph': 'X', 'name': 'lonely', 'ts': 5, 'dur': 1, 'tid': -2, 'cat': 'cpu_op'},
+  ]
+  filepath = write_trace(tmp_path, {'traceEvents': events})
+  raw_slice_count, raw_slice_index, slices_bytes = h_read.load_raw_trace(filepath)
+
+  # The trace processor gets every normalized event
+  tp_events = json.loads(read_all(slices_bytes))
+  assert [event['tid'] for event in tp_events] == [1, 1, 2]
+
+  # Tracks with a single slice are dropped from the index, and null values are sanitized for the trace viewer
+  assert raw_slice_count == 2
+  assert sorted(json.loads(h_read.read_raw_slice(slices_bytes, location))['name'] for location in raw_slice_index.values()) == ['a', 'b']
+  assert json.loads(h_read.read_raw_slice(slices_bytes, raw_slice_index[h_read.get_key(events[0])]))['cat'] == 'NULL'
+  assert json.loads(read_all(slices_bytes))[0]['cat'] is None  # only sanitized on export
+
+
+def test_raw_and_processed_keys_match():
+  raw = [
+    {'ph': 'X', 'name': 'aten::add_', 'ts': 1665165714853849, 'dur': 15, 'cat': 'cpu_op', 'tid': 7},
+    {'ph': 'i', 'name': 'instant', 'ts': 1665165714853850, 'cat': None, 'tid': 7},
+  ]
+  processed = [
+    {'name': 'aten::add_', 'ts': 1665165714853849000, 'dur': 15000, 'category': 'cpu_op', 'track_id': 2},
+    {'name': 'instant', 'ts': 1665165714853850000, 'dur': 0, 'category': None, 'track_id': 2},
+  ]
+  track_index = {2: {'tid': 7}}
+  assert h_read.get_keys(raw) == h_read.get_keys(processed, processed=True, track_index=track_index)
+  assert h_read.get_key(raw[0]) == h_read.get_key(processed[0], processed=True, track_index=track_index)
+
+
+@pytest.mark.parametrize('extension', ['.json', '.json.gz', '.json.zst'])
+def test_compressed_traces(tmp_path, extension):
+  if extension == '.json.zst':
+    pytest.importorskip('zstandard')
+  trace = {'traceEvents': [{'ph': 'X', 'name': f'op{idx}', 'ts': idx, 'dur': 1, 'tid': 1} for idx in range(100)]}
+  filepath = str(tmp_path / f'trace{extension}')
+  with h_read.open_trace(filepath, 'wb') as f:
+    f.write(json.dumps(trace).encode())
+  assert list(h_read.iter_trace_events(filepath, read_block_size=64)) == trace['traceEvents']
+  raw_slice_count, _, slices_bytes = h_read.load_raw_trace(filepath)
+  assert raw_slice_count == 100
+  assert json.loads(read_all(slices_bytes)) == trace['traceEvents']
+
+
+def make_profiler_trace():
+  # pid 1 is the training process, pid 2 a dataloader worker and pid 0 the GPU
+  return {'traceEvents': [
+    {'ph': 'M', 'name': 'process_name', 'pid': 0, 'tid': 0, 'args': {'name': 'GPU 0'}},
+    {'ph': 'M', 'name': 'process_name', 'pid': 1, 'tid': 0, 'args': {'name': 'python'}},
+    {'ph': 'M', 'name': 'process_name', 'pid': 2, 'tid': 0, 'args': {'name': 'worker'}},
+    {'ph': 'X', 'cat': 'cpu_op', 'name': 'warmup', 'pid': 1, 'tid': 1, 'ts': 10, 'dur': 5},
+    {'ph': 'X', 'cat': 'user_annotation', 'name': 'ProfilerStep#3', 'pid': 1, 'tid': 1, 'ts': 100, 'dur': 100, 'args': {'External id': 1}},
+    {'ph': 'X', 'cat': 'cpu_op', 'name': 'aten::add_', 'pid': 1, 'tid': 1, 'ts': 110, 'dur': 5},
+    {'ph': 'X', 'cat': 'cpu_op', 'name': 'backward', 'pid': 1, 'tid': 2, 'ts': 150, 'dur': 10},
+    {'ph': 'f', 'cat': 'ac2g', 'name': 'launch', 'pid': 0, 'tid': 7, 'ts': 190, 'id': 1},
+    {'ph': 'X', 'cat': 'kernel', 'name': 'gemm', 'pid': 0, 'tid': 7, 'ts': 190, 'dur': 30},
+    {'ph': 'X', 'cat': 'kernel', 'name': 'warmup_gemm', 'pid': 0, 'tid': 7, 'ts': 12, 'dur': 3},
+    {'ph': 'X', 'cat': 'cpu_op', 'name': 'after', 'pid': 1, 'tid': 1, 'ts': 300, 'dur': 5},
+    {'ph': 'X', 'cat': 'cpu_op', 'name': 'load', 'pid': 2, 'tid': 3, 'ts': 120, 'dur': 5},
+  ]}
+
+
+@pytest.mark.parametrize('read_block_size', [7, 64, 1 << 20])
+def test_find_profiler_step_windows(tmp_path, read_block_size):
+  filepath = write_trace(tmp_path, make_profiler_trace(), indent=1)
+  windows, step_pids = h_read.find_profiler_step_windows(filepath, read_block_size=read_block_size)
+  assert windows == [(100, 200)]
+  assert step_pids == {1}
+
+
+def test_find_profiler_step_windows_fallback(tmp_path):
+  # "name" after a nested object can't be found by the byte search
+  trace = {'traceEvents': [{'ph': 'X', 'args': {'a': {}}, 'name': 'ProfilerStep#0', 'pid': 5, 'ts': 1, 'dur': 2}]}
+  filepath = write_trace(tmp_path, trace)
+  assert h_read.find_profiler_step_windows(filepath) == ([(1, 3)], {5})
+
+
+def test_load_raw_trace_profiler_step_only(tmp_path):
+  filepath = write_trace(tmp_path, make_profiler_trace())
+  _, _, slices_bytes = h_read.load_raw_trace(filepath, profiler_step_only=True)
+  names = [event['name'] if event['ph'] != 'M' else event['args']['name'] for event in json.loads(read_all(slices_bytes))]
+  assert names == ['python', 'ProfilerStep#3', 'aten::add_', 'backward', 'launch', 'gemm', 'GPU 0']
+
+  # Without any ProfilerStep nothing is dropped
+  trace = {'traceEvents': make_profiler_trace()['traceEvents'][:4]}
+  filepath = write_trace(tmp_path, trace, name='no_step.json')
+  _, _, slices_bytes = h_read.load_raw_trace(filepath, profiler_step_only=True)
+  assert len(json.loads(read_all(slices_bytes))) == 4
+
+
+def make_large_trace(count=200):
+  events = []
+  for idx in range(count):
+    event = {'ph': 'X', 'cat': 'cpu_op', 'name': f'op{idx} }},{{', 'pid': 1, 'tid': -(idx % 3), 'ts': idx, 'dur': 1, 'id': idx}
+    if idx % 10 == 0:
+      event['args'] = {'shapes': [{'a': 1}, {'b': 2}], 'cat': None}  # "},{" inside a nested value
+    events.append(event)
+  return {'schemaVersion': 1, 'traceEvents': events, 'deviceProperties': [{'id': 0}], 'traceName': 'x'}
+
+
+@pytest.mark.parametrize('indent', [None, 1])
+def test_parallel_ingest_matches_streaming(tmp_path, indent):
+  filepath = write_trace(tmp_path, make_large_trace(), indent=indent)
+  serial = h_read.load_raw_trace(filepath, remove_slice_args=False)
+  parallel = h_read.load_raw_trace(filepath, remove_slice_args=False, num_workers=3)
+  assert parallel[0] == serial[0]
+  assert parallel[1] == serial[1]
+  assert read_all(parallel[2]) == read_all(serial[2])
+
+
+def test_parallel_ingest_on_a_started_pool(tmp_path):
+  from hotline.hotline import h_util
+  filepath = write_trace(tmp_path, make_large_trace())
+  serial = h_read.load_raw_trace(filepath)
+  with h_util.start_process_pool(2) as executor:
+    assert len(executor._processes) == 2  # forked before any task that needs them
+    parallel = h_read.load_raw_trace(filepath, num_workers=2, executor=executor)
+  assert parallel[1] == serial[1]
+  assert read_all(parallel[2]) == read_all(serial[2])
+
+
+def test_trace_event_ranges_start_on_events(tmp_path):
+  filepath = write_trace(tmp_path, make_large_trace(), indent=1)
+  ranges = h_read.find_trace_event_ranges(filepath, 8)
+  assert len(ranges) > 1 and ranges[-1][1] is None
+  with open(filepath, 'rb') as f:
+    data = f.read()
+  assert all(data[start:start + 1] == b'{' for start, _ in ranges)
+  assert h_read.find_trace_event_ranges(write_trace(tmp_path, {'traceEvents': []}, name='empty.json'), 8) == []
+
+
+def test_parallel_ingest_profiler_step_only(tmp_path):
+  filepath = write_trace(tmp_path, make_profiler_trace(), indent=1)
+  serial = h_read.load_raw_trace(filepath, profiler_step_only=True)
+  parallel = h_read.load_raw_trace(filepath, profiler_step_only=True, num_workers=2)
+  assert sorted(json.loads(read_all(parallel[2])), key=str) == sorted(json.loads(read_all(serial[2])), key=str)
+  assert parallel[1] == serial[1]
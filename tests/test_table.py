@@ -0,0 +1,114 @@
+"""
+# Run Tests
+pytest tests/test_table.py -s
+"""
+import pytest
+import os
+import sys
+import pickle
+import numpy as np
+sys.path.append(os.path.abspath('.'))
+from hotline.hotline import h_table, h_slice, h_time, h_name
+
+
+def make_slices():
+  # Two tracks. Track 1: a(0) > b(1) > c(2) and a(0) > b(4). Track 2: kernel(3)
+  return [
+    {'id': 0, 'ts': 100, 'dur': 50, 'track_id': 1, 'depth': 0, 'parent_id': None, 'name': 'a', 'category': 'cpu_op'},
+    {'id': 3, 'ts': 120, 'dur': 10, 'track_id': 2, 'depth': 0, 'parent_id': None, 'name': 'kernel', 'category': 'kernel'},
+    {'id': 1, 'ts': 105, 'dur': 20, 'track_id': 1, 'depth': 1, 'parent_id': 0, 'name': 'b', 'category': 'cpu_op'},
+    {'id': 2, 'ts': 110, 'dur': 5, 'track_id': 1, 'depth': 2, 'parent_id': 1, 'name': 'c', 'category': None},
+    {'id': 4, 'ts': 130, 'dur': 10, 'track_id': 1, 'depth': 1, 'parent_id': 0, 'name': 'b', 'category': 'cpu_op'},
+  ]
+
+
+def test_from_rows_is_sorted_by_id_and_interns_names():
+  table = h_table.SliceTable.from_rows(make_slices())
+  assert table.id.tolist() == [0, 1, 2, 3, 4]
+  assert table.parent_id.tolist() == [-1, 0, 1, -1, 0]
+  assert table.name_codes[1] == table.name_codes[4]  # 'b' is stored once
+  assert table.names == ['a', 'b', 'c', 'kernel']  # only the names of this table
+  assert [table.names[code] for code in table.name_codes] == ['a', 'b', 'c', 'kernel', 'b']
+  assert table.name_code('kernel') == 3 and table.name_code('missing') == -1
+
+
+def test_to_dicts_round_trip():
+  table = h_table.SliceTable.from_rows(make_slices())
+  slice = table.to_dict(table.rows_for_ids([2])[0])
+  assert slice == {'ts': 110, 'dur': 5, 'track_id': 1, 'category': None, 'name': 'c', 'depth': 2, 'cat': None, 'slice_id': 2, 'id': 2, 'parent_id': 1}
+
+
+def test_rows_for_missing_ids():
+  table = h_table.SliceTable.from_rows(make_slices())
+  with pytest.raises(KeyError):
+    table.rows_for_ids([99])
+
+
+def test_slice_index_reuses_dicts():
+  slice_index = h_table.SliceIndex(h_table.SliceTable.from_rows(make_slices()))
+  assert slice_index[3] is slice_index[3]
+  assert slice_index[3]['name'] == 'kernel'
+  assert 99 not in slice_index
+  assert 4 in slice_index
+  assert len(slice_index) == 5
+  with pytest.raises(KeyError):
+    slice_index[99]
+
+
+def test_row_helpers_match_dict_helpers():
+  slices = make_slices()
+  table = h_table.SliceTable.from_rows(slices)
+  track_rows = np.flatnonzero(table.track_id == 1)
+  assert table.id[h_slice.get_rows_at_depth(table, track_rows, 'minimum')].tolist() == [0]
+  assert table.id[h_slice.get_rows_at_depth(table, track_rows, 1)].tolist() == [1, 4]
+
+  # Descendants of a DataParallel.forward slice, see detect_model.model_detection_units()
+  for ids in [[0, 1, 2, 4], [1, 2, 4], [0, 2], [], [0, 1, 3, 2, 4]]:
+    rows = table.rows_for_ids(sorted(ids)) if ids else np.array([], dtype=np.int64)
+    rows = h_slice.get_rows_at_depth(table, h_slice.remove_upper_depth_rows_if_only_one_slice(table, rows), 'minimum')
+    dict_slices = h_slice.get_slices_at_depth(h_slice.remove_upper_depths_if_only_one_slice(table.to_dicts(table.rows_for_ids(sorted(ids)))), 'minimum')
+    assert table.to_dicts(rows) == dict_slices
+
+
+def test_pickled_table_carries_only_its_names():
+  h_name.name_table.intern('a name of another trace')
+  table = h_table.SliceTable.from_rows(make_slices())
+  unpickled = pickle.loads(pickle.dumps(table))
+  assert unpickled.names == ['a', 'b', 'c', 'kernel']
+  assert unpickled.to_dicts(np.arange(5)) == table.to_dicts(np.arange(5))
+  assert unpickled.names[0] is h_name.name_table.names[h_name.name_table.intern('a')]  # shares the strings of this process
+
+
+def test_children_index():
+  table = h_table.SliceTable.from_rows(make_slices())
+  rows = table.rows_for_ids([0, 1, 2, 3, 4])
+  assert table.id[table.children_rows([rows[0]])].tolist() == [1, 4]
+  assert table.children_rows([rows[2], rows[3]]).tolist() == []
+  assert table.id[table.descendant_rows(rows[0])].tolist() == [1, 2, 4]
+  assert table.descendant_rows(rows[3]).tolist() == []
+  assert table.id[table.ancestor_rows(rows[2])].tolist() == [1, 0]
+  assert table.ancestor_rows(rows[0]).tolist() == []
+  assert table.id[table.rows_for_ids([4, 99, 2], skip_missing=True)].tolist() == [4, 2]
+
+
+def test_interval_index_matches_scans():
+  rng = np.random.default_rng(0)
+  slices = [{'id': idx, 'ts': int(ts), 'dur': int(dur), 'track_id': int(track), 'depth': 0, 'parent_id': None, 'name': 'a', 'category': None}
+    for idx, (ts, dur, track) in enumerate(zip(rng.integers(0, 1000, 300), rng.integers(0, 200, 300), rng.integers(0, 3, 300)))]
+  table = h_table.SliceTable.from_rows(slices)
+  intervals = table.intervals()
+  for start, end in [(0, 0), (100, 400), (500, 510), (990, 2000)]:
+    for track_ids in [None, [1], [0, 2, 99]]:
+      on_tracks = [slice for slice in slices if track_ids is None or slice['track_id'] in track_ids]
+      assert table.id[intervals.starting_between(start, end, track_ids)].tolist() == [slice['id'] for slice in on_tracks if start <= slice['ts'] <= end]
+      assert table.id[intervals.starting_between(start, end, track_ids, include_end=False)].tolist() == [slice['id'] for slice in on_tracks if start <= slice['ts'] < end]
+      assert table.id[intervals.overlapping(start, end, track_ids)].tolist() == [slice['id'] for slice in on_tracks if slice['ts'] <= end and slice['ts'] + slice['dur'] >= start]
+      assert table.id[intervals.within(start, end, track_ids)].tolist() == [slice['id'] for slice in on_tracks if slice['ts'] >= start and slice['ts'] + slice['dur'] <= end]
+
+
+def test_sub_slices_for_range_with_interval_index():
+  slices = make_slices()
+  slice_group = [slices[2], slices[1]]  # b and kernel, 105 to 130
+  interval_index = h_table.IntervalIndex.from_slices(slices)
+  assert h_slice.get_sub_slices_for_range(slices, slice_group, interval_index) == h_slice.get_sub_slices_for_range(slices, slice_group)
+  assert [slice['id'] for slice in h_slice.get_sub_slices_for_range(slices, slice_group, interval_index)] == [3, 1, 2]
@@ -0,0 +1,56 @@
+"""
+# Run Tests
+pytest tests/test_write.py -s
+"""
+import pytest
+import os
+import sys
+sys.path.append(os.path.abspath('.'))
+from hotline.hotline import h_write, h_read
+
+
+def test_protobuf_trace_detection():
+  assert h_read.is_protobuf_trace('/traces/resnet.pftrace')
+  assert h_read.is_protobuf_trace('/traces/resnet.perfetto-trace.gz')
+  assert not h_read.is_protobuf_trace('/traces/resnet.pt.trace.json')
+  assert not h_read.is_protobuf_trace('/traces/resnet.pt.trace.json.zst')
+
+
+def test_slices_to_chrome_events():
+  track_index = {2: {'pid': 10, 'tid': 7, 'process_name': 'python', 'thread_name': 'main'}}
+  slices = [
+    {'name': 'aten::add_', 'ts': 1665165714853849000, 'dur': 15000, 'category': 'cpu_op', 'track_id': 2},
+    {'name': 'kernel', 'ts': 1665165714853850500, 'dur': -1, 'category': None, 'track_id': 5},
+  ]
+  events = h_write.slices_to_chrome_events(slices, track_index)
+  assert events == [
+    {'ph': 'M', 'name': 'process_name', 'pid': 10, 'tid': 7, 'args': {'name': 'python'}},
+    {'ph': 'M', 'name': 'thread_name', 'pid': 10, 'tid': 7, 'args': {'name': 'main'}},
+    {'ph': 'X', 'name': 'aten::add_', 'cat': 'cpu_op', 'ts': 1665165714853849.0, 'dur': 15.0, 'pid': 10, 'tid': 7},
+    {'ph': 'X', 'name': 'kernel', 'cat': 'NULL', 'ts': 1665165714853850.5, 'dur': 0.0, 'pid': 0, 'tid': 5},
+  ]
+
+
+def test_write_trace_exports_raw_events(tmp_path, monkeypatch):
+  import json
+  trace_filepath = tmp_path / 'trace.json'
+  events = [
+    {'ph': 'X', 'name': 'a', 'ts': 1, 'dur': 10, 'tid': 1, 'cat': None},
+    {'ph': 'X', 'name': 'b', 'ts': 2, 'dur': 3, 'tid': 1, 'cat': 'cpu_op'},
+  ]
+  trace_filepath.write_text(json.dumps({'traceEvents': events}))
+  _, raw_slice_index, slices_bytes = h_read.load_raw_trace(str(trace_filepath))
+  track_index = {4: {'tid': 1}}
+  slices = [{'name': 'b', 'ts': 2000, 'dur': 3000, 'category': 'cpu_op', 'track_id': 4}, {'name': 'a', 'ts': 1000, 'dur': 10000, 'category': None, 'track_id': 4}]
+  monkeypatch.setattr(h_write, 'export_idx', 1)  # not the top op
+  op = {'resources': {'cpu': {'slices': slices}}}
+  h_write.write_trace(op, str(tmp_path), 'run', raw_slice_index, slices_bytes, track_index)
+  with open(op['trace_file'], 'rb') as f:
+    assert json.loads(f.read()) == [events[1], dict(events[0], cat='NULL')]
+
+  # The top op gets the whole normalized trace
+  monkeypatch.setattr(h_write, 'export_idx', 0)
+  op = {}
+  h_write.write_trace(op, str(tmp_path), 'run', raw_slice_index, slices_bytes, track_index)
+  with open(op['trace_file'], 'rb') as f:
+    assert json.loads(f.read()) == events